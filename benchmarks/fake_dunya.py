@@ -0,0 +1,62 @@
+import os
+import shutil
+import time
+
+
+def _clock(ms:float) -> str:
+    seconds = int(ms // 1000)
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class FakeTradition:
+    '''
+    Stand-in for compmusic.dunya.hindustani / .andalusian. Recordings are the fixture
+    files, cycled, and every call sleeps for latency seconds.
+
+    params:
+        - tradition (str): 'hindustani' or 'andalusian'.
+        - fixtures (list): paths of the synthetic MP3s to serve.
+        - duration_ms (float): length of the fixtures, for the andalusian sections.
+        - n_recordings (int): size of the corpus listing.
+        - latency (float): seconds added to every call.
+    '''
+    def __init__(self, tradition:str, fixtures:list, duration_ms:float, n_recordings:int, latency:float = 0.0):
+        self.tradition = tradition
+        self.fixtures = fixtures
+        self.duration_ms = duration_ms
+        self.latency = latency
+        self.mbids = [f'{tradition[:3]}-{i:06d}' for i in range(n_recordings)]
+
+    def get_recordings(self) -> list:
+        time.sleep(self.latency)
+        return [{'mbid': mbid, 'title': f'Recording {i}'} for i, mbid in enumerate(self.mbids)]
+
+    def get_recording(self, mbid:str) -> dict:
+        time.sleep(self.latency)
+        if self.tradition == 'hindustani':
+            common = lambda name: [{'common_name': name}]
+            return {'layas': common('Vilambit'), 'taals': common('Tīntāl'), 'forms': common('Khayāl')}
+        # Three sections, the last one long enough to be split further
+        bounds = [0, self.duration_ms * 0.2, self.duration_ms * 0.4, self.duration_ms]
+        return {'sections': [
+            {
+                'start_time': _clock(start), 'end_time': _clock(end),
+                'mizan': {'display_order': 1}, 'nawba': {'display_order': 2}, 'form': {'display_order': i + 1},
+            }
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:]))
+        ]}
+
+    def download_mp3(self, mbid:str, location:str) -> str:
+        '''Copy a fixture to location/<title>.mp3, as dunya names its downloads.'''
+        time.sleep(self.latency)
+        i = self.mbids.index(mbid)
+        name = f'Recording {i}.mp3'
+        shutil.copyfile(self.fixtures[i % len(self.fixtures)], os.path.join(location, name))
+        return name
+
+
+def install(dunya, fixtures:list, duration_ms:float, n_recordings:int, latency:float = 0.0):
+    '''Point the dunya module used by dunya_functionality at fake traditions.'''
+    dunya.set_token = lambda token: None
+    for tradition in ('hindustani', 'andalusian'):
+        setattr(dunya, tradition, FakeTradition(tradition, fixtures, duration_ms, n_recordings, latency))
@@ -0,0 +1,31 @@
+import os
+import random
+
+from pydub import AudioSegment
+from pydub.generators import Sine, WhiteNoise
+
+# Length of each tone in a synthetic recording, in ms
+NOTE_MS = 2000
+
+
+def synthetic_mp3(path:str, seconds:float, seed:int = 0, bitrate:str = '128k') -> str:
+    '''
+    Write a recording of random sine notes over low noise, so different seeds give
+    different audio. Reused if it already exists.
+    '''
+    if os.path.isfile(path):
+        return path
+    rng = random.Random(seed)
+    audio = AudioSegment.empty()
+    while len(audio) < seconds * 1000:
+        audio += Sine(rng.uniform(110, 880)).to_audio_segment(duration=NOTE_MS, volume=-12)
+    audio = audio[:int(seconds * 1000)]
+    audio = audio.overlay(WhiteNoise().to_audio_segment(duration=len(audio), volume=-40))
+    audio.set_channels(2).export(path, format='mp3', bitrate=bitrate)
+    return path
+
+
+def fixture_set(directory:str, n:int, seconds:float) -> list:
+    '''n distinct synthetic recordings of the given length, created on first use.'''
+    os.makedirs(directory, exist_ok=True)
+    return [synthetic_mp3(os.path.join(directory, f'fixture_{seconds:g}s_{i}.mp3'), seconds, seed=i) for i in range(n)]
@@ -0,0 +1,344 @@
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+from graphql import build_schema, graphql_sync
+
+from feature_schema import (
+    BPM_PREDICTION_FIELDS, CATEGORICAL_FIELDS, MOOD_FIELDS, MOOD_ADVANCED_FIELDS, MOVEMENT_FIELDS
+)
+
+# Labels the mock hands out for each categorical field
+LABELS = {
+    'energyLevel': ('variable', 'medium', 'high', 'low'),
+    'energyDynamics': ('low', 'medium', 'high'),
+    'emotionalProfile': ('variable', 'negative', 'balanced', 'positive'),
+    'emotionalDynamics': ('low', 'medium', 'high'),
+}
+
+
+def _object_type(name:str, fields) -> str:
+    return f'type {name} {{\n' + ''.join(f'  {field}: Float\n' for field in fields) + '}\n'
+
+
+def schema_sdl() -> str:
+    '''SDL of the slice of the Cyanite API that cyaniteAPI.py calls.'''
+    labels = ''.join(f'  {field}: String\n' for field in CATEGORICAL_FIELDS)
+    return '''
+type Query {
+  libraryTrack(id: ID!): LibraryTrackResult!
+  libraryTracks(filter: LibraryTracksFilter, first: Int, after: String): LibraryTrackConnection!
+}
+
+type Mutation {
+  fileUploadRequest: FileUploadRequest!
+  libraryTrackCreate(input: LibraryTrackCreateInput!): LibraryTrackCreateResult!
+}
+
+input LibraryTracksFilter {
+  sha256: String
+}
+
+input LibraryTrackCreateInput {
+  uploadId: ID!
+  title: String!
+}
+
+type FileUploadRequest {
+  id: ID!
+  uploadUrl: String!
+}
+
+union LibraryTrackCreateResult = LibraryTrackCreateSuccess | LibraryTrackCreateError
+
+type LibraryTrackCreateSuccess {
+  createdLibraryTrack: LibraryTrack!
+}
+
+type LibraryTrackCreateError {
+  code: String!
+  message: String!
+}
+
+union LibraryTrackResult = LibraryTrack | LibraryTrackNotFoundError
+
+type LibraryTrackNotFoundError {
+  message: String!
+}
+
+type PageInfo {
+  hasNextPage: Boolean!
+}
+
+type LibraryTrackEdge {
+  cursor: String!
+  node: LibraryTrack!
+}
+
+type LibraryTrackConnection {
+  pageInfo: PageInfo!
+  edges: [LibraryTrackEdge!]!
+}
+
+type LibraryTrack {
+  id: ID!
+  title: String!
+  audioAnalysisV6: AudioAnalysisV6!
+}
+
+union AudioAnalysisV6 = AudioAnalysisV6Processing | AudioAnalysisV6Finished | AudioAnalysisV6Failed
+
+type AudioAnalysisV6Processing {
+  status: String
+}
+
+type AudioAnalysisV6Failed {
+  error: String
+}
+
+type AudioAnalysisV6Finished {
+  result: AudioAnalysisV6Result!
+}
+
+type AudioAnalysisV6MoodMaxTime {
+  mood: String!
+  start: Float!
+  end: Float!
+}
+
+type AudioAnalysisV6Result {
+  valence: Float
+  arousal: Float
+''' + labels + '''  mood: AudioAnalysisV6Mood
+  moodTags: [String!]!
+  moodMaxTimes: [AudioAnalysisV6MoodMaxTime!]!
+  moodAdvanced: AudioAnalysisV6MoodAdvanced
+  moodAdvancedTags: [String!]!
+  movement: AudioAnalysisV6Movement
+  movementTags: [String!]!
+  bpmPrediction: AudioAnalysisV6BpmPrediction
+  bpmRangeAdjusted: Float
+}
+
+''' + '\n'.join([
+        _object_type('AudioAnalysisV6Mood', MOOD_FIELDS),
+        _object_type('AudioAnalysisV6MoodAdvanced', MOOD_ADVANCED_FIELDS),
+        _object_type('AudioAnalysisV6Movement', MOVEMENT_FIELDS),
+        _object_type('AudioAnalysisV6BpmPrediction', BPM_PREDICTION_FIELDS),
+    ])
+
+
+def _operation_name(query:str) -> str:
+    match = re.search(r'\b(?:query|mutation)\s+(\w+)', query)
+    return match.group(1) if match else 'anonymous'
+
+
+def synthetic_result(seed:str) -> dict:
+    '''A plausible analysis result, the same on every call for one seed.'''
+    rng = random.Random(seed)
+    scores = lambda fields: {field: round(rng.random(), 6) for field in fields}
+    mood, advanced, movement = scores(MOOD_FIELDS), scores(MOOD_ADVANCED_FIELDS), scores(MOVEMENT_FIELDS)
+    top = lambda group, n: sorted(group, key=group.get, reverse=True)[:n]
+    return {
+        'valence': round(rng.uniform(-1, 1), 6),
+        'arousal': round(rng.uniform(-1, 1), 6),
+        **{field: rng.choice(LABELS[field]) for field in CATEGORICAL_FIELDS},
+        'mood': mood,
+        'moodTags': top(mood, 3),
+        'moodMaxTimes': [{'mood': m, 'start': 0.0, 'end': 15.0} for m in top(mood, 3)],
+        'moodAdvanced': advanced,
+        'moodAdvancedTags': top(advanced, 5),
+        'movement': movement,
+        'movementTags': top(movement, 2),
+        'bpmPrediction': {'value': round(rng.uniform(60, 180), 1), 'confidence': round(rng.random(), 6)},
+        'bpmRangeAdjusted': round(rng.uniform(60, 180), 1),
+    }
+
+
+class MockCyanite:
+    '''
+    Local stand-in for the Cyanite GraphQL API and its S3 upload URLs. Queries are
+    executed by graphql-core against schema_sdl(), so introspection and validation
+    behave like the real endpoint. Uploaded bytes are hashed so libraryTracks can
+    answer sha256 filters, and an analysis finishes analysis_time seconds after its
+    track is created.
+
+    params:
+        - latency (float): seconds added to every GraphQL request.
+        - upload_latency (float): seconds added to every PUT.
+        - upload_bandwidth (float): bytes/s a PUT is slowed down to. None for no limit.
+        - analysis_time (float): seconds an analysis stays in AudioAnalysisV6Processing.
+        - port (int): 0 picks a free port.
+        - webhook_url (str): if set, an analysis event signed with webhook_secret is posted
+        here as each analysis finishes, like a Cyanite integration webhook.
+    '''
+    def __init__(self, latency:float = 0.0, upload_latency:float = 0.0, upload_bandwidth:float = None,
+                 analysis_time:float = 0.0, host:str = '127.0.0.1', port:int = 0,
+                 webhook_url:str = None, webhook_secret:str = None):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.upload_bandwidth = upload_bandwidth
+        self.analysis_time = analysis_time
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.schema = build_schema(schema_sdl())
+        self.uploads = {}
+        self.tracks = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> str:
+        '''Serve on a background thread and return the GraphQL endpoint.'''
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url + '/graphql'
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, name:str):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def execute(self, body:dict) -> dict:
+        time.sleep(self.latency)
+        self._count(body.get('operationName') or _operation_name(body['query']))
+        result = graphql_sync(
+            self.schema, body['query'], root_value=self._root(),
+            variable_values=body.get('variables'), operation_name=body.get('operationName'),
+        )
+        response = {'data': result.data}
+        if result.errors:
+            response['errors'] = [error.formatted for error in result.errors]
+        return response
+
+    def put(self, upload_id:str, data:bytes) -> int:
+        time.sleep(self.upload_latency + (len(data) / self.upload_bandwidth if self.upload_bandwidth else 0))
+        self._count('PUT')
+        with self._lock:
+            if upload_id not in self.uploads:
+                return 404
+            self.uploads[upload_id] = hashlib.sha256(data).hexdigest()
+        return 200
+
+    def _root(self) -> dict:
+        # graphql-core calls callables on the root value with (info, **args)
+        return {
+            'fileUploadRequest': self._file_upload_request,
+            'libraryTrackCreate': self._library_track_create,
+            'libraryTrack': self._library_track,
+            'libraryTracks': self._library_tracks,
+        }
+
+    def _file_upload_request(self, info):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = None
+        return {'id': upload_id, 'uploadUrl': f'{self.url}/upload/{upload_id}'}
+
+    def _library_track_create(self, info, input):
+        with self._lock:
+            sha256 = self.uploads.get(input['uploadId'])
+            if sha256 is None:
+                return {'__typename': 'LibraryTrackCreateError', 'code': 'fileUploadNotFound',
+                        'message': 'No file was uploaded for this id'}
+            track_id = uuid.uuid4().hex
+            self.tracks[track_id] = {'title': input['title'], 'sha256': sha256, 'created': time.monotonic()}
+        if self.webhook_url:
+            threading.Timer(self.analysis_time, self._send_webhook, (track_id,)).start()
+        return {'__typename': 'LibraryTrackCreateSuccess', 'createdLibraryTrack': self._track(track_id)}
+
+    def _send_webhook(self, track_id:str):
+        body = json.dumps({
+            'version': '2',
+            'resource': {'type': 'LibraryTrack', 'id': track_id},
+            'event': {'type': 'AudioAnalysisV6', 'status': 'finished'},
+        }).encode()
+        signature = hmac.new(self.webhook_secret.encode(), body, hashlib.sha512).hexdigest()
+        self._count('webhook')
+        requests.post(self.webhook_url, data=body, headers={'Content-Type': 'application/json', 'Signature': signature})
+
+    def _library_track(self, info, id):
+        if id not in self.tracks:
+            return {'__typename': 'LibraryTrackNotFoundError', 'message': f'Track {id} not found'}
+        return self._track(id)
+
+    def _library_tracks(self, info, filter=None, first=None, after=None):
+        sha256 = (filter or {}).get('sha256')
+        with self._lock:
+            ids = [i for i, track in self.tracks.items() if sha256 is None or track['sha256'] == sha256]
+        return {'pageInfo': {'hasNextPage': False}, 'edges': [{'cursor': i, 'node': self._track(i)} for i in ids]}
+
+    def _track(self, track_id:str) -> dict:
+        track = self.tracks[track_id]
+        if time.monotonic() - track['created'] < self.analysis_time:
+            analysis = {'__typename': 'AudioAnalysisV6Processing', 'status': 'processing'}
+        else:
+            analysis = {'__typename': 'AudioAnalysisV6Finished', 'result': synthetic_result(track['sha256'])}
+        return {'__typename': 'LibraryTrack', 'id': track_id, 'title': track['title'], 'audioAnalysisV6': analysis}
+
+
+def _handler(mock:MockCyanite):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, as the pooled aiohttp and requests sessions expect
+        protocol_version = 'HTTP/1.1'
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _reply(self, status:int, body:bytes = b'', content_type:str = 'application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if urlsplit(self.path).path != '/graphql':
+                return self._reply(404)
+            self._reply(200, json.dumps(mock.execute(json.loads(self._body()))).encode())
+
+        def do_PUT(self):
+            parts = urlsplit(self.path).path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'upload':
+                return self._reply(404)
+            self._reply(mock.put(parts[1], self._body()), content_type='text/plain')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Cyanite API.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every GraphQL request')
+    parser.add_argument('--upload_latency', type=float, default=0.0, help='Seconds added to every PUT')
+    parser.add_argument('--analysis_time', type=float, default=0.0, help='Seconds before an analysis finishes')
+    args = parser.parse_args()
+    mock = MockCyanite(args.latency, args.upload_latency, analysis_time=args.analysis_time, port=args.port)
+    print(f'Serving {mock.start()}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Pipeline stages in the order they feed each other
+STAGES = ('download', 'split', 'tag', 'parse')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DUNYA_CONFIG = 'dunya_config.json'
+SEGMENTS_DIR = 'segments'
+SEGMENTS_CSV = 'segments.csv'
+FEATURES_CSV = 'features.csv'
+
+
+class Recorder:
+    '''
+    Appends per-item latencies to a file, so samples taken in pool processes forked
+    from the stage process are kept too.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+
+    def record(self, seconds:float):
+        with open(self.path, 'a') as f:
+            f.write(f'{seconds}\n')
+
+    def wrap(self, owner, name:str):
+        '''Replace owner.name with a version that records how long each call takes.'''
+        fn = getattr(owner, name)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(time.perf_counter() - start)
+        setattr(owner, name, timed)
+
+    def samples(self) -> list:
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, 'r') as f:
+            return [float(line) for line in f if line.strip()]
+
+
+def _peak_rss_mb(who) -> float:
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def _dataset_dir(cfg:dict) -> str:
+    return os.path.join('data', cfg['dataset'])
+
+
+def run_download(cfg:dict, recorder:Recorder) -> int:
+    from compmusic import dunya
+    from benchmarks import fake_dunya
+    import dunya_functionality
+    fake_dunya.install(dunya, cfg['fixtures'], cfg['seconds'] * 1000, cfg['recordings'], cfg['dunya_latency'])
+    recorder.wrap(dunya_functionality.Downloader, '_download_one')
+    downloader = dunya_functionality.Downloader(
+        cfg['recordings'], DUNYA_CONFIG, cfg['dataset'],
+        path_to_andalusian=os.path.join('data', 'andalusian'),
+        path_to_hindustani=os.path.join('data', 'hindustani'),
+        configs_save_path='configs',
+        workers=cfg['download_workers'],
+    )
+    downloader.download()
+    return len(os.listdir(_dataset_dir(cfg)))
+
+
+def run_split(cfg:dict, recorder:Recorder) -> int:
+    from compmusic import dunya
+    from benchmarks import fake_dunya
+    import dunya_functionality
+    import pandas as pd
+    from pydub import AudioSegment
+    from mp3_frames import MP3Frames
+    fake_dunya.install(dunya, cfg['fixtures'], cfg['seconds'] * 1000, cfg['recordings'], cfg['dunya_latency'])
+    # One sample per exported segment, whichever mode writes it
+    recorder.wrap(AudioSegment, 'export')
+    recorder.wrap(MP3Frames, 'segment')
+    splitter = dunya_functionality.Splitter(
+        _dataset_dir(cfg), SEGMENTS_DIR, cfg['segment_minutes'], cfg['large_segment_minutes'], DUNYA_CONFIG,
+        workers=cfg['split_workers'],
+        streaming=cfg['split_mode'] == 'streaming',
+        lossless=cfg['split_mode'] == 'lossless',
+    )
+    splitter.split()
+    segments = sorted(os.listdir(SEGMENTS_DIR))
+    pd.DataFrame({'filename': segments, 'genre': cfg['dataset']}).to_csv(SEGMENTS_CSV, index=False)
+    return len(segments)
+
+
+def run_tag(cfg:dict, recorder:Recorder) -> int:
+    import cyaniteAPI
+    import pandas as pd
+    cyaniteAPI.request_url = cfg['url']
+    cyaniteAPI.POLL_INITIAL_DELAY = cfg['poll_delay']
+    if cfg['rate']:
+        cyaniteAPI.setRateLimit(cfg['rate'], max(1, int(cfg['rate'])))
+    cyaniteAPI.startProcessProxy(
+        SEGMENTS_DIR, SEGMENTS_CSV, cfg['concurrency'] or None, cfg['upload_workers'], cfg['batch_size']
+    )
+    # Per-file latency: from the first journalled stage to the features being saved
+    first, done = {}, {}
+    with open(cyaniteAPI.JOURNAL_PATH, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            timestamp = datetime.fromisoformat(entry['timestamp'])
+            first.setdefault(entry['file'], timestamp)
+            if entry['stage'] == 'features-fetched':
+                done[entry['file']] = timestamp
+    for file, end in done.items():
+        recorder.record((end - first[file]).total_seconds())
+    return len(pd.read_csv(SEGMENTS_CSV))
+
+
+def run_parse(cfg:dict, recorder:Recorder) -> int:
+    import pandas as pd
+    import parse_and_save_features
+    if cfg['parse_workers']:
+        parse_and_save_features.process_features_parallel(
+            SEGMENTS_CSV, 'classifierResults', FEATURES_CSV, cfg['parse_workers']
+        )
+    else:
+        recorder.wrap(parse_and_save_features, 'load_result')
+        parse_and_save_features.process_features(SEGMENTS_CSV, 'classifierResults', FEATURES_CSV)
+    return len(pd.read_csv(SEGMENTS_CSV))
+
+
+STAGE_RUNNERS = {'download': run_download, 'split': run_split, 'tag': run_tag, 'parse': run_parse}
+
+
+def run_stage(stage:str, workdir:str):
+    '''Child process entry point: run one stage inside workdir and save its measurements.'''
+    with open(os.path.join(workdir, 'bench.json'), 'r') as f:
+        cfg = json.load(f)
+    os.chdir(workdir)
+    recorder = Recorder(f'{stage}.samples')
+    start = time.perf_counter()
+    items = STAGE_RUNNERS[stage](cfg, recorder)
+    seconds = time.perf_counter() - start
+    result = {
+        'stage': stage,
+        'items': items,
+        'seconds': round(seconds, 3),
+        'items_per_sec': round(items / seconds, 2) if seconds > 0 else None,
+        'samples': recorder.samples(),
+        'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+        'children_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+    with open(f'{stage}.result.json', 'w') as f:
+        json.dump(result, f)
+
+
+def summarize(result:dict) -> dict:
+    '''Replace the raw samples of a stage result with p50/p99 in ms.'''
+    samples = result.pop('samples')
+    result['latency_samples'] = len(samples)
+    result['p50_ms'] = round(float(np.percentile(samples, 50)) * 1000, 1) if samples else None
+    result['p99_ms'] = round(float(np.percentile(samples, 99)) * 1000, 1) if samples else None
+    return result
+
+
+def print_report(results:list):
+    columns = ('stage', 'items', 'seconds', 'items_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_mb', 'children_peak_rss_mb')
+    rows = [[str(r.get(c, '')) if r.get(c) is not None else '-' for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def prepare(args, workdir:str) -> dict:
+    '''Create the fixtures and working directories, and write the config stage processes read.'''
+    from benchmarks.fixtures import fixture_set
+    fixture_dir = args.fixture_dir or os.path.join(workdir, 'fixtures')
+    # Fewer fixtures than recordings means duplicate audio, which tagging uploads only once
+    args.fixtures = args.fixtures or args.recordings
+    print(f'Preparing {args.fixtures} synthetic {args.seconds:g}s recordings in {fixture_dir}')
+    fixtures = [os.path.abspath(p) for p in fixture_set(fixture_dir, args.fixtures, args.seconds)]
+    # Downloader creates data/<dataset> with os.mkdir, so the parent has to exist
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    with open(os.path.join(workdir, DUNYA_CONFIG), 'w') as f:
+        json.dump({'key': 'benchmark'}, f)
+    cfg = {key: value for key, value in vars(args).items() if key not in ('stage', 'report')}
+    cfg['fixtures'] = fixtures
+    return cfg
+
+
+def main(args):
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='tagger-bench-'))
+    os.makedirs(workdir, exist_ok=True)
+    cfg = prepare(args, workdir)
+    stages = args.stages.split(',')
+    assert all(stage in STAGES for stage in stages), f'Stages must be among {STAGES}'
+    mock = None
+    if 'tag' in stages:
+        from benchmarks.mock_cyanite import MockCyanite
+        mock = MockCyanite(args.api_latency, args.upload_latency, analysis_time=args.analysis_time)
+        cfg['url'] = mock.start()
+    with open(os.path.join(workdir, 'bench.json'), 'w') as f:
+        json.dump(cfg, f)
+
+    results = []
+    try:
+        for stage in stages:
+            print(f'Running {stage}')
+            log_path = os.path.join(workdir, f'{stage}.log')
+            with open(log_path, 'w') as log:
+                p = subprocess.run(
+                    [sys.executable, '-m', 'benchmarks.run', '--stage', stage, '--workdir', workdir],
+                    cwd=REPO_ROOT, stdout=log, stderr=subprocess.STDOUT,
+                )
+            if p.returncode != 0:
+                print(f'{stage} failed, see {log_path}')
+                break
+            with open(os.path.join(workdir, f'{stage}.result.json'), 'r') as f:
+                results.append(summarize(json.load(f)))
+    finally:
+        if mock is not None:
+            mock.stop()
+            print(f'Mock Cyanite requests: {mock.counts}')
+
+    print_report(results)
+    report = {'config': cfg, 'results': results}
+    report_path = args.report or os.path.join(workdir, 'report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report saved to {report_path}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark download, split, tag and parse against local stand-ins.')
+    parser.add_argument('--stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help='Working directory, a new temporary one by default')
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma-separated stages to run, in order')
+    parser.add_argument('--report', help='Where to save the JSON report, <workdir>/report.json by default')
+    # Fixtures and corpus
+    parser.add_argument('--dataset', choices=['hindustani', 'andalusian'], default='hindustani')
+    parser.add_argument('--recordings', type=int, default=8, help='Recordings to download')
+    parser.add_argument('--fixtures', type=int, help='Distinct synthetic recordings to cycle through, one per recording by default')
+    parser.add_argument('--fixture_dir', help='Where to keep the synthetic recordings, reused across runs')
+    parser.add_argument('--seconds', type=float, default=90, help='Length of each synthetic recording')
+    parser.add_argument('--dunya_latency', type=float, default=0.0, help='Seconds added to every fake Dunya call')
+    # Stage settings
+    parser.add_argument('--download_workers', type=int, default=4)
+    parser.add_argument('--split_workers', type=int, default=1)
+    parser.add_argument('--split_mode', choices=['decode', 'streaming', 'lossless'], default='decode')
+    parser.add_argument('--segment_minutes', type=float, default=0.5)
+    parser.add_argument('--large_segment_minutes', type=float, default=1)
+    parser.add_argument('--concurrency', type=int, default=8, help='Async tagging concurrency, 0 for the sync pipeline')
+    parser.add_argument('--upload_workers', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--rate', type=float, help='Client-side API rate limit, cyaniteAPI.API_RATE by default')
+    parser.add_argument('--poll_delay', type=float, default=0.5, help='Initial analysis poll delay in seconds')
+    parser.add_argument('--parse_workers', type=int, default=0, help='Process pool size for parsing, 0 for serial')
+    # Mock Cyanite
+    parser.add_argument('--api_latency', type=float, default=0.02, help='Seconds added to every GraphQL request')
+    parser.add_argument('--upload_latency', type=float, default=0.05, help='Seconds added to every upload PUT')
+    parser.add_argument('--analysis_time', type=float, default=1.0, help='Seconds until an analysis finishes')
+    args = parser.parse_args()
+    if args.stage:
+        run_stage(args.stage, args.workdir)
+    else:
+        main(args)
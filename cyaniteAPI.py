@@ -1,20 +1,39 @@
 from datetime import datetime
-from time import sleep
+from time import sleep, monotonic
 from tokenize import String
 from venv import create
 
+import asyncio
 import hashlib
+import hmac
 import pandas as pd
+import aiohttp
 import requests
 import os
 import argparse
 import json
+import queue
+import random
+import socket
+import statistics
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
 from flask import Flask, request, json, redirect, url_for
 from hashlib import sha512
+from requests.adapters import HTTPAdapter
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.exceptions import TransportClosed, TransportProtocolError, TransportQueryError, TransportServerError
+from graphql import print_schema
+from job_journal import JobJournal
+from metrics import metrics, add_arguments as addMetricsArguments, configure_from_args as configureMetrics
+from rate_limit import FATAL, THROTTLE, TRANSIENT, RetryStats, TokenBucket, retry, retry_async
+from track_index import TrackIndex
+from work_queue import WorkQueue
+from werkzeug.serving import make_server
 
 #env vars
 load_dotenv()
@@ -22,29 +41,575 @@ access_token = os.getenv("access_token")
 secret = os.getenv("secret")    
 request_url = "https://api.cyanite.ai/graphql"
 
+#analysis polling, in seconds
+POLL_INITIAL_DELAY = 5
+POLL_MAX_DELAY = 60
+POLL_DEADLINE = 30 * 60
+TRACK_INDEX_PATH = 'trackIndex.db'
+# One line per sha256 lookup
+RETRIEVE_IDS_LOG = 'retriveIDs.jsonl'
+JOURNAL_PATH = 'jobJournal.jsonl'
+# Delete to pick up a changed Cyanite schema
+SCHEMA_CACHE_PATH = os.path.join('schemaCache', 'cyanite.graphql')
+
+#client-side rate limit for Cyanite API calls, in requests/s
+API_RATE = 10
+API_BURST = 10
+apiLimiter = TokenBucket(API_RATE, API_BURST)
+apiStats = RetryStats()
+#GraphQL error codes (extensions.code, or the code of a LibraryTrackCreateError) of a
+#rate limited call, matched case-insensitively and ignoring underscores
+THROTTLE_CODES = ('RATELIMITED', 'RATELIMITEXCEEDED', 'TOOMANYREQUESTS', 'THROTTLED')
+
+#feature queries: tracks per batched request
+BATCH_SIZE = 1
+
+#uploads: one pooled keep-alive session shared by a bounded set of threads
+UPLOAD_WORKERS = 8
+_uploadSession = None
+_uploadPoolSize = 0
+_uploadSessionLock = threading.Lock()
+ANALYSIS_DONE = ('AudioAnalysisV6Finished', 'AudioAnalysisV6Failed', 'LibraryTrackNotFoundError')
+
+#webhook mode: Cyanite posts analysis events here, signed with the `secret` env var
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_EVENT_STATUSES = ('finished', 'failed')
+
+#distributed mode: workers lease files from a shared queue, in seconds
+WORK_QUEUE_PATH = 'workQueue.db'
+WORK_LEASE = 300
+WORK_POLL = 2
+
+#graphql documents
+UPLOAD_REQUEST_QUERY = """
+        mutation FileUploadRequestMutation {
+            fileUploadRequest {
+                id
+                uploadUrl
+            }
+        }
+        """
+
+CREATE_TRACK_QUERY = """
+       mutation LibraryTrackCreateMutation($input: LibraryTrackCreateInput! ) {
+  libraryTrackCreate(input: $input) {
+    __typename
+    ... on LibraryTrackCreateSuccess {
+      createdLibraryTrack {
+        id
+      }
+    }
+    ... on LibraryTrackCreateError {
+      code
+      message
+    }
+  }
+}
+    """
+
+SHA256_QUERY = """
+        query LibraryTracksFilteredBySHA256Query($sha256: String!) {
+    libraryTracks(filter: { sha256: $sha256 }) {
+        pageInfo {
+        hasNextPage
+        }
+        edges {
+        cursor
+        node {
+            id
+            title
+        }
+        }
+    }
+    }
+    """
+
+FEATURES_FRAGMENT = """
+fragment LibraryTrackFeatures on LibraryTrack {
+  id
+  title
+  audioAnalysisV6 {
+    __typename
+    ... on AudioAnalysisV6Finished {
+      result {
+        valence
+        arousal
+        energyLevel
+        energyDynamics
+        emotionalProfile
+        emotionalDynamics
+        mood {
+          aggressive
+          calm
+          chilled
+          dark
+          energetic
+          epic
+          happy
+          romantic
+          sad
+          scary
+          sexy
+          ethereal
+          uplifting
+        }
+        moodTags
+        moodMaxTimes {
+          mood
+          start
+          end
+        }
+        moodAdvanced {
+          anxious
+          barren
+          cold
+          creepy
+          dark
+          disturbing
+          eerie
+          evil
+          fearful
+          mysterious
+          nervous
+          restless
+          spooky
+          strange
+          supernatural
+          suspenseful
+          tense
+          weird
+          aggressive
+          agitated
+          angry
+          dangerous
+          fiery
+          intense
+          passionate
+          ponderous
+          violent
+          comedic
+          eccentric
+          funny
+          mischievous
+          quirky
+          whimsical
+          boisterous
+          boingy
+          bright
+          celebratory
+          cheerful
+          excited
+          feelGood
+          fun
+          happy
+          joyous
+          lighthearted
+          perky
+          playful
+          rollicking
+          upbeat
+          calm
+          contented
+          dreamy
+          introspective
+          laidBack
+          leisurely
+          lyrical
+          peaceful
+          quiet
+          relaxed
+          serene
+          soothing
+          spiritual
+          tranquil
+          bittersweet
+          blue
+          depressing
+          gloomy
+          heavy
+          lonely
+          melancholic
+          mournful
+          poignant
+          sad
+          frightening
+          horror
+          menacing
+          nightmarish
+          ominous
+          panicStricken
+          scary
+          concerned
+          determined
+          dignified
+          emotional
+          noble
+          serious
+          solemn
+          thoughtful
+          cool
+          seductive
+          sexy
+          adventurous
+          confident
+          courageous
+          resolute
+          energetic
+          epic
+          exciting
+          exhilarating
+          heroic
+          majestic
+          powerful
+          prestigious
+          relentless
+          strong
+          triumphant
+          victorious
+          delicate
+          graceful
+          hopeful
+          innocent
+          intimate
+          kind
+          light
+          loving
+          nostalgic
+          reflective
+          romantic
+          sentimental
+          soft
+          sweet
+          tender
+          warm
+          anthemic
+          aweInspiring
+          euphoric
+          inspirational
+          motivational
+          optimistic
+          positive
+          proud
+          soaring
+          uplifting
+        }
+        moodAdvancedTags
+        movement {
+          bouncy
+          driving
+          flowing
+          groovy
+          nonrhythmic
+          pulsing
+          robotic
+          running
+          steady
+          stomping
+        }
+        movementTags
+        bpmPrediction {
+          value
+          confidence
+        }
+        bpmRangeAdjusted
+      }
+    }
+  }
+}
+"""
+
+FEATURES_QUERY = """
+    query LibraryTrackQuery($libraryTrackId: ID!) {
+  libraryTrack(id: $libraryTrackId) {
+    __typename
+    ... on LibraryTrackNotFoundError {
+      message
+    }
+    ...LibraryTrackFeatures
+  }
+}
+    """ + FEATURES_FRAGMENT
+
+class LibraryTrackCreateError(Exception):
+    '''libraryTrackCreate answered with LibraryTrackCreateError instead of a track.'''
+    def __init__(self, code, message):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+        self.message = message
+
 #def/dummy functions
-def startProcessProxy(dirName, path_to_csv):
-    startProcess(dirName, path_to_csv)
+def startProcessProxy(dirName, path_to_csv, concurrency=None, upload_workers=UPLOAD_WORKERS, batch_size=BATCH_SIZE, webhook_port=None):
+    # Webhooks are only received by the asyncio pipeline
+    if concurrency or webhook_port:
+        asyncio.run(startProcessAsync(dirName, path_to_csv, concurrency or 8, upload_workers, batch_size, webhook_port))
+    else:
+        startProcess(dirName, path_to_csv, batch_size)
+
+#params : None
+#fn: builds the authenticated transport for the Cyanite endpoint
+#return: AIOHTTPTransport
+def makeTransport():
+    return AIOHTTPTransport(url=request_url, headers = { "Authorization": "Bearer {}".format(access_token)})
+
+#params : None
+#fn: builds the client, using the on-disk schema when there is one so
+#    introspection only runs on the first run
+#return: Client[gql]
+def makeClient():
+    transport = makeTransport()
+    if os.path.isfile(SCHEMA_CACHE_PATH):
+        with open(SCHEMA_CACHE_PATH, 'r') as f:
+            return Client(transport=transport, schema=f.read())
+    return Client(transport=transport, fetch_schema_from_transport=True)
 
-def startProcess(dirName, path_to_csv):
+#params : Client[gql]
+#fn: writes the introspected schema to SCHEMA_CACHE_PATH once it is known
+#return: None
+def cacheSchema(client):
+    if client.schema is None or os.path.isfile(SCHEMA_CACHE_PATH):
+        return
+    os.makedirs(os.path.dirname(SCHEMA_CACHE_PATH), exist_ok=True)
+    tmp_path = SCHEMA_CACHE_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(print_schema(client.schema))
+    os.replace(tmp_path, SCHEMA_CACHE_PATH)
+
+#params : requests/s, burst
+#fn: replaces the shared API rate limiter
+#return: None
+def setRateLimit(rate, burst=API_BURST):
+    global apiLimiter
+    apiLimiter = TokenBucket(rate, burst)
+
+#params : TransportQueryError or LibraryTrackCreateError
+#fn: error codes the API sent with a GraphQL error
+#return: list of codes, without the errors that have none
+def _errorCodes(e):
+    if isinstance(e, LibraryTrackCreateError):
+        return [e.code] if e.code is not None else []
+    codes = []
+    for error in e.errors or []:
+        extensions = error.get('extensions') if isinstance(error, dict) else None
+        if isinstance(extensions, dict) and extensions.get('code') is not None:
+            codes.append(extensions['code'])
+    return codes
+
+#params : exception
+#fn: sorts a failed call into throttle / transient / fatal for the retry scheduler
+#return: (kind, retry-after seconds or None)
+def classifyError(e):
+    if isinstance(e, TransportServerError):
+        status = e.code
+    elif isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+        retry_after = e.response.headers.get('Retry-After')
+        if status == 429 and retry_after is not None and retry_after.isdigit():
+            return THROTTLE, float(retry_after)
+    elif isinstance(e, (TransportQueryError, LibraryTrackCreateError)):
+        # Cyanite reports some limits as GraphQL errors rather than HTTP 429
+        codes = [str(code).replace('_', '').upper() for code in _errorCodes(e)]
+        if any(code in THROTTLE_CODES for code in codes):
+            return THROTTLE, None
+        return FATAL, None
+    elif isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, TransportClosed, TransportProtocolError,
+                        requests.ConnectionError, requests.Timeout)):
+        return TRANSIENT, None
+    else:
+        return FATAL, None
+
+    if status == 429:
+        return THROTTLE, None
+    if status is not None and status >= 500:
+        return TRANSIENT, None
+    return FATAL, None
+
+#params : Client[gql], document, variables, idempotent[bool], check -> callable raising on a bad payload
+#fn: rate limited, retried client.execute. a call that is not idempotent is
+#    only retried on throttling, since a transient error may hide a success
+#return: result payload
+def _execute(client, query, params=None, idempotent=True, check=None):
+    def call():
+        result = client.execute(query, variable_values = params)
+        if check is not None:
+            check(result)
+        return result
+    retry_on = (THROTTLE, TRANSIENT) if idempotent else (THROTTLE,)
+    return retry(call, classifyError, apiLimiter, apiStats, retry_on)
+
+#params : AsyncClientSession[gql], document, variables, idempotent[bool], check
+#fn: async variant of _execute
+#return: result payload
+async def _executeAsync(session, query, params=None, idempotent=True, check=None):
+    async def call():
+        result = await session.execute(query, variable_values = params)
+        if check is not None:
+            check(result)
+        return result
+    retry_on = (THROTTLE, TRANSIENT) if idempotent else (THROTTLE,)
+    return await retry_async(call, classifyError, apiLimiter, apiStats, retry_on)
+
+#params : None
+#fn: prints the API call counters for a run
+#return: None
+def reportRetries():
+    counts = apiStats.snapshot()
+    for name, n in counts.items():
+        metrics.count(f'api_{name}', n)
+    metrics.flush()
+    print(f"API calls: {counts['calls']}, throttled: {counts['throttles']}, "
+          f"retried: {counts['retries']}, failed: {counts['failures']}")
+
+#params : graphql source string
+#fn: parses a document once per process
+#return: DocumentNode
+@lru_cache(maxsize=None)
+def document(source):
+    return gql(source)
+
+#params : number of tracks
+#fn: builds (once per size) a query fetching that many library tracks,
+#    aliased t0..tN-1, with the same selection as FEATURES_QUERY
+#return: DocumentNode
+@lru_cache(maxsize=None)
+def batchFeaturesDocument(size):
+    variables = ', '.join(f'$id{i}: ID!' for i in range(size))
+    fields = '\n'.join(
+        f'  t{i}: libraryTrack(id: $id{i}) {{ __typename ... on LibraryTrackNotFoundError {{ message }} ...LibraryTrackFeatures }}'
+        for i in range(size)
+    )
+    return gql(f'query LibraryTrackBatchQuery({variables}) {{\n{fields}\n}}\n' + FEATURES_FRAGMENT)
+
+def startProcess(dirName, path_to_csv, batch_size=BATCH_SIZE):
  
     #init client 
-    transport = AIOHTTPTransport(url=request_url, headers = { "Authorization": "Bearer {}".format(access_token)})
-    client = Client(transport=transport, fetch_schema_from_transport=True)
+    client = makeClient()
 
     
     #get data
     files = file_from_csv(path_to_csv)
-    hashedFiles = hashFiles(files)
+    hashedFiles = hashFiles(dirName, files)
+    index = TrackIndex(TRACK_INDEX_PATH)
+    journal = JobJournal(JOURNAL_PATH)
 
     #loop for file
-    for file in files:
-      fullFile = os.path.join(dirName, file)
-      fileName = file.split(".")[0]
-      _id, uploadUrl = uploadRequest(client)
-      uploadFiles(fullFile, _id, uploadUrl)
-      trackID = createTrack(client, _id, fileName)
-      getFeatures(client, trackID, fileName)
+    latencies = []
+    if batch_size > 1:
+      # Create every track first, then poll them together
+      pending = []
+      for file, sha256 in zip(files, hashedFiles):
+        trackID = prepareFile(client, index, journal, dirName, file, sha256)
+        cacheSchema(client)
+        if trackID is not None:
+          pending.append((file, sha256, trackID))
+      tracks = [(trackID, file.split(".")[0]) for file, sha256, trackID in pending]
+      fetched = getFeaturesBatch(client, tracks, batch_size)
+      for (file, sha256, trackID), (result, record) in zip(pending, fetched):
+        _featuresFetched(index, journal, file, sha256, trackID, result, record)
+        latencies.append(record)
+    else:
+      for file, sha256 in zip(files, hashedFiles):
+        record = processFile(client, index, journal, dirName, file, sha256)
+        cacheSchema(client)
+        if record is not None:
+          latencies.append(record)
+    journal.close()
+    index.close()
+    reportLatencies(latencies)
+    reportRetries()
+
+
+#params : Client[gql], TrackIndex, JobJournal, MP3 DIR, file, sha256 of the file
+#fn: runs upload -> create -> fetch for one file, resuming from the journal
+#    and skipping every stage the index or the Cyanite library already has
+#    an answer for
+#return: latency record, or None if nothing had to be fetched
+def processFile(client, index, journal, dirName, file, sha256):
+    trackID = prepareFile(client, index, journal, dirName, file, sha256)
+    if trackID is None:
+      return None
+
+    result, record = getFeatures(client, trackID, file.split(".")[0])
+    _featuresFetched(index, journal, file, sha256, trackID, result, record)
+    return record
+
+
+#params : Client[gql], TrackIndex, JobJournal, MP3 DIR, file, sha256 of the file
+#fn: the upload -> create half of processFile
+#return: trackID to fetch features for, or None if the file is already done
+def prepareFile(client, index, journal, dirName, file, sha256):
+    fullFile = os.path.join(dirName, file)
+    fileName = file.split(".")[0]
+    state = journal.state(file, sha256)
+    trackID = _resumeFromCache(index, journal, state, file, sha256)
+    if trackID is False:
+      return None
+
+    if trackID is None:
+      trackID = retriveIDs(sha256, client)
+    if trackID is None:
+      _id = state.get('uploadId') if state.get('stage') == 'uploaded' else None
+      if _id is not None:
+        try:
+          trackID = createTrack(client, _id, fileName)
+        except LibraryTrackCreateError as e:
+          _rejectedUpload(fileName, _id, e)
+          _id = None
+      if _id is None:
+        _id, uploadUrl = uploadRequest(client)
+        journal.record(file, sha256, 'upload-requested', uploadId=_id)
+        uploadFiles(fullFile, _id, uploadUrl)
+        journal.record(file, sha256, 'uploaded', uploadId=_id)
+        trackID = createTrack(client, _id, fileName)
+    _trackCreated(index, journal, state, file, sha256, trackID)
+    return trackID
+
+
+#params : fileName, journalled upload id, LibraryTrackCreateError
+#fn: a journalled upload can expire or be lost before its track is created, so a rejected
+#    one is dropped and the file uploaded again instead of failing on every run
+#return: None
+def _rejectedUpload(fileName, _id, e):
+    print(f"{fileName}: journalled upload {_id} was rejected ({e}), uploading again")
+    metrics.count('uploads_rejected')
+
+
+#params : TrackIndex, JobJournal, journal state, file, sha256
+#fn: settles a file from local state alone where possible. finished files
+#    are skipped, cached features are written out without touching the API
+#return: False if the file is done, else the known trackID or None
+def _resumeFromCache(index, journal, state, file, sha256):
+    fileName = file.split(".")[0]
+    if state.get('stage') == 'features-fetched' and os.path.isfile(os.path.join('classifierResults', f'{fileName}.json')):
+      print(f"{fileName}: already fetched, skipping")
+      return False
+    cached = index.get(sha256)
+    if cached is not None and cached[1] is not None:
+      print(f"{fileName}: features cached, skipping")
+      _saveFeatures(cached[1], fileName)
+      journal.record(file, sha256, 'features-fetched', trackID=cached[0])
+      return False
+    if state.get('trackID') is not None:
+      return state['trackID']
+    return cached[0] if cached is not None else None
+
+
+#params : TrackIndex, JobJournal, journal state, file, sha256, trackID
+#fn: records a created (or rediscovered) track in the index and journal
+#return: None
+def _trackCreated(index, journal, state, file, sha256, trackID):
+    index.set_track(sha256, trackID)
+    if state.get('trackID') != trackID:
+      journal.record(file, sha256, 'track-created', trackID=trackID)
+
+
+#params : TrackIndex, JobJournal, file, sha256, trackID, feature payload, latency record
+#fn: caches and journals a finished analysis
+#return: None
+def _featuresFetched(index, journal, file, sha256, trackID, result, record):
+    if record['status'] == 'AudioAnalysisV6Finished':
+      index.set_features(sha256, result)
+      journal.record(file, sha256, 'features-fetched', trackID=trackID)
       
       
 
@@ -59,18 +624,14 @@ def run():
 def uploadRequest(client):
     
     print("Sending Upload Request........")
-    query = gql(
-        """
-        mutation FileUploadRequestMutation {
-            fileUploadRequest {
-                id
-                uploadUrl
-            }
-        }
-        """
-    )
-    
-    result = client.execute(query)
+    with metrics.stage('upload-request'):
+        result = _execute(client, document(UPLOAD_REQUEST_QUERY))
+    return _handleUploadRequest(result)
+
+#params : result[dict] -> fileUploadRequest payload
+#fn: parses and logs an upload request response
+#return: (id, uploadUrl)
+def _handleUploadRequest(result):
     
     # Parse id and upload URL for uploading data of music
     _id = result['fileUploadRequest']['id']
@@ -105,18 +666,58 @@ def file2List(dir_path):
     return files 
 
 
-#params : MP3 DIR
+#params : MP3 DIR, list of files in it
 #fn: converts dir to hashedlist
 #return: list
-def hashFiles(files):
-    hashedList=[hashlib.sha256(i.encode()).hexdigest().upper() for i in files]
+def hashFiles(dirName, files):
+    hashedList=[sha256File(os.path.join(dirName, i)) for i in files]
     return hashedList
 
 
-#params : MP3 DIR
-#fn: uploads file to API endpoint
-#return: None
-def uploadFiles(file, _id, uploadUrl):
+#params : path to file, chunk size in bytes
+#fn: streams the file through sha256 without reading it whole
+#return: lowercase hex digest, as Cyanite reports it
+def sha256File(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with metrics.stage('hash', os.path.basename(path)) as record, open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+        record['bytes'] = f.tell()
+    return digest.hexdigest()
+
+
+#params : file name, encoded file bytes
+#fn: sha256File for a file that is only held in memory
+#return: lowercase hex digest
+def sha256Bytes(fileName, data):
+    with metrics.stage('hash', fileName, bytes=len(data)):
+        return hashlib.sha256(data).hexdigest()
+
+
+#params : workers[int] -> upload threads that will share the session, UPLOAD_WORKERS by default
+#fn: lazily builds the shared upload session. its pool holds one keep-alive connection per
+#    upload worker, so TLS is set up once per worker. asking for more workers than the pool
+#    holds remounts a larger pool, otherwise connections beyond it would be discarded
+#return: requests.Session
+def uploadSession(workers=None):
+    global _uploadSession, _uploadPoolSize
+    with _uploadSessionLock:
+        if _uploadSession is None:
+            _uploadSession = requests.Session()
+        size = max(workers or UPLOAD_WORKERS, _uploadPoolSize)
+        if size != _uploadPoolSize:
+            adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+            _uploadSession.mount('https://', adapter)
+            _uploadSession.mount('http://', adapter)
+            _uploadPoolSize = size
+    return _uploadSession
+
+
+#params : path to file, upload id, presigned upload url, data[bytes] -> file contents if it is
+#         only held in memory, in which case file just names it
+#fn: uploads file to API endpoint, streaming it from the file handle or sending the buffer
+#return: dict -> upload throughput record
+def uploadFiles(file, _id, uploadUrl, data=None):
     
     print("Uploading files......")
 
@@ -131,15 +732,49 @@ def uploadFiles(file, _id, uploadUrl):
         'X-Amz-SignedHeaders': 'host',
     }
 
-    #add sha256 check -> upload only nonexistant
+    # Passing the handle lets requests stream it with a Content-Length
+    # instead of holding the whole recording in memory
+    if data is None:
+        size = os.path.getsize(file)
+        put = lambda: _putFile(file, uploadUrl, params)
+    else:
+        size = len(data)
+        put = lambda: _putBuffer(data, uploadUrl, params)
+    start = monotonic()
+    with metrics.stage('upload', os.path.basename(file), bytes=size):
+        response = retry(put, classifyError, stats=apiStats)
+    elapsed = monotonic() - start
+
+    record = {
+        'uploadId': _id,
+        'file': os.path.basename(file),
+        'status': response.status_code,
+        'bytes': size,
+        'seconds': round(elapsed, 3),
+        'bytesPerSec': round(size / elapsed) if elapsed > 0 else None
+    }
+    print(f"Uploaded {record['file']}: {response.status_code}, {size / 1e6:.1f} MB at {size / 1e6 / max(elapsed, 1e-9):.2f} MB/s")
+    _appendLog('uploadStats.jsonl', record)
+    return record
+
+
+#params : path to file, presigned upload url, query params
+#fn: one streamed PUT attempt. each retry reopens the file from the start
+#return: response
+def _putFile(file, uploadUrl, params):
     with open(file, 'rb') as f:
-        data = f.read()
+        response = uploadSession().put(uploadUrl, params=params, data=f)
+    response.raise_for_status()
+    return response
 
-    response = requests.put(uploadUrl, params=params, data=data)
- 
-    print(response.json)
-    print(response.status_code)
-    return 
+
+#params : encoded file bytes, presigned upload url, query params
+#fn: one PUT attempt of an in-memory file
+#return: response
+def _putBuffer(data, uploadUrl, params):
+    response = uploadSession().put(uploadUrl, params=params, data=data)
+    response.raise_for_status()
+    return response
 
 
 #params : Client[gql]
@@ -149,29 +784,25 @@ def createTrack(client, _id, fileName):
     print("Creating Track......")
 
     # Run query
-    query = gql(
-    """
-       mutation LibraryTrackCreateMutation($input: LibraryTrackCreateInput! ) {
-  libraryTrackCreate(input: $input) {
-    __typename
-    ... on LibraryTrackCreateSuccess {
-      createdLibraryTrack {
-        id
-      }
-    }
-    ... on LibraryTrackCreateError {
-      code
-      message
-    }
-  }
-}
-
-    
-    """
-    )
-    
     params = { "input": { "uploadId": _id, "title": fileName } }
-    result = client.execute(query, variable_values = params)
+    with metrics.stage('create-track', fileName):
+        result = _execute(client, document(CREATE_TRACK_QUERY), params, idempotent=False, check=_checkCreateTrack)
+    return _handleCreateTrack(result)
+
+
+#params : result[dict] -> libraryTrackCreate payload
+#fn: raises LibraryTrackCreateError if the track was not created
+#return: None
+def _checkCreateTrack(result):
+    payload = result["libraryTrackCreate"]
+    if payload["__typename"] == "LibraryTrackCreateError":
+        raise LibraryTrackCreateError(payload.get("code"), payload.get("message"))
+
+
+#params : result[dict] -> libraryTrackCreate payload
+#fn: parses and logs a track creation response
+#return: trackID
+def _handleCreateTrack(result):
     trackID = result["libraryTrackCreate"]["createdLibraryTrack"]["id"]
     
     #per file json dump 
@@ -191,276 +822,702 @@ def createTrack(client, _id, fileName):
     return trackID
     
 
-#params : Clinet[gql], hashedFiles
+#params : sha256 of a file, Clinet[gql]
 #fn: retrives ID to check track existance
-#return: None  [shld return something]
-def retriveIDs(hashedFiles, client):
+#return: library track id, or None if no track has this hash
+def retriveIDs(sha256, client):
 
     print("Retriving IDs............")
-    query = gql(
-        """
-        query LibraryTracksFilteredBySHA256Query($sha256: String!) {
-    libraryTracks(filter: { sha256: $sha256 }) {
-        pageInfo {
-        hasNextPage
-        }
-        edges {
-        cursor
-        node {
-            id
-            title
-        }
-        }
-    }
-    }
-    """   
-    )
-    
-    #change hardcoded vars
-    params = {"sha256": "e5118512f23f922c54ef92d995f8fe7da7046819390f0d02ba596fd0a3db67e2"}
-    result = client.execute(query, variable_values = params)
-    timestamp = str(datetime.now())
+    params = {"sha256": sha256}
+    with metrics.stage('lookup', sha256=sha256):
+        result = _execute(client, document(SHA256_QUERY), params)
+    return _handleRetriveIDs(sha256, result)
 
-    a_dict = {timestamp: result}
-    
-    with open('retriveIDs.json') as f:
-        data = json.load(f)
-    data.update(a_dict)
 
-    with open('retriveIDs.json', 'w') as f:
-        json.dump(data, f)
+#params : sha256 of a file, result[dict] -> libraryTracks payload
+#fn: appends the sha256 lookup to retriveIDs.jsonl and picks the matching track. lookups run
+#    once per file, so the log is only ever appended to rather than read back and rewritten.
+#    the log is best effort, a failed write never fails the lookup
+#return: library track id or None
+def _handleRetriveIDs(sha256, result):
+    try:
+        _appendLog(RETRIEVE_IDS_LOG, {'timestamp': str(datetime.now()), 'sha256': sha256, 'result': result})
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Could not log the lookup of {sha256}: {e!r}")
+
+    edges = result['libraryTracks']['edges']
+    return edges[0]['node']['id'] if edges else None
     
 
-#PARAMS: [IMPLEMENT] ID(s), Client(gql)
-#FN : FN TO QUERY FOR CREATED TRACK FEATURES
-#RETURN: JSON PAYLOAD
-def getFeatures(client, trackID, fileName):
-  sleep(45)
-  query = gql(
-    """
-    query LibraryTrackQuery($libraryTrackId: ID!) {
-  libraryTrack(id: $libraryTrackId) {
-    __typename
-    ... on LibraryTrackNotFoundError {
-      message
-    }
-    ... on LibraryTrack {
-      id
-      title
-      audioAnalysisV6 {
-        __typename
-        ... on AudioAnalysisV6Finished {
-          result {
-            valence
-            arousal
-            energyLevel
-            energyDynamics
-            emotionalProfile
-            emotionalDynamics
-            mood {
-              aggressive
-              calm
-              chilled
-              dark
-              energetic
-              epic
-              happy
-              romantic
-              sad
-              scary
-              sexy
-              ethereal
-              uplifting
-            }
-            moodTags
-            moodMaxTimes {
-              mood
-              start
-              end
-            }
-            moodAdvanced {
-              anxious
-              barren
-              cold
-              creepy
-              dark
-              disturbing
-              eerie
-              evil
-              fearful
-              mysterious
-              nervous
-              restless
-              spooky
-              strange
-              supernatural
-              suspenseful
-              tense
-              weird
-              aggressive
-              agitated
-              angry
-              dangerous
-              fiery
-              intense
-              passionate
-              ponderous
-              violent
-              comedic
-              eccentric
-              funny
-              mischievous
-              quirky
-              whimsical
-              boisterous
-              boingy
-              bright
-              celebratory
-              cheerful
-              excited
-              feelGood
-              fun
-              happy
-              joyous
-              lighthearted
-              perky
-              playful
-              rollicking
-              upbeat
-              calm
-              contented
-              dreamy
-              introspective
-              laidBack
-              leisurely
-              lyrical
-              peaceful
-              quiet
-              relaxed
-              serene
-              soothing
-              spiritual
-              tranquil
-              bittersweet
-              blue
-              depressing
-              gloomy
-              heavy
-              lonely
-              melancholic
-              mournful
-              poignant
-              sad
-              frightening
-              horror
-              menacing
-              nightmarish
-              ominous
-              panicStricken
-              scary
-              concerned
-              determined
-              dignified
-              emotional
-              noble
-              serious
-              solemn
-              thoughtful
-              cool
-              seductive
-              sexy
-              adventurous
-              confident
-              courageous
-              resolute
-              energetic
-              epic
-              exciting
-              exhilarating
-              heroic
-              majestic
-              powerful
-              prestigious
-              relentless
-              strong
-              triumphant
-              victorious
-              delicate
-              graceful
-              hopeful
-              innocent
-              intimate
-              kind
-              light
-              loving
-              nostalgic
-              reflective
-              romantic
-              sentimental
-              soft
-              sweet
-              tender
-              warm
-              anthemic
-              aweInspiring
-              euphoric
-              inspirational
-              motivational
-              optimistic
-              positive
-              proud
-              soaring
-              uplifting
-            }
-            moodAdvancedTags
-            movement {
-              bouncy
-              driving
-              flowing
-              groovy
-              nonrhythmic
-              pulsing
-              robotic
-              running
-              steady
-              stomping
-            }
-            movementTags
-            bpmPrediction {
-              value
-              confidence
-            }
-            bpmRangeAdjusted
-          }
-        }
-      }
-    }
-  }
-}
-    """
-        
-    )
+#PARAMS: Client(gql), ID, fileName, deadline (s)
+#FN : POLL CREATED TRACK WITH BACKOFF UNTIL ANALYSIS IS DONE, SAVE FEATURES
+#RETURN: FEATURE PAYLOAD, LATENCY RECORD
+def getFeatures(client, trackID, fileName, deadline=POLL_DEADLINE):
   params = {"libraryTrackId": trackID}
-  result = client.execute(query, variable_values = params)
-  
+  start = monotonic()
+  delays = backoffDelays()
+  polls = 0
+  while True:
+    sleep(next(delays))
+    result = _execute(client, document(FEATURES_QUERY), params)
+    polls += 1
+    status = analysisStatus(result)
+    if status in ANALYSIS_DONE or monotonic() - start >= deadline:
+      break
+  _saveFeatures(result, fileName)
+  return result, _logLatency(trackID, fileName, status, monotonic() - start, polls)
+
+
+#PARAMS: Client(gql), list of (ID, fileName), tracks per request, deadline (s)
+#FN : POLL MANY TRACKS, batch_size PER REQUEST, UNTIL EACH ANALYSIS IS DONE
+#RETURN: LIST OF (FEATURE PAYLOAD, LATENCY RECORD) IN THE ORDER OF tracks
+def getFeaturesBatch(client, tracks, batch_size=BATCH_SIZE, deadline=POLL_DEADLINE):
+  start = monotonic()
+  delays = backoffDelays()
+  fetched = [None] * len(tracks)
+  pending = list(range(len(tracks)))
+  polls = 0
+  while pending:
+    sleep(next(delays))
+    polls += 1
+    waiting = []
+    for b in range(0, len(pending), batch_size):
+      chunk = pending[b:b + batch_size]
+      results = _executeBatch(client, [tracks[i][0] for i in chunk])
+      for i, result in zip(chunk, results):
+        status = analysisStatus(result)
+        if status in ANALYSIS_DONE or monotonic() - start >= deadline:
+          trackID, fileName = tracks[i]
+          _saveFeatures(result, fileName)
+          fetched[i] = (result, _logLatency(trackID, fileName, status, monotonic() - start, polls))
+        else:
+          waiting.append(i)
+    pending = waiting
+  return fetched
+
+
+#params : Client(gql), list of IDs
+#fn: fetches several library tracks in one request
+#return: list of payloads shaped like a single FEATURES_QUERY result
+def _executeBatch(client, trackIDs):
+  params = {f'id{i}': trackID for i, trackID in enumerate(trackIDs)}
+  result = _execute(client, batchFeaturesDocument(len(trackIDs)), params)
+  return [{'libraryTrack': result[f't{i}']} for i in range(len(trackIDs))]
+
+
+#params : initial[s], maximum[s], factor. defaults are read at call time,
+#         so POLL_INITIAL_DELAY / POLL_MAX_DELAY can be tuned after import
+#fn: exponential backoff with equal jitter, so tracks created together
+#    do not all poll in the same instant
+#return: generator of delays in seconds
+def backoffDelays(initial=None, maximum=None, factor=2):
+  initial = POLL_INITIAL_DELAY if initial is None else initial
+  maximum = POLL_MAX_DELAY if maximum is None else maximum
+  delay = initial
+  while True:
+    yield delay / 2 + random.uniform(0, delay / 2)
+    delay = min(delay * factor, maximum)
+
+
+#params : result[dict] -> libraryTrack payload
+#fn: reads the analysis state out of a feature query result
+#return: __typename of audioAnalysisV6, or of libraryTrack if it was not found
+def analysisStatus(result):
+  track = result['libraryTrack']
+  if 'audioAnalysisV6' not in track:
+    return track['__typename']
+  return track['audioAnalysisV6']['__typename']
+
+
+#params : trackID, fileName, status, latency[s], polls
+#fn: appends one line per track to analysisLatency.jsonl for backoff tuning
+#return: dict -> the logged record
+def _logLatency(trackID, fileName, status, latency, polls):
+  record = {
+    'trackID': trackID,
+    'fileName': fileName,
+    'status': status,
+    'latency': round(latency, 3),
+    'polls': polls
+  }
+  # Time from the first poll being scheduled to the analysis being done
+  wait = {'stage': 'analysis-wait', 'file': fileName, 'seconds': round(latency, 6), 'polls': polls}
+  if status != 'AudioAnalysisV6Finished':
+    print(f"{fileName}: analysis ended as {status} after {latency:.0f}s")
+    wait['error'] = status
+  metrics.observe(wait)
+  _appendLog('analysisLatency.jsonl', record)
+  return record
+
+
+#params : path to .jsonl file, record[dict]
+#fn: appends one json line with a single write on an O_APPEND descriptor, so the lines of
+#    workers sharing a directory never interleave
+#return: None
+def _appendLog(path, record):
+  fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    os.write(fd, (json.dumps(record) + '\n').encode())
+  finally:
+    os.close(fd)
+
+
+#params : list of latency records
+#fn: prints a latency summary for a run
+#return: None
+def reportLatencies(records):
+  latencies = [r['latency'] for r in records if r['status'] == 'AudioAnalysisV6Finished']
+  if len(latencies) < 2:
+    return
+  cuts = statistics.quantiles(latencies, n=100)
+  print(f"Analysis latency over {len(latencies)} tracks: "
+        f"p50={cuts[49]:.1f}s p90={cuts[89]:.1f}s max={max(latencies):.1f}s, "
+        f"{sum(r['polls'] for r in records)} polls")
+
+
+#params : result[dict] -> libraryTrack payload, fileName[str]
+#fn: writes the feature payload to classifierResults/<fileName>.json
+#return: None
+def _saveFeatures(result, fileName):
   # Check if directory for jsons does not exist. If it doesn't create it:
   if not os.path.isdir('classifierResults'):
     os.mkdir('classifierResults')
   
   
   
-  # Save json as fileName.json
-  with open(os.path.join('classifierResults', f'{fileName}.json'), 'w') as j:
+  # Save json as fileName.json. Written aside and renamed into place, so an incremental
+  # parse_and_save_features run never reads a half-written result
+  path = os.path.join('classifierResults', f'{fileName}.json')
+  with open(path + '.tmp', 'w') as j:
     json.dump(result, j)
-    
+  os.replace(path + '.tmp', path)
+
+
+#params : AsyncClientSession[gql]
+#fn: async variant of uploadRequest
+#return: (id, uploadUrl)
+async def uploadRequestAsync(session):
+    print("Sending Upload Request........")
+    with metrics.stage('upload-request'):
+        result = await _executeAsync(session, document(UPLOAD_REQUEST_QUERY))
+    return _handleUploadRequest(result)
+
+
+#params : AsyncClientSession[gql], upload id, fileName
+#fn: async variant of createTrack
+#return: trackID
+async def createTrackAsync(session, _id, fileName):
+    print("Creating Track......")
+    params = { "input": { "uploadId": _id, "title": fileName } }
+    with metrics.stage('create-track', fileName):
+        result = await _executeAsync(session, document(CREATE_TRACK_QUERY), params, idempotent=False, check=_checkCreateTrack)
+    return _handleCreateTrack(result)
+
+
+#params : AsyncClientSession[gql], sha256 of a file
+#fn: async variant of retriveIDs
+#return: library track id or None
+async def retriveIDsAsync(session, sha256):
+    print("Retriving IDs............")
+    params = {"sha256": sha256}
+    with metrics.stage('lookup', sha256=sha256):
+        result = await _executeAsync(session, document(SHA256_QUERY), params)
+    return _handleRetriveIDs(sha256, result)
+
+
+#params : AsyncClientSession[gql], trackID, fileName
+#fn: async variant of getFeatures. the wait does not block other files.
+#return: feature payload, latency record
+async def getFeaturesAsync(session, trackID, fileName, deadline=POLL_DEADLINE):
+  params = {"libraryTrackId": trackID}
+  start = monotonic()
+  delays = backoffDelays()
+  polls = 0
+  while True:
+    await asyncio.sleep(next(delays))
+    result = await _executeAsync(session, document(FEATURES_QUERY), params)
+    polls += 1
+    status = analysisStatus(result)
+    if status in ANALYSIS_DONE or monotonic() - start >= deadline:
+      break
+  _saveFeatures(result, fileName)
+  return result, _logLatency(trackID, fileName, status, monotonic() - start, polls)
+
+
+class FeatureBatcher:
+    '''
+    Pools the tracks that async pipeline files are waiting on and polls them
+    together, batch_size tracks per request, resolving each file's fetch as soon
+    as its own analysis is done.
+
+    params:
+        - session (AsyncClientSession): open gql session.
+        - batch_size (int): tracks per request.
+        - deadline (float): seconds a track is polled before giving up.
+    '''
+    def __init__(self, session, batch_size, deadline=POLL_DEADLINE):
+        self.session = session
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self._pending = []
+        self._task = None
+
+    async def fetch(self, trackID, fileName, created=True):
+        '''Wait for one track. Returns (feature payload, latency record) like getFeaturesAsync. Polling finds finished tracks whether or not they were just created.'''
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append({'trackID': trackID, 'fileName': fileName, 'start': monotonic(), 'polls': 0, 'future': future})
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        # Tracks that join mid-run are picked up at the next tick
+        delays = backoffDelays()
+        while self._pending:
+            await asyncio.sleep(next(delays))
+            waiting, self._pending = self._pending, []
+            for b in range(0, len(waiting), self.batch_size):
+                chunk = waiting[b:b + self.batch_size]
+                try:
+                    results = await _executeBatchAsync(self.session, [entry['trackID'] for entry in chunk])
+                except Exception as e:
+                    for entry in chunk:
+                        entry['future'].set_exception(e)
+                    continue
+                for entry, result in zip(chunk, results):
+                    entry['polls'] += 1
+                    status = analysisStatus(result)
+                    latency = monotonic() - entry['start']
+                    if status in ANALYSIS_DONE or latency >= self.deadline:
+                        _saveFeatures(result, entry['fileName'])
+                        record = _logLatency(entry['trackID'], entry['fileName'], status, latency, entry['polls'])
+                        entry['future'].set_result((result, record))
+                    else:
+                        self._pending.append(entry)
+
+
+#params : AsyncClientSession[gql], list of IDs
+#fn: async variant of _executeBatch
+#return: list of payloads shaped like a single FEATURES_QUERY result
+async def _executeBatchAsync(session, trackIDs):
+    params = {f'id{i}': trackID for i, trackID in enumerate(trackIDs)}
+    result = await _executeAsync(session, batchFeaturesDocument(len(trackIDs)), params)
+    return [{'libraryTrack': result[f't{i}']} for i in range(len(trackIDs))]
+
+
+#params : secret[str], raw request body[bytes], Signature header[str]
+#fn: checks a webhook body against its hex HMAC-SHA512 signature, in constant time
+#return: bool
+def verifySignature(secret, body, signature):
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, sha512).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+#params : payload[dict] -> webhook body
+#fn: reads the library track id out of an analysis-finished or -failed event
+#return: trackID, or None for any other event (e.g. the TEST ping)
+def webhookTrackID(payload):
+    resource = payload.get('resource') or {}
+    event = payload.get('event') or {}
+    if resource.get('type') != 'LibraryTrack' or event.get('type') != 'AudioAnalysisV6':
+        return None
+    if event.get('status') not in WEBHOOK_EVENT_STATUSES:
+        return None
+    return resource.get('id')
+
+
+class WebhookReceiver:
+    '''
+    Push alternative to FeatureBatcher. An embedded Flask server accepts Cyanite's
+    analysis events, checks their signature against the `secret` env var and fetches
+    the features of just that track, so waiting tracks cost no requests at all.
+    The webhook URL of the Cyanite integration has to point at host:port + path.
+
+    A track that was not created by this run may have finished before the receiver
+    started, so it is checked once up front. Any track that gets no event within the
+    deadline is fetched once more and settled with whatever state it is in.
+
+    params:
+        - session (AsyncClientSession): open gql session.
+        - port (int): port to listen on.
+        - signing_secret (str): webhook secret. Defaults to the `secret` env var.
+        - host (str): interface to listen on.
+        - path (str): URL path Cyanite posts to.
+        - deadline (float): seconds a track waits for its event.
+    '''
+    def __init__(self, session, port, signing_secret=None, host=WEBHOOK_HOST, path=WEBHOOK_PATH, deadline=POLL_DEADLINE):
+        self.session = session
+        self.secret = signing_secret if signing_secret is not None else secret
+        assert self.secret, "Set the `secret` env var to the webhook secret of the Cyanite integration"
+        self.deadline = deadline
+        self._events = {}
+        self._loop = None
+        self._app = Flask(__name__)
+        self._app.add_url_rule(path, 'webhook', self._receive, methods=['POST'])
+        self._server = make_server(host, port, self._app, threaded=True)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    def start(self):
+        '''Serve on a background thread. Has to be called from the event loop that awaits fetch.'''
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        print(f"Listening for Cyanite webhooks on port {self.port}")
+
+    def stop(self):
+        self._server.shutdown()
+        # shutdown only ends serve_forever, the socket holds the port until it is closed
+        self._server.server_close()
+
+    def _receive(self):
+        # Runs on a server thread: verify, then hand the track id to the event loop
+        body = request.get_data()
+        if not verifySignature(self.secret, body, request.headers.get('Signature')):
+            metrics.count('webhook_rejected')
+            return 'invalid signature', 401
+        payload = request.get_json(silent=True) or {}
+        trackID = webhookTrackID(payload)
+        metrics.count('webhook_events')
+        if trackID is not None:
+            self._loop.call_soon_threadsafe(self._notify, trackID)
+        return '', 200
+
+    def _notify(self, trackID):
+        # Only tracks being waited on are kept. fetch registers a created track before its
+        # first await, and tracks from earlier runs are checked up front instead
+        event = self._events.get(trackID)
+        if event is None:
+            metrics.count('webhook_ignored')
+            return
+        event.set()
+
+    async def fetch(self, trackID, fileName, created=True):
+        '''Wait for one track's event. Returns (feature payload, latency record) like getFeaturesAsync.'''
+        params = {"libraryTrackId": trackID}
+        start = monotonic()
+        event = self._events.setdefault(trackID, asyncio.Event())
+        polls = 0
+        try:
+            if not created and not event.is_set():
+                result = await _executeAsync(self.session, document(FEATURES_QUERY), params)
+                polls += 1
+                if analysisStatus(result) in ANALYSIS_DONE:
+                    event.set()
+            try:
+                await asyncio.wait_for(event.wait(), max(0, self.deadline - (monotonic() - start)))
+            except asyncio.TimeoutError:
+                pass
+            # The query can briefly lag the event, so back off until it agrees
+            delays = backoffDelays()
+            while True:
+                result = await _executeAsync(self.session, document(FEATURES_QUERY), params)
+                polls += 1
+                status = analysisStatus(result)
+                if status in ANALYSIS_DONE or monotonic() - start >= self.deadline:
+                    break
+                await asyncio.sleep(next(delays))
+        finally:
+            self._events.pop(trackID, None)
+        _saveFeatures(result, fileName)
+        return result, _logLatency(trackID, fileName, status, monotonic() - start, polls)
+
+
+#params : AsyncClientSession[gql], batch_size[int], webhook_port[int] or None
+#fn: picks how the async pipelines wait for analyses: webhook events, batched polling or per-track polling
+#return: WebhookReceiver (started), FeatureBatcher or None
+def makeWaiter(session, batch_size, webhook_port=None):
+    if webhook_port is not None:
+        receiver = WebhookReceiver(session, webhook_port)
+        receiver.start()
+        return receiver
+    return FeatureBatcher(session, batch_size) if batch_size > 1 else None
+
+
+#params : AsyncClientSession[gql], Semaphore, TrackIndex, JobJournal, upload executor,
+#         FeatureBatcher, WebhookReceiver or None, MP3 DIR, file, data[bytes] -> contents of
+#         a file that was never written to MP3 DIR
+#fn: async variant of processFile. the semaphore bounds the network
+#    stages, not the analysis wait in between.
+#return: latency record, or None if nothing had to be fetched
+async def processFileAsync(session, semaphore, index, journal, uploader, batcher, dirName, file, data=None):
+    fullFile = os.path.join(dirName, file)
+    fileName = file.split(".")[0]
+    if data is None:
+        sha256 = await asyncio.to_thread(sha256File, fullFile)
+    else:
+        sha256 = sha256Bytes(file, data)
+    state = journal.state(file, sha256)
+    trackID = _resumeFromCache(index, journal, state, file, sha256)
+    if trackID is False:
+        return None
+
+    created = False
+    async with semaphore:
+        if trackID is None:
+            trackID = await retriveIDsAsync(session, sha256)
+        if trackID is None:
+            _id = state.get('uploadId') if state.get('stage') == 'uploaded' else None
+            if _id is not None:
+                try:
+                    trackID = await createTrackAsync(session, _id, fileName)
+                except LibraryTrackCreateError as e:
+                    _rejectedUpload(fileName, _id, e)
+                    _id = None
+            if _id is None:
+                _id, uploadUrl = await uploadRequestAsync(session)
+                journal.record(file, sha256, 'upload-requested', uploadId=_id)
+                # uploadFiles is blocking, keep it off the event loop
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(uploader, uploadFiles, fullFile, _id, uploadUrl, data)
+                journal.record(file, sha256, 'uploaded', uploadId=_id)
+                trackID = await createTrackAsync(session, _id, fileName)
+            created = True
+    _trackCreated(index, journal, state, file, sha256, trackID)
+
+    if batcher is not None:
+        result, record = await batcher.fetch(trackID, fileName, created)
+    else:
+        result, record = await getFeaturesAsync(session, trackID, fileName)
+    _featuresFetched(index, journal, file, sha256, trackID, result, record)
+    return record
+
+
+#params : MP3 DIR, path to csv, concurrency[int] -> max files in a network stage at once,
+#         upload_workers[int] -> max uploads running at once, batch_size[int] -> tracks per feature query,
+#         webhook_port[int] -> wait for Cyanite webhooks on this port instead of polling
+#fn: asyncio pipeline variant of startProcess
+#return: None
+async def startProcessAsync(dirName, path_to_csv, concurrency=8, upload_workers=UPLOAD_WORKERS, batch_size=BATCH_SIZE, webhook_port=None):
+
+    #init client 
+    client = makeClient()
+
+    #get data
+    files = file_from_csv(path_to_csv)
+    semaphore = asyncio.Semaphore(concurrency)
+    index = TrackIndex(TRACK_INDEX_PATH)
+    journal = JobJournal(JOURNAL_PATH)
+    uploader = ThreadPoolExecutor(max_workers=upload_workers)
+    # One pooled connection per upload thread
+    uploadSession(upload_workers)
+
+    async with client as session:
+        cacheSchema(client)
+        batcher = makeWaiter(session, batch_size, webhook_port)
+        try:
+            results = await asyncio.gather(
+                *[processFileAsync(session, semaphore, index, journal, uploader, batcher, dirName, file) for file in files],
+                return_exceptions=True
+            )
+        finally:
+            # Frees the port even if the run fails
+            if isinstance(batcher, WebhookReceiver):
+                batcher.stop()
+    uploader.shutdown()
+    journal.close()
+    index.close()
+
+    # A failure on one file should not cancel the rest of the batch
+    latencies = []
+    for file, result in zip(files, results):
+        if isinstance(result, Exception):
+            print(f"Failed {file}: {result!r}")
+        elif result is not None:
+            latencies.append(result)
+    reportLatencies(latencies)
+    reportRetries()
+
+
+#params : MP3 DIR, queue.Queue of file names, or (file name, bytes) for files only held in memory,
+#         closed with None, concurrency[int] -> max files in a network stage at once,
+#         upload_workers[int], batch_size[int], in_flight[int] -> max files taken off the queue and not yet done,
+#         onDone(file, latency record / None / exception) -> called as each file finishes,
+#         webhook_port[int] -> wait for Cyanite webhooks on this port instead of polling
+#fn: streaming variant of startProcessAsync, for files that are still being produced. the queue
+#    is only read while fewer than in_flight files are in progress, so a slow API backs up into
+#    whatever fills the queue
+#return: None
+async def startProcessQueue(dirName, files, concurrency=8, upload_workers=UPLOAD_WORKERS, batch_size=BATCH_SIZE, in_flight=64, onDone=None, webhook_port=None):
+
+    #init client
+    client = makeClient()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    slots = asyncio.Semaphore(in_flight)
+    index = TrackIndex(TRACK_INDEX_PATH)
+    journal = JobJournal(JOURNAL_PATH)
+    uploader = ThreadPoolExecutor(max_workers=upload_workers)
+    # One pooled connection per upload thread
+    uploadSession(upload_workers)
+    loop = asyncio.get_running_loop()
+    latencies = []
+
+    async def tag(file, data):
+        try:
+            result = await processFileAsync(session, semaphore, index, journal, uploader, batcher, dirName, file, data)
+        except Exception as e:
+            # A failure on one file should not stop the stream
+            print(f"Failed {file}: {e!r}")
+            result = e
+        finally:
+            slots.release()
+        if isinstance(result, dict):
+            latencies.append(result)
+        if onDone is not None:
+            onDone(file, result)
+
+    async with client as session:
+        cacheSchema(client)
+        batcher = makeWaiter(session, batch_size, webhook_port)
+        try:
+            tasks = set()
+            while True:
+                await slots.acquire()
+                # queue.Queue.get blocks, keep it off the event loop
+                item = await loop.run_in_executor(None, files.get)
+                if item is None:
+                    break
+                file, data = item if isinstance(item, tuple) else (item, None)
+                task = asyncio.create_task(tag(file, data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            # Frees the port even if the run fails
+            if isinstance(batcher, WebhookReceiver):
+                batcher.stop()
+    uploader.shutdown()
+    journal.close()
+    index.close()
+    reportLatencies(latencies)
+    reportRetries()
+
+
+#params : path to csv, path to the work queue database
+#fn: coordinator of a distributed run: queues every filename of the csv as a work item.
+#    re-running it with a longer csv only adds the new files
+#return: number of files added
+def coordinate(path_to_csv, queuePath=WORK_QUEUE_PATH):
+    workQueue = WorkQueue(queuePath)
+    added = workQueue.add(file_from_csv(path_to_csv))
+    print(f"Queued {added} new files, queue is now {workQueue.counts()}")
+    workQueue.close()
+    return added
+
+
+#params : MP3 DIR, path to the work queue database, worker id (defaults to host-pid),
+#         concurrency, upload_workers, batch_size, in_flight -> as startProcessQueue,
+#         lease[s] -> how long a claim lasts without a heartbeat, webhook_port
+#fn: worker of a distributed run. claims files while fewer than in_flight are in progress,
+#    tags them with startProcessQueue and heartbeats its leases, so files of a worker that
+#    dies go back to the others. exits once no file is pending or leased by anyone
+#return: None
+def startWorker(dirName, queuePath=WORK_QUEUE_PATH, worker=None, concurrency=8, upload_workers=UPLOAD_WORKERS,
+                batch_size=BATCH_SIZE, in_flight=64, lease=WORK_LEASE, webhook_port=None):
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    workQueue = WorkQueue(queuePath, lease)
+    files = queue.Queue()
+    held = set()
+    heldLock = threading.Lock()
+    # (file, error or None) of finished files, written to the queue by the feeder so sqlite stays off the event loop
+    settled = queue.Queue()
+
+    def onDone(file, result):
+        with heldLock:
+            held.discard(file)
+        # None is a file skipped as already tagged
+        if isinstance(result, Exception):
+            settled.put((file, repr(result)))
+        elif result is not None and result['status'] != 'AudioAnalysisV6Finished':
+            settled.put((file, result['status']))
+        else:
+            settled.put((file, None))
+
+    def settle():
+        while True:
+            try:
+                file, error = settled.get_nowait()
+            except queue.Empty:
+                return
+            if error is None:
+                workQueue.complete(worker, file)
+            else:
+                workQueue.fail(worker, file, error)
+
+    def feed():
+        lastBeat = monotonic()
+        try:
+            while True:
+                settle()
+                with heldLock:
+                    free = in_flight - len(held)
+                claimed = workQueue.claim(worker, free) if free > 0 else []
+                with heldLock:
+                    held.update(claimed)
+                for file in claimed:
+                    files.put(file)
+                if monotonic() - lastBeat >= lease / 3:
+                    with heldLock:
+                        current = list(held)
+                    workQueue.heartbeat(worker, current)
+                    lastBeat = monotonic()
+                if not claimed:
+                    # Files leased by other workers may still come back if they die
+                    if workQueue.remaining() == 0:
+                        return
+                    sleep(WORK_POLL)
+        except Exception as e:
+            # Stop taking work, unheartbeated leases go back to the other workers
+            print(f"Worker {worker} stopped claiming: {e!r}")
+        finally:
+            files.put(None)
+
+    print(f"Worker {worker} claiming from {queuePath}")
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        asyncio.run(startProcessQueue(dirName, files, concurrency, upload_workers, batch_size, in_flight, onDone, webhook_port))
+    finally:
+        # Files finished after the feeder stopped
+        settle()
+        workQueue.release(worker)
+        print(f"Worker {worker} finished, queue is now {workQueue.counts()}")
+        workQueue.close()
+
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(description='Pass in directory name.')
 
     parser.add_argument('--dir_name', help='Name of directory with mp3s')
     parser.add_argument('--csv_name', help='Path to csv')
+    parser.add_argument('--concurrency', type=int, default=None, help='Run the asyncio pipeline with this many files in flight')
+    parser.add_argument('--upload_workers', type=int, default=UPLOAD_WORKERS, help='Max parallel uploads in the asyncio pipeline')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE, help='Tracks fetched per feature query')
+    parser.add_argument('--rate', type=float, default=API_RATE, help='Max Cyanite API requests per second')
+    parser.add_argument('--webhook_port', type=int, default=None, help='Wait for Cyanite analysis webhooks on this port instead of polling')
+    parser.add_argument('--queue', default=None, help='Work queue database shared by a distributed run. Runs a worker over --dir_name, or with --coordinate queues --csv_name')
+    parser.add_argument('--coordinate', action='store_true', help='Queue the files of --csv_name in --queue and exit')
+    parser.add_argument('--worker_id', default=None, help='Name of this worker in --queue, defaults to host-pid')
+    parser.add_argument('--lease', type=float, default=WORK_LEASE, help='Seconds a claimed file is held without a heartbeat')
+
+    addMetricsArguments(parser)
 
     args = parser.parse_args()
+    setRateLimit(args.rate)
+    configureMetrics(args)
 
-    startProcessProxy(args.dir_name, args.csv_name)
+    if args.queue and args.coordinate:
+        coordinate(args.csv_name, args.queue)
+    elif args.queue:
+        # --rate is per worker, so split the account's limit between them
+        startWorker(args.dir_name, args.queue, args.worker_id, args.concurrency or 8, args.upload_workers,
+                    args.batch_size, lease=args.lease, webhook_port=args.webhook_port)
+    else:
+        startProcessProxy(args.dir_name, args.csv_name, args.concurrency, args.upload_workers, args.batch_size, args.webhook_port)
     
\ No newline at end of file
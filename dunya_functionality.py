@@ -1,19 +1,116 @@
+import argparse
+import io
 import json
 import os
 import math
+import shutil
+import subprocess
+import threading
+import time
 import pydub
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pydub import AudioSegment
+from pydub.audio_segment import fix_wav_headers
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import mediainfo
 from compmusic import dunya
 from datetime import datetime
+from metrics import metrics, add_arguments, configure_from_args
+from mp3_frames import MP3Frames
+from segment_filter import SegmentFilter, load_pcm, pcm_from_audio
+
+# Dunya metadata rarely changes; refetch cached entries after 30 days
+METADATA_TTL = 30 * 24 * 3600
+
+class MetadataCache:
+    '''
+    On-disk cache of Dunya recording metadata, one JSON per mbid, so that splitting
+    doesn't call get_recording for every file on every run.
+
+    params:
+        - tradition (str): 'hindustani' or 'andalusian'.
+        - cache_path (str): root directory. Entries are saved as <cache_path>/<tradition>/<mbid>.json.
+        - ttl (float): seconds before an entry is refetched. None never refetches.
+        - offline (bool): never call Dunya. Expired entries are used as is, and a missing entry raises KeyError.
+    '''
+    def __init__(self, tradition:str, cache_path:str = os.path.join('configs', 'metadata'), ttl:float = METADATA_TTL, offline:bool = False):
+        self.tradition = tradition
+        self.path = os.path.join(cache_path, tradition)
+        self.ttl = ttl
+        self.offline = offline
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, mbid:str) -> str:
+        return os.path.join(self.path, f'{mbid}.json')
+
+    def _is_fresh(self, path:str) -> bool:
+        return self.ttl is None or time.time() - os.path.getmtime(path) < self.ttl
+
+    def get_recording(self, mbid:str) -> dict:
+        '''Cached equivalent of dunya.<tradition>.get_recording(mbid).'''
+        path = self._entry_path(mbid)
+        cached = os.path.isfile(path)
+        if cached and (self.offline or self._is_fresh(path)):
+            metrics.count('metadata_cache_hits')
+            with open(path, 'r') as j:
+                return json.load(j)
+        if self.offline:
+            raise KeyError(f'No cached {self.tradition} metadata for {mbid}')
+        try:
+            with metrics.stage('metadata', mbid):
+                recording = getattr(dunya, self.tradition).get_recording(mbid)
+        except Exception as e:
+            if not cached:
+                raise
+            # A stale entry beats failing the whole split
+            print(f'Refreshing metadata for {mbid} failed ({e!r}), using cached copy')
+            with open(path, 'r') as j:
+                return json.load(j)
+        # Write to a temp file first so a crash or a concurrent writer never leaves half a JSON
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as j:
+            json.dump(recording, j)
+        os.replace(tmp_path, path)
+        return recording
+
+    def prefetch(self, mbids:list, workers:int = 8):
+        '''Fill the cache for all mbids, fetching missing or expired entries in parallel.'''
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.get_recording, mbid): mbid for mbid in mbids}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Failed to fetch metadata for {futures[future]}: {e!r}')
+        print(f'Prefetched {len(mbids)} {self.tradition} recordings.')
 
 class OSFunctionality:
     '''
     Child class to hold any common functions used for both Downloader and Splitter classes.
 
     - dunya_config (str): path to dunya config to authenticate.
+    - metadata_path (str): root of the on-disk Dunya metadata cache.
+    - metadata_ttl (float): seconds before cached metadata is refetched. None never refetches.
+    - offline (bool): use only cached metadata and never call the Dunya API for it.
     '''
-    def __init__(self, dunya_config:str):
+    def __init__(
+        self,
+        dunya_config:str,
+        metadata_path:str = os.path.join('configs', 'metadata'),
+        metadata_ttl:float = METADATA_TTL,
+        offline:bool = False
+    ):
         self.dunya_config = dunya_config
+        self.metadata_path = metadata_path
+        self.metadata_ttl = metadata_ttl
+        self.offline = offline
+        self._metadata = {}
+    
+    def _metadata_cache(self, tradition:str) -> MetadataCache:
+        '''Metadata cache of a tradition, created on first use.'''
+        if tradition not in self._metadata:
+            self._metadata[tradition] = MetadataCache(tradition, self.metadata_path, self.metadata_ttl, self.offline)
+        return self._metadata[tradition]
     
     def _authenticate(self):
         '''
@@ -37,6 +134,9 @@ class Downloader(OSFunctionality):
     params:
         - N (int): number of files to download from each set.
         - dunya_config (str): path to dunya config for authentication.
+        - workers (int): number of recordings to download at once.
+        - metadata_path (str): root of the on-disk Dunya metadata cache.
+        - metadata_ttl (float): seconds before the cached recordings listing and metadata are refetched.
     '''
     def __init__(
         self, 
@@ -46,13 +146,17 @@ class Downloader(OSFunctionality):
         path_to_andalusian:str = os.path.join('data', 'andalusian'), 
         path_to_hindustani:str = os.path.join('data', 'hindustani'),
         configs_save_path:str = os.path.join('configs'),
-        start_from:int = 0
+        start_from:int = 0,
+        workers:int = 1,
+        metadata_path:str = os.path.join('configs', 'metadata'),
+        metadata_ttl:float = METADATA_TTL
     ):
-        super().__init__(dunya_config)
+        super().__init__(dunya_config, metadata_path, metadata_ttl)
         # Instantiate params:
         self.N = N
         self.start_from = start_from
         self.dataset = dataset
+        self.workers = workers
         
         # Create paths if they don't exit:
         self.path_to_andalusian = path_to_andalusian
@@ -80,7 +184,7 @@ class Downloader(OSFunctionality):
         with open(config_name, 'w') as j:
             json.dump(recordings_list, j)
     
-    def _convert_name(self, path_to_folder:str, song_title:str, mbid:str):
+    def _convert_name(self, path_to_folder:str, song_title:str, mbid:str, download_dir:str):
         '''
         Convert name of specified mp3 file.
 
@@ -88,48 +192,101 @@ class Downloader(OSFunctionality):
             - path_to_folder (str): folder name. will be either pointing to andalusian or hindustani directories.
             - song_title (str): song title of song to be converted. dunya api will save the mp3 as song_title.
             - mbid (str): unique mbid of song. will be used for new save name as it will be more consistent.
+            - download_dir (str): directory the mp3 was downloaded into.
         '''
         # Create paths:
-        mp3_path = os.path.join(path_to_folder, song_title)
-        wav_path = os.path.join(path_to_folder, f'{mbid}.mp3')
-        # Convert audio file:
-        AudioSegment.from_file(mp3_path, format='mp3').export(wav_path, format='mp3')
-        # Remove mp3 file:
-        os.remove(mp3_path)
+        mp3_path = os.path.join(download_dir, song_title)
+        final_path = os.path.join(path_to_folder, f'{mbid}.mp3')
+        # Atomic rename, so <mbid>.mp3 only ever exists complete:
+        os.replace(mp3_path, final_path)
+
+    def _dataset_paths(self):
+        '''Dunya module and save folder of the selected dataset.'''
+        if self.dataset == 'hindustani':
+            return self.hindustani, self.path_to_hindustani
+        elif self.dataset == 'andalusian':
+            return self.andalusian, self.path_to_andalusian
+        raise ValueError(f'Unknown dataset {self.dataset}')
+
+    def _download_one(self, entry:dict) -> str:
+        '''
+        Download one recording to <mbid>.mp3, skipping it if it is already there.
+
+        Each download goes to its own .<mbid>.part directory first, so concurrent
+        downloads of recordings with the same title can't collide and an interrupted
+        download never leaves a partial <mbid>.mp3 behind.
+        '''
+        module, folder = self._dataset_paths()
+        mbid = entry['mbid']
+        if os.path.isfile(os.path.join(folder, f'{mbid}.mp3')):
+            print(f'Skipping {entry["title"]}, already downloaded.')
+            return mbid
+
+        download_dir = os.path.join(folder, f'.{mbid}.part')
+        # Clear anything left by an interrupted run:
+        shutil.rmtree(download_dir, ignore_errors=True)
+        os.makedirs(download_dir)
+
+        # Download file
+        print(f'Downloading {entry["title"]} from {self.dataset.capitalize()}.')
+        with metrics.stage('download', mbid) as record:
+            name = module.download_mp3(mbid, download_dir)
+            record['bytes'] = os.path.getsize(os.path.join(download_dir, name))
+        print('Download complete.')
+
+        # Convert name
+        self._convert_name(folder, name, mbid, download_dir)
+        shutil.rmtree(download_dir, ignore_errors=True)
+        return mbid
 
     def _download(self, recordings):
         '''
         Actually download in the loop. This helps with redundant code.
         '''
-        for i in range(self.start_from, (self.N + self.start_from)):
-            # Get current entry:
-            entry = recordings[i]
-            
-            # Download file
-            print(f'Downloading {entry["title"]} from {self.dataset.capitalize()}.')
-            if self.dataset == 'hindustani':
-                name = self.hindustani.download_mp3(entry['mbid'], self.path_to_hindustani)
-            elif self.dataset == 'andalusian':
-                name = self.andalusian.download_mp3(entry['mbid'], self.path_to_andalusian)
-            print('Download complete.')
-
-            # Convert name
-            if self.dataset == 'andalusian':
-                self._convert_name(self.path_to_andalusian, name, entry['mbid'])
-            elif self.dataset == 'hindustani':
-                self._convert_name(self.path_to_hindustani, name, entry['mbid'])
+        entries = recordings[self.start_from:(self.N + self.start_from)]
+        if self.workers <= 1:
+            for entry in entries:
+                self._download_one(entry)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self._download_one, entry): entry for entry in entries}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # One failed recording shouldn't stop the rest; rerun to retry it
+                    print(f'Failed to download {futures[future]["title"]}: {e!r}')
             
 
     
+    def _get_recordings(self) -> list:
+        '''
+        Listing of the whole corpus, saved to configs_save_path and only refetched once
+        it is older than metadata_ttl.
+        '''
+        module, _ = self._dataset_paths()
+        config_name = os.path.join(self.configs_save_path, f'{self.dataset}_recordings.json')
+        if os.path.isfile(config_name) and (
+            self.metadata_ttl is None or time.time() - os.path.getmtime(config_name) < self.metadata_ttl
+        ):
+            with open(config_name, 'r') as j:
+                return json.load(j)
+        recordings = module.get_recordings()
+        self._save_recordings(recordings, config_name)
+        return recordings
+
     def download(self):
         '''
         Core method for downloading the first N files from both Andalusian and Hindustani corpora.
         '''
         # Get all recordings. Each entry of the list will be a JSON with a recording ID
-        if self.dataset == 'andalusian':
-            self._download(self.andalusian.get_recordings())
-        elif self.dataset == 'hindustani':
-            self._download(self.hindustani.get_recordings())
+        self._download(self._get_recordings())
+
+    def prefetch_metadata(self, workers:int = 8):
+        '''Cache the metadata of the N selected recordings so they can be split offline.'''
+        entries = self._get_recordings()[self.start_from:(self.N + self.start_from)]
+        self._metadata_cache(self.dataset).prefetch([entry['mbid'] for entry in entries], workers)
         
 
 class Splitter(OSFunctionality):
@@ -144,14 +301,49 @@ class Splitter(OSFunctionality):
         - len_large_segment (float): length in minutes of a large segement to be cropped down further for andalusian data.
         - dunya_config (str): path to dunya config to authenticate.
         - sr (float): sample rate of audio. default set to 16000
+        - workers (int): number of processes to export segments with. 1 exports serially in this process.
+        - segments_per_job (int): max segments of one recording handed to a single worker.
+        - streaming (bool): decode only each segment's time window with an ffmpeg seek instead
+        of the whole recording, so memory is bounded by segment length.
+        - lossless (bool): cut on MP3 frame boundaries and copy the compressed frames instead of
+        decoding and re-encoding. Takes precedence over streaming.
+        - metadata_path (str): root of the on-disk Dunya metadata cache.
+        - metadata_ttl (float): seconds before cached metadata is refetched.
+        - offline (bool): split from cached metadata only, without calling the Dunya API.
+        - prune_silence (bool): skip segments that are mostly silence.
+        - prune_duplicates (bool): skip segments that repeat an earlier segment of the same recording.
+        With either set, every recording is also checked for the other and the savings are reported.
     '''
-    def __init__(self, dir_path:str, save_path:str, len_minutes_crop:float, len_large_segment:float, dunya_config:str):
-        super().__init__(dunya_config)
+    def __init__(
+        self,
+        dir_path:str,
+        save_path:str,
+        len_minutes_crop:float,
+        len_large_segment:float,
+        dunya_config:str,
+        workers:int = 1,
+        segments_per_job:int = 8,
+        streaming:bool = False,
+        lossless:bool = False,
+        metadata_path:str = os.path.join('configs', 'metadata'),
+        metadata_ttl:float = METADATA_TTL,
+        offline:bool = False,
+        prune_silence:bool = False,
+        prune_duplicates:bool = False
+    ):
+        super().__init__(dunya_config, metadata_path, metadata_ttl, offline)
         # Instantiate params
         self.dir_path = dir_path
         self.save_path = save_path
         self.len_minutes_crop = len_minutes_crop
         self.len_large_segment = len_large_segment
+        self.workers = workers
+        self.segments_per_job = segments_per_job
+        self.streaming = streaming
+        self.lossless = lossless
+        self.segment_filter = None
+        if prune_silence or prune_duplicates:
+            self.segment_filter = SegmentFilter(drop_silent=prune_silence, drop_duplicates=prune_duplicates)
         # Convert minutes to num samples
         self.num_samples = self.len_minutes_crop * 60 * 1000
         self.len_large_segment *= 60 * 1000
@@ -168,11 +360,20 @@ class Splitter(OSFunctionality):
         processed_str = '/-/-'.join(common_names)
         return processed_str
 
-    def _split_hindustani(self, audio, full_file_name):
-        '''Split on Hindustani dataset.'''
+    def _plan_hindustani(self, length:float, full_file_name:str) -> list:
+        '''
+        Plan the segments of a Hindustani recording.
+
+        params:
+            - length (float): length of the recording in ms.
+            - full_file_name (str): mbid of the recording.
+
+        returns:
+            - list of (start, end, file_name, tags) tuples. end of None means the end of the recording.
+        '''
         # Get metadata:
         print('Getting recordings')
-        recordings = dunya.hindustani.get_recording(full_file_name)
+        recordings = self._metadata_cache('hindustani').get_recording(full_file_name)
         print('Completed. Now splitting data')
         layas = self._get_common_names_processed(recordings['layas'])
         taals = self._get_common_names_processed(recordings['taals'])
@@ -184,35 +385,27 @@ class Splitter(OSFunctionality):
             'forms': [forms]
         }
         # Calculate number of (len_minutes) segments in the audio file
-        num_segments = math.floor(len(audio) / self.num_samples)
+        num_segments = math.floor(length / self.num_samples)
         # If we can't parse 2 or more segments, no need to split:
         if num_segments <= 1:
-            seg_i = 0
-            file_name = f'{full_file_name}_{seg_i}.mp3'
-            segment_path = os.path.join(self.save_path, file_name)
-            audio.export(segment_path, format='mp3', tags=tags_)
-        else:
-            # Loop through segment index and save
-            for seg_i in range(num_segments):
-                # Get start and end
-                start = seg_i*self.num_samples
-                end = ((seg_i + 1) * self.num_samples) - 1
-                # Segment array
-                audio_segment = audio[start:end]
-                # Write array:
-                file_name = f'{full_file_name}_{seg_i}.mp3'
-                segment_path = os.path.join(self.save_path, file_name)
-                audio_segment.export(segment_path, format='mp3', tags=tags_)
-        print('Splitting completed.')
-    
-    def _split_andalusian(self, audio, full_file_name):
-        '''Split on Andalusian dataset.'''
+            return [(0, None, f'{full_file_name}_0.mp3', tags_)]
+        plan = []
+        for seg_i in range(num_segments):
+            # Get start and end
+            start = seg_i*self.num_samples
+            end = ((seg_i + 1) * self.num_samples) - 1
+            plan.append((start, end, f'{full_file_name}_{seg_i}.mp3', tags_))
+        return plan
+
+    def _plan_andalusian(self, length:float, full_file_name:str) -> list:
+        '''Plan the segments of an Andalusian recording by section. Same return as _plan_hindustani.'''
         # Get recording info and the sections:
         print('Getting recordings')
-        recording_info = dunya.andalusian.get_recording(full_file_name)
+        recording_info = self._metadata_cache('andalusian').get_recording(full_file_name)
         sections = recording_info['sections']
         print('Completed. Now splitting data')
         # Loop through sections
+        plan = []
         seg_i = 0
         for section in sections:
             
@@ -222,45 +415,45 @@ class Splitter(OSFunctionality):
             
             # Now convert to array index:
             st, et = self._datetime_to_index(st), self._datetime_to_index(et)
-            audio_segment = audio[st:et]
+            # Length of audio[st:et], which is clipped to the recording
+            section_length = max(0, min(et, length) - min(st, length))
             
             # Get mizan, nawba, and form:
             mizan = section['mizan']['display_order']
             nawba = section['nawba']['display_order']
             form = section['form']['display_order']
+            tags_ = {
+                'genre': 'andalusian',
+                'mizan': mizan,
+                'nawba': nawba,
+                'form': form
+            }
             
             # Now see if the segment is too big:
-            if len(audio_segment) >= self.len_large_segment:
+            if section_length >= self.len_large_segment:
                 # Update seg_i for indices of segment:
-                    seg_i = self._segment_split(
-                    st, et, full_file_name, audio_segment, mizan, nawba, form, seg_i
-                    ) # This function will save all of the data as well.
+                seg_i = self._segment_split(
+                    st, et, section_length, full_file_name, tags_, seg_i, plan
+                )
             else:
                 # Construct segment
                 seg_i += 1
-                file_name = f'{full_file_name}_{seg_i}.mp3'
-                segment_path = os.path.join(self.save_path, file_name)
-                tags_ = {
-                    'genre': 'andalusian',
-                    'mizan': mizan,
-                    'nawba': nawba,
-                    'form': form
-                }
-                audio_segment.export(segment_path, format='mp3', tags=tags_)
+                plan.append((st, et, f'{full_file_name}_{seg_i}.mp3', tags_))
+        return plan
     
-    def _segment_split(self, st, et, full_file_name, audio_segment, mizan, nawba, form, seg_i):
+    def _segment_split(self, st, et, section_length, full_file_name, tags_, seg_i, plan):
         '''
         Split segment further.
 
         params:
-            - st (float): start time of array (index)
-            - et (float): end time of array (index)
-            - audio_segment (np.ndarray): numpy array of audio segment
-            - mizan (dict): dict containing mizan
-            - nawba (dict): dict containing nawba
-            - form (dict): dict containing form
+            - st (float): start time of the section in the recording (index)
+            - et (float): end time of the section in the recording (index)
+            - section_length (float): length of the section once clipped to the recording
+            - tags_ (dict): dict containing genre, mizan, nawba and form
+            - seg_i (int): index of the last planned segment
+            - plan (list): segment plan to append to
         '''
-        num_segments = math.floor(len(audio_segment) / self.num_samples)
+        num_segments = math.floor(section_length / self.num_samples)
         for seg in range(num_segments):
             # Get start index:
             start_ = st + (seg*self.num_samples)
@@ -271,25 +464,28 @@ class Splitter(OSFunctionality):
             else:
                 end_ = st + ((seg+1)*self.num_samples) - 1
             
-            # Update segment index and file name and update file names list:
+            # Update segment index and file name:
             seg_i += 1
-            file_name = f'{full_file_name}_{seg_i}.mp3'
-            segment_path = os.path.join(self.save_path, file_name)
-
-            # Construct tags:
-            tags_ = {
-                'genre': 'andalusian',
-                'mizan': mizan,
-                'nawba': nawba,
-                'form': form
-            }
-            
-            # Now do the splitting:
-            audio_sub_segment = audio_segment[start_:end_]
-            audio_sub_segment.export(segment_path, format='mp3', tags=tags_)
+            plan.append((start_, end_, f'{full_file_name}_{seg_i}.mp3', tags_))
         # Return all updated information when complete:
         return seg_i
 
+    def _plan(self, data_folder:str, length:float, file_name:str) -> list:
+        if data_folder == 'andalusian':
+            return self._plan_andalusian(length, file_name)
+        elif data_folder == 'hindustani':
+            return self._plan_hindustani(length, file_name)
+        return []
+
+    def _prune(self, path:str, plan:list, audio=None) -> list:
+        '''
+        Run the plan of the recording at path through the segment filter, if there is one.
+        Given the recording already decoded as audio, it is resampled rather than decoded again.
+        '''
+        if self.segment_filter is None or not plan:
+            return plan
+        return _prune_plan(self.segment_filter, path, plan, audio)
+
     def _datetime_to_index(self, dt:datetime) -> float:
         '''Convert dt to seconds, add them up, and multiply by 1000'''
         hour_ = dt.hour * 3600
@@ -300,20 +496,298 @@ class Splitter(OSFunctionality):
     def split(self):
         '''Main split function:'''
         # Authenticate
-        self._authenticate()
+        if not self.offline:
+            self._authenticate()
         data_folder = self.dir_path.split('/')[-1]
-        for file in os.listdir(self.dir_path):
+        files = []
+        for file in sorted(os.listdir(self.dir_path)):
             file_name = file.split('.')[0] # Will be mbid
             if file_name == '':
                 continue
-            # Load audio as array
-            print(f'Loading {file_name}')
-            audio = pydub.AudioSegment.from_mp3(os.path.join(self.dir_path, file))
-            print(f'Loaded. \n Processing {file_name}')
-            if data_folder == 'andalusian':
-                self._split_andalusian(audio, file_name)
-            elif data_folder == 'hindustani':
-                self._split_hindustani(audio, file_name)
+            files.append((file, file_name))
+
+        if self.workers > 1:
+            self._split_parallel(data_folder, files)
+        else:
+            for file, file_name in files:
+                self.split_file(file, data_folder)
+        if self.segment_filter is not None:
+            self.segment_filter.report()
+
+    def split_file(self, file:str, data_folder:str = None) -> list:
+        '''
+        Split one recording of dir_path in the current mode.
+
+        params:
+            - file (str): file name within dir_path, <mbid>.mp3.
+            - data_folder (str): 'hindustani' or 'andalusian'. Defaults to the name of dir_path.
+
+        returns:
+            - the exported plan, as (start, end, file_name, tags) tuples.
+        '''
+        plan = []
+        for start, end, file_name, tags_, data in self._encode_file(file, data_folder):
+            _save_segment(self.save_path, file_name, data)
+            plan.append((start, end, file_name, tags_))
+        print('Splitting completed.')
+        return plan
+
+    def iter_segments(self, file:str, data_folder:str = None, archive:bool = False):
+        '''
+        Split one recording like split_file, but hand each segment over in memory as soon
+        as it is encoded instead of writing it to save_path.
+
+        params:
+            - file (str): file name within dir_path, <mbid>.mp3.
+            - data_folder (str): 'hindustani' or 'andalusian'. Defaults to the name of dir_path.
+            - archive (bool): also write each segment to save_path.
+
+        returns:
+            - generator of (file_name, tags, data), data being the encoded MP3 bytes.
+        '''
+        for _, _, file_name, tags_, data in self._encode_file(file, data_folder):
+            if archive:
+                _save_segment(self.save_path, file_name, data)
+            yield file_name, tags_, data
+
+    def _encode_file(self, file:str, data_folder:str = None):
+        '''Plan one recording and encode its segments in the current mode, yielding (start, end, file_name, tags, data).'''
+        data_folder = data_folder or self.dir_path.split('/')[-1]
+        file_name = file.split('.')[0] # Will be mbid
+        path = os.path.join(self.dir_path, file)
+        if self.lossless:
+            print(f'Processing {file_name}')
+            with metrics.stage('index', file_name, bytes=os.path.getsize(path)):
+                frames = MP3Frames(path)
+            try:
+                plan = self._prune(path, self._plan(data_folder, frames.duration_ms, file_name))
+                yield from _with_plan(plan, _encode_frames(frames, plan))
+            finally:
+                frames.close()
+            return
+        if self.streaming:
+            print(f'Processing {file_name}')
+            plan = self._prune(path, self._plan(data_folder, _duration(path), file_name))
+            yield from _with_plan(plan, _encode_windows(path, plan))
+            return
+        # Load audio as array
+        print(f'Loading {file_name}')
+        with metrics.stage('decode', file_name, bytes=os.path.getsize(path)):
+            audio = pydub.AudioSegment.from_mp3(path)
+        print(f'Loaded. \n Processing {file_name}')
+        plan = self._prune(path, self._plan(data_folder, len(audio), file_name), audio)
+        yield from _with_plan(plan, _encode_segments(audio, plan))
+
+    def _mode(self) -> str:
+        if self.lossless:
+            return 'lossless'
+        return 'streaming' if self.streaming else 'decode'
+
+    def _split_parallel(self, data_folder:str, files:list):
+        '''
+        Export segments across a process pool. Plans are built here, from the duration
+        ffprobe (or the frame index) reports, so names and tags are fixed before any worker starts. Large
+        recordings are cut into jobs of at most segments_per_job segments. With a segment
+        filter, each plan is first pruned by a job of its own in the pool, and its exports
+        are queued as soon as that finishes.
+        '''
+        plans = []
+        for file, file_name in files:
+            path = os.path.join(self.dir_path, file)
+            length = _frames_duration(path) if self.lossless else _duration(path)
+            plans.append((path, self._plan(data_folder, length, file_name)))
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+
+            def submit(path, plan):
+                for i in range(0, len(plan), self.segments_per_job):
+                    futures.append(pool.submit(_export_job, path, self.save_path, plan[i:i + self.segments_per_job], self._mode()))
+
+            if self.segment_filter is None:
+                for path, plan in plans:
+                    submit(path, plan)
+            else:
+                settings = self.segment_filter.settings()
+                pruning = [pool.submit(_prune_job, path, plan, settings) for path, plan in plans if plan]
+                for future in as_completed(pruning):
+                    path, plan, totals, worker_metrics = future.result()
+                    self.segment_filter.merge(totals)
+                    metrics.merge(worker_metrics)
+                    submit(path, plan)
+            for future in as_completed(futures):
+                names, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                print(f'Exported {", ".join(names)}')
+        print('Splitting completed.')
+
+
+def _save_segment(save_path:str, file_name:str, data:bytes):
+    with open(os.path.join(save_path, file_name), 'wb') as f:
+        f.write(data)
+
+
+def _save_segments(save_path:str, segments) -> list:
+    '''Write encoded (file_name, tags, data) segments to save_path and return their names.'''
+    names = []
+    for file_name, _, data in segments:
+        _save_segment(save_path, file_name, data)
+        names.append(file_name)
+    return names
+
+
+def _with_plan(plan:list, segments):
+    '''Pair encoded (file_name, tags, data) segments back up with their planned start and end.'''
+    for (start, end, _, _), (file_name, tags_, data) in zip(plan, segments):
+        yield start, end, file_name, tags_, data
+
+
+def _encode_segments(audio, plan:list):
+    '''Encode each planned (start, end, file_name, tags) segment of a decoded recording, yielding (file_name, tags, data).'''
+    for start, end, file_name, tags_ in plan:
+        with metrics.stage('encode', file_name) as record:
+            buffer = io.BytesIO()
+            audio[start:end].export(buffer, format='mp3', tags=tags_)
+            data = buffer.getvalue()
+            record['bytes'] = len(data)
+        yield file_name, tags_, data
+
+
+def _export_segments(audio, save_path:str, plan:list) -> list:
+    '''Export each planned (start, end, file_name, tags) segment of a decoded recording.'''
+    return _save_segments(save_path, _encode_segments(audio, plan))
+
+
+def _load_span(path:str, plan:list) -> tuple:
+    '''
+    Decode only the part of a recording that plan's segments cover.
+
+    returns:
+        - (audio, plan with start and end relative to the start of audio).
+    '''
+    start = min(segment[0] for segment in plan)
+    ends = [segment[1] for segment in plan]
+    end = None if None in ends else max(ends)
+    with metrics.stage('decode', os.path.basename(path).split('.')[0]):
+        audio = _load_window(path, start, end)
+    return audio, [(s - start, None if e is None else e - start, f, t) for s, e, f, t in plan]
+
+
+def _export_job(path:str, save_path:str, plan:list, mode:str = 'decode') -> tuple:
+    '''
+    Process pool entry point for one job of Splitter._split_parallel. In decode mode a job
+    decodes only the span its segments cover, so workers given jobs of the same recording
+    don't each decode all of it.
+
+    returns:
+        - (exported file names, metrics snapshot of the job) for the parent to merge.
+    '''
+    # The worker's totals start as a copy of the parent's, count this job alone
+    metrics.reset()
+    if mode == 'lossless':
+        with metrics.stage('index', os.path.basename(path).split('.')[0], bytes=os.path.getsize(path)):
+            frames = MP3Frames(path)
+        try:
+            names = _export_frames(frames, save_path, plan)
+        finally:
+            frames.close()
+    elif mode == 'streaming':
+        names = _export_windows(path, save_path, plan)
+    else:
+        audio, plan = _load_span(path, plan)
+        names = _export_segments(audio, save_path, plan)
+    return names, metrics.snapshot()
+
+
+def _prune_plan(segment_filter:SegmentFilter, path:str, plan:list, audio=None) -> list:
+    '''
+    Prune plan with segment_filter, one segment's window at a time. Windows are resampled
+    from audio if the recording is already decoded, and otherwise decoded on their own from
+    path, so streaming and lossless modes never hold more than one segment's PCM.
+    '''
+    sr = segment_filter.sr
+    if audio is None:
+        windows = (load_pcm(path, sr, start, end) for start, end, _, _ in plan)
+    else:
+        windows = (pcm_from_audio(audio[start:end], sr) for start, end, _, _ in plan)
+    with metrics.stage('filter', os.path.basename(path).split('.')[0]):
+        return segment_filter.prune(windows, plan, os.path.getsize(path))
+
+
+def _prune_job(path:str, plan:list, settings:dict) -> tuple:
+    '''
+    Process pool entry point pruning one plan of Splitter._split_parallel.
+
+    returns:
+        - (path, pruned plan, filter totals, metrics snapshot of the job) for the parent to merge.
+    '''
+    metrics.reset()
+    segment_filter = SegmentFilter(**settings)
+    plan = _prune_plan(segment_filter, path, plan)
+    return path, plan, segment_filter.summary(), metrics.snapshot()
+
+
+def _frames_duration(path:str) -> float:
+    '''Length of a recording in ms, from its frame index.'''
+    frames = MP3Frames(path)
+    duration = frames.duration_ms
+    frames.close()
+    return duration
+
+
+def _encode_frames(frames:MP3Frames, plan:list):
+    '''Lossless variant of _encode_segments: copy each planned window's frames as is.'''
+    for start, end, file_name, tags_ in plan:
+        with metrics.stage('copy', file_name) as record:
+            data = frames.segment(start, end, tags_)
+            record['bytes'] = len(data)
+        yield file_name, tags_, data
+
+
+def _export_frames(frames:MP3Frames, save_path:str, plan:list) -> list:
+    '''Lossless variant of _export_segments: copy each planned window's frames as is.'''
+    return _save_segments(save_path, _encode_frames(frames, plan))
+
+
+def _duration(path:str) -> float:
+    '''Length of a recording in ms, read by ffprobe without decoding it.'''
+    return float(mediainfo(path)['duration']) * 1000
+
+
+def _load_window(path:str, start:float, end:float):
+    '''
+    Decode only [start, end) ms of a recording. Unlike AudioSegment.from_file(start_second=...),
+    -ss goes before -i so ffmpeg seeks the input instead of decoding up to start and discarding it.
+    end of None decodes to the end of the recording.
+    '''
+    command = [AudioSegment.converter, '-v', 'error', '-ss', str(start / 1000), '-i', path]
+    if end is not None:
+        command += ['-t', str((end - start) / 1000)]
+    command += ['-vn', '-acodec', 'pcm_s16le', '-f', 'wav', '-']
+    p = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode != 0 or len(p.stdout) == 0:
+        raise CouldntDecodeError(f'Decoding {path} [{start}:{end}] failed:\n{p.stderr.decode(errors="ignore")}')
+    data = bytearray(p.stdout)
+    fix_wav_headers(data)
+    return AudioSegment(bytes(data))
+
+
+def _encode_windows(path:str, plan:list):
+    '''Streaming variant of _encode_segments: decode and encode one planned window at a time.'''
+    for start, end, file_name, tags_ in plan:
+        with metrics.stage('decode', file_name):
+            window = _load_window(path, start, end)
+        with metrics.stage('encode', file_name) as record:
+            buffer = io.BytesIO()
+            window.export(buffer, format='mp3', tags=tags_)
+            data = buffer.getvalue()
+            record['bytes'] = len(data)
+        yield file_name, tags_, data
+
+
+def _export_windows(path:str, save_path:str, plan:list) -> list:
+    '''Streaming variant of _export_segments: decode and export one planned window at a time.'''
+    return _save_segments(save_path, _encode_windows(path, plan))
 
 # if __name__ == '__main__':
 #     dunya_config = 'configs/dunya_config.json'
@@ -326,4 +800,33 @@ class Splitter(OSFunctionality):
 #     dir_path = 'data/andalusian'
 #     save_path = 'data/andalusian_crop'
 #     splitter = Splitter(dir_path, save_path, 3, 6, dunya_config)
-#     splitter.split()
\ No newline at end of file
+#     splitter.split()
+
+
+def prefetch(dataset:str, dunya_config:str, dir_path:str = None, N:int = None, start_from:int = 0, workers:int = 8):
+    '''
+    Fill the metadata cache for every recording in dir_path, or for N recordings of the
+    corpus listing starting at start_from, so a later Splitter(offline=True) needs no API.
+    '''
+    osf = OSFunctionality(dunya_config)
+    osf._authenticate()
+    if dir_path is not None:
+        mbids = sorted({f.split('.')[0] for f in os.listdir(dir_path) if f.split('.')[0] != ''})
+        osf._metadata_cache(dataset).prefetch(mbids, workers)
+        return
+    downloader = Downloader(N, dunya_config, dataset=dataset, start_from=start_from)
+    downloader.prefetch_metadata(workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prefetch Dunya metadata so splitting can run offline.')
+    parser.add_argument('--dataset', choices=['hindustani', 'andalusian'], required=True)
+    parser.add_argument('--dunya_config', default=os.path.join('configs', 'dunya_config.json'))
+    parser.add_argument('--dir_path', help='Prefetch the recordings downloaded to this directory')
+    parser.add_argument('--N', type=int, help='Otherwise prefetch this many recordings of the corpus listing')
+    parser.add_argument('--start_from', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=8)
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    prefetch(args.dataset, args.dunya_config, args.dir_path, args.N, args.start_from, args.workers)
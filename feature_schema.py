@@ -0,0 +1,98 @@
+'''
+Column registry for the audioAnalysisV6 result requested by cyaniteAPI.FEATURES_FRAGMENT.
+Every reader and writer of feature tables takes its column names and order from here.
+'''
+
+# Scalar fields holding a label rather than a score
+CATEGORICAL_FIELDS = ('energyLevel', 'energyDynamics', 'emotionalProfile', 'emotionalDynamics')
+# List-of-string fields
+TAG_FIELDS = ('moodTags', 'moodAdvancedTags', 'movementTags')
+# List of {mood, start, end} structs
+MOOD_MAX_TIMES = 'moodMaxTimes'
+
+MOOD_FIELDS = (
+    'aggressive', 'calm', 'chilled', 'dark', 'energetic', 'epic', 'happy', 'romantic',
+    'sad', 'scary', 'sexy', 'ethereal', 'uplifting',
+)
+
+MOOD_ADVANCED_FIELDS = (
+    'anxious', 'barren', 'cold', 'creepy', 'dark', 'disturbing', 'eerie', 'evil',
+    'fearful', 'mysterious', 'nervous', 'restless', 'spooky', 'strange', 'supernatural',
+    'suspenseful', 'tense', 'weird', 'aggressive', 'agitated', 'angry', 'dangerous',
+    'fiery', 'intense', 'passionate', 'ponderous', 'violent', 'comedic', 'eccentric',
+    'funny', 'mischievous', 'quirky', 'whimsical', 'boisterous', 'boingy', 'bright',
+    'celebratory', 'cheerful', 'excited', 'feelGood', 'fun', 'happy', 'joyous',
+    'lighthearted', 'perky', 'playful', 'rollicking', 'upbeat', 'calm', 'contented',
+    'dreamy', 'introspective', 'laidBack', 'leisurely', 'lyrical', 'peaceful', 'quiet',
+    'relaxed', 'serene', 'soothing', 'spiritual', 'tranquil', 'bittersweet', 'blue',
+    'depressing', 'gloomy', 'heavy', 'lonely', 'melancholic', 'mournful', 'poignant',
+    'sad', 'frightening', 'horror', 'menacing', 'nightmarish', 'ominous',
+    'panicStricken', 'scary', 'concerned', 'determined', 'dignified', 'emotional',
+    'noble', 'serious', 'solemn', 'thoughtful', 'cool', 'seductive', 'sexy',
+    'adventurous', 'confident', 'courageous', 'resolute', 'energetic', 'epic',
+    'exciting', 'exhilarating', 'heroic', 'majestic', 'powerful', 'prestigious',
+    'relentless', 'strong', 'triumphant', 'victorious', 'delicate', 'graceful',
+    'hopeful', 'innocent', 'intimate', 'kind', 'light', 'loving', 'nostalgic',
+    'reflective', 'romantic', 'sentimental', 'soft', 'sweet', 'tender', 'warm',
+    'anthemic', 'aweInspiring', 'euphoric', 'inspirational', 'motivational',
+    'optimistic', 'positive', 'proud', 'soaring', 'uplifting',
+)
+
+MOVEMENT_FIELDS = (
+    'bouncy', 'driving', 'flowing', 'groovy', 'nonrhythmic', 'pulsing', 'robotic',
+    'running', 'steady', 'stomping',
+)
+
+BPM_PREDICTION_FIELDS = ('value', 'confidence')
+
+# Nested score objects of the result, in query order
+SCORE_GROUPS = (
+    ('mood', MOOD_FIELDS),
+    ('moodAdvanced', MOOD_ADVANCED_FIELDS),
+    ('movement', MOVEMENT_FIELDS),
+)
+
+# Every nested object of the result, in query order
+NESTED_GROUPS = tuple(group for group, _ in SCORE_GROUPS) + ('bpmPrediction',)
+
+# Every float feature, flattened with '.' the way pd.json_normalize names them
+NUMERIC_COLUMNS = (
+    ('valence', 'arousal')
+    + tuple(f'{group}.{field}' for group, fields in SCORE_GROUPS for field in fields)
+    + tuple(f'bpmPrediction.{field}' for field in BPM_PREDICTION_FIELDS)
+    + ('bpmRangeAdjusted',)
+)
+
+# Columns of the flattened feature CSV, in the order pd.json_normalize lays them out:
+# top-level scalars first, then the nested objects
+CSV_COLUMNS = (
+    ('valence', 'arousal')
+    + CATEGORICAL_FIELDS
+    + ('bpmRangeAdjusted',)
+    + NUMERIC_COLUMNS[2:-1]
+)
+
+
+def numeric_row(result:dict) -> list:
+    '''Float features of one analysis result in NUMERIC_COLUMNS order, None where missing.'''
+    row = [result.get('valence'), result.get('arousal')]
+    for group, fields in SCORE_GROUPS:
+        scores = result.get(group) or {}
+        row.extend(scores.get(field) for field in fields)
+    bpm = result.get('bpmPrediction') or {}
+    row.extend(bpm.get(field) for field in BPM_PREDICTION_FIELDS)
+    row.append(result.get('bpmRangeAdjusted'))
+    return row
+
+
+def csv_layout(null_groups=()) -> tuple:
+    '''
+    CSV_COLUMNS as pd.json_normalize lays out a result whose null_groups are null rather
+    than objects: each such group is then a scalar, a single column named after it among
+    the top-level scalars (all of which but bpmRangeAdjusted come before it in the query),
+    and its fields are left out of the nested columns.
+    '''
+    scalars = [column for column in CSV_COLUMNS if '.' not in column]
+    nested = [column for column in CSV_COLUMNS if column.partition('.')[0] in NESTED_GROUPS]
+    scalars[-1:-1] = [group for group in NESTED_GROUPS if group in null_groups]
+    return tuple(scalars + [column for column in nested if column.partition('.')[0] not in null_groups])
@@ -0,0 +1,242 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from feature_schema import (
+    BPM_PREDICTION_FIELDS, CATEGORICAL_FIELDS, MOOD_MAX_TIMES, NUMERIC_COLUMNS, SCORE_GROUPS, TAG_FIELDS,
+    numeric_row
+)
+
+# Column of each numeric feature in FeatureTable.matrix
+COLUMN_INDEX = {name: i for i, name in enumerate(NUMERIC_COLUMNS)}
+# Contiguous matrix columns of each score group, so a group is a zero-copy slice
+GROUP_SLICES = {
+    group: slice(COLUMN_INDEX[f'{group}.{fields[0]}'], COLUMN_INDEX[f'{group}.{fields[-1]}'] + 1)
+    for group, fields in SCORE_GROUPS
+}
+# Code of a missing label
+MISSING = -1
+# Interned strings are stored as int16 codes into a per-field vocabulary
+CODE_DTYPE = np.int16
+# Vocabularies and the column registry of a saved table, next to one .npy per array
+META_FILE = 'table.json'
+# Fields stored as a variable-length list per track
+LIST_FIELDS = TAG_FIELDS + (MOOD_MAX_TIMES,)
+
+
+def _intern(values, vocabulary:dict) -> np.ndarray:
+    '''Codes of values in vocabulary, adding new strings as they come. None becomes MISSING.'''
+    codes = np.fromiter(
+        (MISSING if v is None else vocabulary.setdefault(v, len(vocabulary)) for v in values),
+        dtype=np.int64, count=len(values)
+    )
+    assert len(vocabulary) <= np.iinfo(CODE_DTYPE).max, 'Vocabulary too large for CODE_DTYPE'
+    return codes.astype(CODE_DTYPE)
+
+
+def _offsets(lengths) -> np.ndarray:
+    '''CSR offsets: row i's items are items[offsets[i]:offsets[i + 1]].'''
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+
+class TrackRecord:
+    '''
+    One track of a FeatureTable, read straight out of the table's arrays. Any feature
+    is available by name, e.g. record['mood.calm'], record['energyLevel'] or
+    record['moodTags'].
+    '''
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row:int):
+        self.table = table
+        self.row = row
+
+    @property
+    def filename(self) -> str:
+        return str(self.table.filenames[self.row])
+
+    def __getitem__(self, name:str):
+        table = self.table
+        if name in COLUMN_INDEX:
+            value = table.matrix[self.row, COLUMN_INDEX[name]]
+            return None if np.isnan(value) else float(value)
+        if name in CATEGORICAL_FIELDS:
+            return table.label(name, self.row)
+        if name in LIST_FIELDS:
+            return table.items(name, self.row)
+        raise KeyError(name)
+
+    def to_result(self) -> dict:
+        '''The track as the nested audioAnalysisV6 result it was built from.'''
+        result = {name: self[name] for name in ('valence', 'arousal') + CATEGORICAL_FIELDS}
+        for group, fields in SCORE_GROUPS:
+            result[group] = {field: self[f'{group}.{field}'] for field in fields}
+        result.update({field: self[field] for field in LIST_FIELDS})
+        result['bpmPrediction'] = {field: self[f'bpmPrediction.{field}'] for field in BPM_PREDICTION_FIELDS}
+        result['bpmRangeAdjusted'] = self['bpmRangeAdjusted']
+        return result
+
+    def __repr__(self):
+        return f'TrackRecord({self.filename!r})'
+
+
+class FeatureTable:
+    '''
+    Compact in-memory table of Cyanite results, one row per track. All float features
+    sit in one contiguous float32 matrix laid out by feature_schema.NUMERIC_COLUMNS, with
+    NaN where a score is missing. Labels and tags are interned into int16 codes against
+    a per-field vocabulary. Tag lists and moodMaxTimes are CSR arrays, i.e. a flat array
+    of items plus per-row offsets. column() and group() are views into the matrix, and
+    a table saved with save() is memory-mapped back by load().
+
+    params:
+        - arrays (dict): every array of the table by name, as built by from_results.
+        - vocabulary (dict): {field: list of strings} for each interned field.
+    '''
+    def __init__(self, arrays:dict, vocabulary:dict):
+        self.arrays = arrays
+        self.vocabulary = {field: list(strings) for field, strings in vocabulary.items()}
+        self.filenames = arrays['filenames']
+        self.matrix = arrays['matrix']
+        assert self.matrix.shape == (len(self.filenames), len(NUMERIC_COLUMNS)), 'Matrix does not match the column registry'
+        self._rows = None
+
+    @classmethod
+    def from_results(cls, filenames:list, results:list):
+        '''Build a table from audioAnalysisV6 result dicts. Files whose result is None are left out.'''
+        pairs = [(f, r) for f, r in zip(filenames, results) if r is not None]
+        filenames = [f for f, _ in pairs]
+        results = [r for _, r in pairs]
+        vocabulary = {field: {} for field in CATEGORICAL_FIELDS + LIST_FIELDS}
+
+        matrix = np.empty((len(results), len(NUMERIC_COLUMNS)), dtype=np.float32)
+        for i, result in enumerate(results):
+            # None converts to NaN
+            matrix[i] = numeric_row(result)
+        arrays = {'filenames': np.array(filenames, dtype=str), 'matrix': matrix}
+        for field in CATEGORICAL_FIELDS:
+            arrays[field] = _intern([r.get(field) for r in results], vocabulary[field])
+        for field in TAG_FIELDS:
+            tags = [r.get(field) or [] for r in results]
+            arrays[f'{field}.offsets'] = _offsets([len(t) for t in tags])
+            arrays[f'{field}.codes'] = _intern([tag for t in tags for tag in t], vocabulary[field])
+        times = [r.get(MOOD_MAX_TIMES) or [] for r in results]
+        arrays[f'{MOOD_MAX_TIMES}.offsets'] = _offsets([len(t) for t in times])
+        arrays[f'{MOOD_MAX_TIMES}.codes'] = _intern([m['mood'] for t in times for m in t], vocabulary[MOOD_MAX_TIMES])
+        arrays[f'{MOOD_MAX_TIMES}.times'] = np.array(
+            [(m['start'], m['end']) for t in times for m in t], dtype=np.float32
+        ).reshape(-1, 2)
+        return cls(arrays, {field: list(strings) for field, strings in vocabulary.items()})
+
+    @classmethod
+    def from_jsons(cls, files:list, jsons_dir:str):
+        '''Build a table from the classifier JSONs saved for audio files, e.g. the filename column of a segments CSV.'''
+        from parse_and_save_features import load_result
+        return cls.from_results(files, [load_result(jsons_dir, file_) for file_ in files])
+
+    @classmethod
+    def from_csv(cls, csv_path:str, jsons_dir:str):
+        return cls.from_jsons(pd.read_csv(csv_path)['filename'].tolist(), jsons_dir)
+
+    def save(self, path:str):
+        '''Write the table to a directory, one .npy per array.'''
+        os.makedirs(path, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(path, f'{name}.npy'), array)
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump({'columns': list(NUMERIC_COLUMNS), 'arrays': list(self.arrays), 'vocabulary': self.vocabulary}, f)
+
+    @classmethod
+    def load(cls, path:str, mmap_mode:str = 'r'):
+        '''
+        Open a table written by save(). With the default mmap_mode the arrays are
+        memory-mapped, so only the pages actually read are loaded. None reads them whole.
+        '''
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        assert tuple(meta['columns']) == NUMERIC_COLUMNS, f'{path} was saved with a different column registry'
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in meta['arrays']}
+        return cls(arrays, meta['vocabulary'])
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, row:int) -> TrackRecord:
+        if not -len(self) <= row < len(self):
+            raise IndexError(row)
+        return TrackRecord(self, row % len(self))
+
+    def __iter__(self):
+        return (TrackRecord(self, row) for row in range(len(self)))
+
+    def row(self, filename:str) -> int:
+        '''Row of a file, from an index built on first use.'''
+        if self._rows is None:
+            self._rows = {str(f): i for i, f in enumerate(self.filenames)}
+        return self._rows[filename]
+
+    def record(self, filename:str) -> TrackRecord:
+        return TrackRecord(self, self.row(filename))
+
+    def column(self, name:str) -> np.ndarray:
+        '''One numeric feature of every track, as a strided view of the matrix.'''
+        return self.matrix[:, COLUMN_INDEX[name]]
+
+    def group(self, group:str) -> np.ndarray:
+        '''The scores of 'mood', 'moodAdvanced' or 'movement', as a view of the matrix.'''
+        return self.matrix[:, GROUP_SLICES[group]]
+
+    def columns(self, names) -> np.ndarray:
+        '''Several numeric features as an (n, len(names)) array. A copy unless names are consecutive columns.'''
+        idx = [COLUMN_INDEX[name] for name in names]
+        if idx == list(range(idx[0], idx[0] + len(idx))):
+            return self.matrix[:, idx[0]:idx[-1] + 1]
+        return self.matrix[:, idx]
+
+    def codes(self, field:str) -> np.ndarray:
+        '''Interned codes of a categorical field, MISSING where the label is missing.'''
+        return self.arrays[field]
+
+    def label(self, field:str, row:int):
+        code = self.arrays[field][row]
+        return None if code == MISSING else self.vocabulary[field][code]
+
+    def labels(self, field:str) -> np.ndarray:
+        '''Labels of a categorical field for every track, None where missing.'''
+        strings = np.array(self.vocabulary[field] + [None], dtype=object)
+        # MISSING (-1) picks the trailing None
+        return strings[self.arrays[field]]
+
+    def items(self, field:str, row:int) -> list:
+        '''The tags of a TAG_FIELDS field, or the {mood, start, end} list of moodMaxTimes, of one track.'''
+        offsets = self.arrays[f'{field}.offsets']
+        start, end = offsets[row], offsets[row + 1]
+        strings = [self.vocabulary[field][c] for c in self.arrays[f'{field}.codes'][start:end]]
+        if field != MOOD_MAX_TIMES:
+            return strings
+        times = self.arrays[f'{field}.times'][start:end]
+        return [{'mood': m, 'start': float(s), 'end': float(e)} for m, (s, e) in zip(strings, times)]
+
+    def has_tag(self, field:str, tag:str) -> np.ndarray:
+        '''Boolean mask of the tracks whose TAG_FIELDS field contains tag.'''
+        mask = np.zeros(len(self), dtype=bool)
+        if tag not in self.vocabulary[field]:
+            return mask
+        offsets = self.arrays[f'{field}.offsets']
+        hits = np.flatnonzero(self.arrays[f'{field}.codes'] == self.vocabulary[field].index(tag))
+        # Row of each hit, from the offsets its position falls between
+        mask[np.searchsorted(offsets, hits, side='right') - 1] = True
+        return mask
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def to_frame(self) -> pd.DataFrame:
+        '''Filename, labels and numeric features as a DataFrame, like the feature CSV without the segment tags.'''
+        df = pd.DataFrame(self.matrix, columns=NUMERIC_COLUMNS)
+        for field in CATEGORICAL_FIELDS:
+            df[field] = self.labels(field)
+        df.insert(0, 'filename', self.filenames)
+        return df
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+# Stages a file moves through during a tagging run, in order
+STAGES = ('upload-requested', 'uploaded', 'track-created', 'features-fetched')
+
+
+class JobJournal:
+    '''
+    Append-only JSONL journal of a tagging run. Every stage a file reaches is written
+    and flushed before the next one starts, so a restarted run can replay the journal
+    and continue each file from its last completed stage.
+
+    params:
+        - path (str): path to the journal. Replayed if it already exists.
+    '''
+    def __init__(self, path:str = 'jobJournal.jsonl'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = {}
+        self._replay()
+        self._f = open(self.path, 'a')
+        # Terminate a partial last line so new entries start on their own line
+        if self._f.tell() > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._f.write('\n')
+
+    def _replay(self):
+        '''Fold existing entries into the latest state per file.'''
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-write can leave a partial last line
+                    continue
+                self._apply(entry)
+
+    def _apply(self, entry:dict):
+        state = self._state.get(entry['file'])
+        # A changed file starts over rather than inheriting the old ids
+        if state is None or state['sha256'] != entry['sha256']:
+            state = self._state[entry['file']] = {}
+        state.update(entry)
+
+    def state(self, file:str, sha256:str) -> dict:
+        '''
+        Latest journalled state of a file, e.g. {'stage': 'uploaded', 'uploadId': ...}.
+        Empty if the file was never seen or its content hash has changed since.
+        '''
+        with self._lock:
+            state = self._state.get(file, {})
+        if state.get('sha256') != sha256:
+            return {}
+        return dict(state)
+
+    def record(self, file:str, sha256:str, stage:str, **fields):
+        '''Durably append that a file reached a stage, with any ids needed to resume from it.'''
+        assert stage in STAGES, f'Unknown stage {stage}'
+        entry = {'file': file, 'sha256': sha256, 'stage': stage, 'timestamp': str(datetime.now()), **fields}
+        with self._lock:
+            self._f.write(json.dumps(entry) + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._apply(entry)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
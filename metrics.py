@@ -0,0 +1,206 @@
+import atexit
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Read once at import, so any stage can be measured without code changes
+JSONL_ENV = 'TAGGER_METRICS_JSONL'
+PROMETHEUS_ENV = 'TAGGER_METRICS_PROM'
+PROFILE_ENV = 'TAGGER_PROFILE'
+# Prefix of every Prometheus metric name
+NAMESPACE = 'tagger'
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Metrics:
+    '''
+    Per-file, per-stage timings, byte counts and error counters for the pipeline.
+    Every measured call is appended to a JSON lines file as it finishes, and the
+    per-stage totals can be written as a Prometheus text file. Both are off until
+    configure() gives them a path.
+
+    Pool workers forked after configure() append to the same JSON lines file. Their
+    totals reach the Prometheus file only if the parent merge()s their snapshot().
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self.jsonl_path = None
+        self.prometheus_path = None
+        self._f = None
+        self._pid = None
+
+    def configure(self, jsonl_path:str = None, prometheus_path:str = None):
+        '''Set where events and totals are written. None leaves a sink unchanged.'''
+        with self._lock:
+            if jsonl_path is not None:
+                self.jsonl_path = jsonl_path
+                self._f = None
+            if prometheus_path is not None:
+                self.prometheus_path = prometheus_path
+
+    @contextmanager
+    def stage(self, name:str, file:str = None, **fields):
+        '''
+        Time the block as one run of a stage for file. The yielded record can be
+        updated inside the block, e.g. record['bytes'] = size. An exception is
+        counted as an error of the stage and re-raised.
+        '''
+        record = {'stage': name, 'file': file, **fields}
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            self.observe(record)
+
+    def observe(self, record:dict):
+        '''Add a finished stage record to the totals and the JSON lines file.'''
+        with self._lock:
+            totals = self._stages.setdefault(record['stage'], _empty_totals())
+            totals['count'] += 1
+            totals['seconds'] += record.get('seconds', 0)
+            totals['bytes'] += record.get('bytes') or 0
+            totals['errors'] += 'error' in record
+            totals['durations'].append(record.get('seconds', 0))
+            self._write({'timestamp': str(datetime.now()), 'pid': os.getpid(), **record})
+
+    def count(self, name:str, n:int = 1):
+        '''Bump a free-standing counter, e.g. API throttles.'''
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+            self._write({'timestamp': str(datetime.now()), 'pid': os.getpid(), 'counter': name, 'n': n})
+
+    def _write(self, entry:dict):
+        if self.jsonl_path is None:
+            return
+        # A forked worker opens its own handle rather than sharing the parent's buffer
+        if self._f is None or self._pid != os.getpid():
+            self._f = open(self.jsonl_path, 'a', buffering=1)
+            self._pid = os.getpid()
+        self._f.write(json.dumps(entry) + '\n')
+
+    def snapshot(self) -> dict:
+        '''Copy of the totals, for a pool worker to hand back to its parent.'''
+        with self._lock:
+            return {
+                'stages': {name: {**t, 'durations': list(t['durations'])} for name, t in self._stages.items()},
+                'counters': dict(self._counters),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    def merge(self, snapshot:dict):
+        '''Fold another process's snapshot() into the totals, without re-writing its events.'''
+        with self._lock:
+            for name, other in snapshot['stages'].items():
+                totals = self._stages.setdefault(name, _empty_totals())
+                for key in ('count', 'seconds', 'bytes', 'errors'):
+                    totals[key] += other[key]
+                totals['durations'].extend(other['durations'])
+            for name, n in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def summary(self) -> dict:
+        '''Per-stage count, total seconds, bytes, errors and duration quantiles.'''
+        stages = {}
+        for name, totals in self.snapshot()['stages'].items():
+            durations = sorted(totals.pop('durations'))
+            totals['quantiles'] = {q: _quantile(durations, q) for q in QUANTILES}
+            stages[name] = totals
+        return stages
+
+    def prometheus(self) -> str:
+        '''Totals in the Prometheus text exposition format.'''
+        lines = [
+            f'# HELP {NAMESPACE}_stage_seconds Time spent per pipeline stage and file.',
+            f'# TYPE {NAMESPACE}_stage_seconds summary',
+        ]
+        summary = self.summary()
+        for name, totals in sorted(summary.items()):
+            for q, value in totals['quantiles'].items():
+                lines.append(f'{NAMESPACE}_stage_seconds{{stage="{name}",quantile="{q}"}} {value}')
+            lines.append(f'{NAMESPACE}_stage_seconds_sum{{stage="{name}"}} {totals["seconds"]}')
+            lines.append(f'{NAMESPACE}_stage_seconds_count{{stage="{name}"}} {totals["count"]}')
+        for metric, key, help_ in (
+            ('stage_bytes_total', 'bytes', 'Bytes read or written per pipeline stage.'),
+            ('stage_errors_total', 'errors', 'Failed runs per pipeline stage.'),
+        ):
+            lines += [f'# HELP {NAMESPACE}_{metric} {help_}', f'# TYPE {NAMESPACE}_{metric} counter']
+            lines += [f'{NAMESPACE}_{metric}{{stage="{name}"}} {t[key]}' for name, t in sorted(summary.items())]
+        counters = self.snapshot()['counters']
+        if counters:
+            lines += [f'# HELP {NAMESPACE}_events_total Pipeline event counters.', f'# TYPE {NAMESPACE}_events_total counter']
+            lines += [f'{NAMESPACE}_events_total{{event="{name}"}} {n}' for name, n in sorted(counters.items())]
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        '''Write the Prometheus file, if configured. Safe to call repeatedly, e.g. for node_exporter's textfile collector.'''
+        if self.prometheus_path is None:
+            return
+        with open(self.prometheus_path + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(self.prometheus_path + '.tmp', self.prometheus_path)
+
+
+def _empty_totals() -> dict:
+    return {'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0, 'durations': []}
+
+
+def _quantile(values:list, q:float) -> float:
+    '''Nearest-rank quantile of sorted values.'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+_profiler = None
+
+
+def start_profiling(path:str):
+    '''
+    Profile the calling thread with cProfile until exit, then dump the stats to path
+    (open with pstats, or snakeviz). Worker threads and processes are not profiled.
+    '''
+    global _profiler
+    if _profiler is not None:
+        return
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+    def dump():
+        _profiler.disable()
+        _profiler.dump_stats(path)
+    atexit.register(dump)
+
+
+def add_arguments(parser):
+    '''Add the --metrics, --prometheus and --profile flags to an argparse parser.'''
+    parser.add_argument('--metrics', help='Append per-file stage timings to this JSON lines file')
+    parser.add_argument('--prometheus', help='Write per-stage totals to this Prometheus text file on exit')
+    parser.add_argument('--profile', help='Dump cProfile stats of the run to this file')
+
+
+def configure_from_args(args):
+    '''Apply the flags added by add_arguments.'''
+    metrics.configure(args.metrics, args.prometheus)
+    if args.profile:
+        start_profiling(args.profile)
+
+
+metrics = Metrics()
+metrics.configure(os.getenv(JSONL_ENV), os.getenv(PROMETHEUS_ENV))
+if os.getenv(PROFILE_ENV):
+    start_profiling(os.getenv(PROFILE_ENV))
+atexit.register(metrics.flush)
@@ -1,6 +1,29 @@
+import hashlib
 import json
+import numpy as np
 import pandas as pd
 import os
+from concurrent.futures import ProcessPoolExecutor
+from feature_schema import (
+    CATEGORICAL_FIELDS, CSV_COLUMNS, MOOD_MAX_TIMES, NESTED_GROUPS, NUMERIC_COLUMNS, SCORE_GROUPS,
+    TAG_FIELDS, csv_layout, numeric_row
+)
+from metrics import metrics
+from mp3_frames import MP3Frames
+
+# orjson parses the ~160-float results several times faster when it's installed
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+# Rows per Arrow record batch when writing a feature dataset
+DATASET_BATCH_SIZE = 1024
+# Extension of the data files for each dataset format
+DATASET_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+# Result JSONs parsed per process-pool task
+PARSE_CHUNK_SIZE = 256
+
 
 def load_json(json_path):
     '''Load json and return json object.'''
@@ -9,6 +32,28 @@ def load_json(json_path):
     return j
 
 
+def result_path(jsons_dir, file_):
+    '''Path of the classifier JSON saved for an audio file.'''
+    return os.path.join(jsons_dir, file_.split('.')[0] + '.json')
+
+
+def parse_result(feature_json, file_):
+    '''Parse out the analysis result of a feature json, or None if it did not process in time.'''
+    try:
+        return feature_json['libraryTrack']['audioAnalysisV6']['result']
+    except (KeyError, TypeError):
+        print(f'Dropping {file_.split(".")[0]}: analysis has no result')
+        metrics.count('results_dropped')
+        return None
+
+
+def load_result(jsons_dir, file_):
+    '''Load the analysis result saved for an audio file, or None if it did not process in time.'''
+    path = result_path(jsons_dir, file_)
+    with metrics.stage('parse', file_, bytes=os.path.getsize(path)):
+        return parse_result(load_json(path), file_)
+
+
 def process_features(csv_path, jsons_dir, csv_save_path):
     '''Process features given the filename.'''
     df = pd.read_csv(csv_path)
@@ -16,15 +61,10 @@ def process_features(csv_path, jsons_dir, csv_save_path):
     drop = []
     for i in range(len(df)):
         # Get file, filename and load json
-        file_ = df['filename'][i]
-        filename = file_.split('.')[0]
-        json_path = filename + '.json'
-        feature_json = load_json(os.path.join(jsons_dir, json_path))
-        # Parse out results from feature json. If no result, it did not process in time.
-        try:
-            result = feature_json['libraryTrack']['audioAnalysisV6']['result']
+        result = load_result(jsons_dir, df['filename'][i])
+        if result is not None:
             jsons_.append(result)
-        except:
+        else:
             # Drop index in pain dataframe
             drop.append(i)
         # Convert jsons to dataframe, and save
@@ -33,7 +73,407 @@ def process_features(csv_path, jsons_dir, csv_save_path):
     df = df.drop(drop, axis=0).reset_index()
     df = df.join(feature_df)
     df = df.drop('index', axis=1)
-    df.to_csv(csv_save_path, index=None)
+    with metrics.stage('write', csv_save_path):
+        df.to_csv(csv_save_path, index=None)
+
+
+def _parse_chunk(paths, dtype):
+    '''
+    Parse a chunk of result JSONs straight into a preallocated score array.
+
+    returns:
+        - (keep, scores, labels, nulls, metrics): boolean mask of the files with a result,
+        their scores in NUMERIC_COLUMNS order (rows without a result are left unset), a
+        list of labels per CATEGORICAL_FIELDS entry, the NESTED_GROUPS each result has as
+        null, and the chunk's metrics snapshot.
+    '''
+    # The worker's totals start as a copy of the parent's, count this chunk alone
+    metrics.reset()
+    keep = np.zeros(len(paths), dtype=bool)
+    scores = np.empty((len(paths), len(NUMERIC_COLUMNS)), dtype=dtype)
+    labels = [[None] * len(paths) for _ in CATEGORICAL_FIELDS]
+    nulls = [()] * len(paths)
+    for i, path in enumerate(paths):
+        with metrics.stage('parse', os.path.basename(path)) as record, open(path, 'rb') as j:
+            data = j.read()
+            record['bytes'] = len(data)
+            feature_json = _loads(data)
+            try:
+                result = feature_json['libraryTrack']['audioAnalysisV6']['result']
+            except (KeyError, TypeError):
+                continue
+            keep[i] = True
+            scores[i] = numeric_row(result)
+            for field, column in zip(CATEGORICAL_FIELDS, labels):
+                column[i] = result.get(field)
+            nulls[i] = tuple(group for group in NESTED_GROUPS if group in result and result[group] is None)
+    return keep, scores, labels, nulls, metrics.snapshot()
+
+
+def parse_results_parallel(files, jsons_dir, workers=None, chunk_size=PARSE_CHUNK_SIZE, dtype=np.float32):
+    '''
+    Parse the result JSONs of many audio files across a process pool.
+
+    params:
+        - files (list): audio filenames, as in the CSV's filename column.
+        - workers (int): pool size, defaults to the number of CPUs.
+        - dtype: dtype of the score array.
+
+    returns:
+        - (keep, scores, labels, nulls): boolean mask over files of those with a result, a
+        (keep.sum(), len(NUMERIC_COLUMNS)) array of their scores in NUMERIC_COLUMNS
+        order, {field: list of labels} for CATEGORICAL_FIELDS, and per result the
+        NESTED_GROUPS it has as null rather than an object.
+    '''
+    paths = [result_path(jsons_dir, file_) for file_ in files]
+    keep = np.zeros(len(paths), dtype=bool)
+    scores = np.empty((len(paths), len(NUMERIC_COLUMNS)), dtype=dtype)
+    labels = [[None] * len(paths) for _ in CATEGORICAL_FIELDS]
+    nulls = [()] * len(paths)
+    starts = range(0, len(paths), chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunks = pool.map(_parse_chunk, [paths[s:s + chunk_size] for s in starts], [dtype] * len(starts))
+        for start, (chunk_keep, chunk_scores, chunk_labels, chunk_nulls, chunk_metrics) in zip(starts, chunks):
+            metrics.merge(chunk_metrics)
+            end = start + len(chunk_keep)
+            keep[start:end] = chunk_keep
+            scores[start:end] = chunk_scores
+            for column, chunk_column in zip(labels, chunk_labels):
+                column[start:end] = chunk_column
+            nulls[start:end] = chunk_nulls
+    for file_ in np.asarray(files, dtype=object)[~keep]:
+        print(f'Dropping {file_.split(".")[0]}: analysis has no result')
+        metrics.count('results_dropped')
+    labels = {field: [label for label, k in zip(column, keep) if k] for field, column in zip(CATEGORICAL_FIELDS, labels)}
+    nulls = [groups for groups, k in zip(nulls, keep) if k]
+    return keep, scores[keep], labels, nulls
+
+
+def process_features_parallel(csv_path, jsons_dir, csv_save_path, workers=None):
+    '''
+    process_features with the JSONs parsed across a process pool. Writes the same CSV,
+    built from the parsed arrays rather than pd.json_normalize.
+
+    A result with a null nested object gets from pd.json_normalize an extra, empty column
+    named after the object, and the columns follow the order in which each layout first
+    appears; the same layout is rebuilt here so the CSVs stay byte-identical.
+    '''
+    df = pd.read_csv(csv_path)
+    # float64 so the CSV carries the scores exactly as the serial path writes them
+    keep, scores, labels, nulls = parse_results_parallel(df['filename'].tolist(), jsons_dir, workers, dtype=np.float64)
+    feature_df = pd.DataFrame(scores, columns=NUMERIC_COLUMNS)
+    for field in CATEGORICAL_FIELDS:
+        feature_df[field] = labels[field]
+    columns = {}
+    for null_groups in dict.fromkeys(nulls):
+        columns.update(dict.fromkeys(csv_layout(null_groups)))
+    for group in NESTED_GROUPS:
+        if group in columns:
+            feature_df[group] = np.nan
+    df = df[keep].reset_index(drop=True).join(feature_df[list(columns)])
+    with metrics.stage('write', csv_save_path):
+        df.to_csv(csv_save_path, index=None)
+
+
+def load_manifest(manifest_path):
+    '''
+    Manifest of scanned result JSONs: {audio filename: {mtime, size, sha256, ingested}}, where
+    ingested says whether that version of the JSON had a result, i.e. is a row of the output.
+    '''
+    if not os.path.isfile(manifest_path):
+        return {}
+    return load_json(manifest_path)
+
+
+def _save_manifest(manifest, manifest_path):
+    with open(manifest_path + '.tmp', 'w') as j:
+        json.dump(manifest, j)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _scan_results(df, jsons_dir, manifest):
+    '''
+    Find the rows whose result JSON is new or has changed since it was recorded in the
+    manifest, updating the manifest as it goes. Unchanged mtime and size skip a file
+    without reading it; otherwise the sha256 decides.
+
+    returns:
+        - (rows, results, changed): CSV row positions with a result, their results, and
+        the filenames with a row from an older version of their JSON. A JSON first saved
+        without a result, e.g. before the analysis finished, has no row to replace.
+    '''
+    rows, results, changed = [], [], set()
+    for i, file_ in enumerate(df['filename']):
+        json_path = result_path(jsons_dir, file_)
+        try:
+            stat = os.stat(json_path)
+        except FileNotFoundError:
+            # Not tagged yet, pick it up on a later run
+            continue
+        entry = manifest.get(file_)
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            continue
+        with open(json_path, 'rb') as j:
+            data = j.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        record = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256}
+        if entry and entry['sha256'] == sha256:
+            # Touched but not changed
+            manifest[file_] = {**record, 'ingested': entry.get('ingested', True)}
+            continue
+        try:
+            result = parse_result(json.loads(data), file_)
+        except json.JSONDecodeError:
+            print(f'Skipping {file_}: result JSON is incomplete')
+            continue
+        # Manifests from before the flag don't say, so assume the row is there
+        if entry and entry.get('ingested', True):
+            changed.add(file_)
+        manifest[file_] = {**record, 'ingested': result is not None}
+        if result is not None:
+            rows.append(i)
+            results.append(result)
+    return rows, results, changed
+
+
+def process_features_incremental(csv_path, jsons_dir, csv_save_path, manifest_path=None):
+    '''
+    Incremental process_features. Only result JSONs that are new or changed since the
+    last run are parsed, tracked by a manifest next to the output. New rows are appended
+    to the CSV, which is only rewritten when a result already in it has changed or a
+    row the manifest doesn't list is already in it. Rows
+    whose JSON doesn't exist yet are left for a later run, so this can be re-run while
+    a tagging run is still saving results.
+
+    params:
+        - manifest_path (str): defaults to csv_save_path + '.manifest.json'.
+
+    returns:
+        - (added, replaced): number of new rows and of rows rewritten with a changed result.
+    '''
+    manifest_path = manifest_path or csv_save_path + '.manifest.json'
+    exists = os.path.isfile(csv_save_path)
+    # A manifest is only meaningful alongside the output it describes
+    manifest = load_manifest(manifest_path) if exists else {}
+    df = pd.read_csv(csv_path)
+    rows, results, changed = _scan_results(df, jsons_dir, manifest)
+    if results:
+        feature_df = pd.json_normalize(results)
+        feature_df = feature_df.drop(list(TAG_FIELDS) + [MOOD_MAX_TIMES], axis=1, errors='ignore')
+        new = df.iloc[rows].reset_index(drop=True).join(feature_df)
+    if exists and results:
+        # Rows the manifest doesn't know about may already be in the CSV, e.g. one written by
+        # process_features or by a run that stopped before saving its manifest. Replace them
+        existing = pd.read_csv(csv_save_path, usecols=['filename'])['filename']
+        changed |= set(new['filename'][new['filename'].isin(existing)])
+    if not exists:
+        if not results:
+            return 0, 0
+        new.to_csv(csv_save_path, index=None)
+    elif changed:
+        old = pd.read_csv(csv_save_path)
+        replaced = old['filename'].isin(changed)
+        out = pd.concat([old[~replaced], new], ignore_index=True) if results else old[~replaced]
+        out = out[old.columns]
+        out.to_csv(csv_save_path + '.tmp', index=None)
+        os.replace(csv_save_path + '.tmp', csv_save_path)
+    elif results:
+        header = pd.read_csv(csv_save_path, nrows=0).columns
+        new.reindex(columns=header).to_csv(csv_save_path, mode='a', header=False, index=None)
+    _save_manifest(manifest, manifest_path)
+    added = int((~new['filename'].isin(changed)).sum()) if results else 0
+    return added, len(changed)
+
+
+def dataset_schema(meta_schema, format='parquet'):
+    '''
+    Arrow schema of a feature dataset: the CSV's own columns followed by the analysis.
+    Labels are dictionary encoded in Parquet only. Each batch encodes its own dictionary,
+    and Arrow IPC files can't replace a field's dictionary between batches.
+    '''
+    import pyarrow as pa
+    label_type = pa.dictionary(pa.int32(), pa.string()) if format == 'parquet' else pa.string()
+    fields = list(meta_schema)
+    fields += [pa.field(name, pa.float32()) for name in NUMERIC_COLUMNS]
+    fields += [pa.field(name, label_type) for name in CATEGORICAL_FIELDS]
+    fields += [pa.field(name, pa.list_(pa.string())) for name in TAG_FIELDS]
+    max_time = pa.struct([('mood', pa.string()), ('start', pa.float32()), ('end', pa.float32())])
+    fields.append(pa.field(MOOD_MAX_TIMES, pa.list_(max_time)))
+    return pa.schema(fields)
+
+
+def _genre_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([('genre', pa.string())]), flavor='hive')
+
+
+def _record_batch(meta, results, meta_schema, schema):
+    '''One record batch from a slice of the CSV and the analysis results of its rows.'''
+    import pyarrow as pa
+    arrays = pa.RecordBatch.from_pandas(meta, schema=meta_schema, preserve_index=False).columns
+    scores = np.array([numeric_row(result) for result in results], dtype=np.float32)
+    # NaN marks a score missing from the response, and is stored as null
+    arrays += [pa.array(scores[:, j], from_pandas=True) for j in range(scores.shape[1])]
+    for name in CATEGORICAL_FIELDS:
+        labels = pa.array([result.get(name) for result in results], pa.string())
+        arrays.append(labels.dictionary_encode() if pa.types.is_dictionary(schema.field(name).type) else labels)
+    arrays += [pa.array([result.get(name) for result in results], pa.list_(pa.string())) for name in TAG_FIELDS]
+    arrays.append(pa.array([result.get(MOOD_MAX_TIMES) for result in results], schema.field(MOOD_MAX_TIMES).type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _feature_batches(df, jsons_dir, meta_schema, schema, batch_size):
+    '''Yield record batches of batch_size CSV rows, dropping rows without a result.'''
+    for start in range(0, len(df), batch_size):
+        meta = df.iloc[start:start + batch_size]
+        results = [load_result(jsons_dir, file_) for file_ in meta['filename']]
+        keep = [i for i, result in enumerate(results) if result is not None]
+        if keep:
+            yield _record_batch(meta.iloc[keep], [results[i] for i in keep], meta_schema, schema)
+
+
+def process_features_dataset(csv_path, jsons_dir, dataset_path, format='parquet', genre=None,
+                             batch_size=DATASET_BATCH_SIZE, compression='zstd'):
+    '''
+    Stream the features of every row in the CSV into a typed Arrow dataset partitioned by
+    genre (dataset_path/genre=<genre>/...). Scores are float32, labels are dictionary
+    encoded in Parquet and plain strings in Arrow IPC, and the tag lists and moodMaxTimes are kept as native list columns. Only
+    one batch of JSONs is held in memory at a time.
+
+    params:
+        - format (str): 'parquet' or 'arrow' (Feather v2 / Arrow IPC files).
+        - genre (str): genre of every row, for a CSV without a genre column.
+        - compression (str): codec for the data files. Uncompressed 'arrow' files can be
+        read zero-copy from a memory map.
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    df = pd.read_csv(csv_path)
+    if 'genre' not in df.columns:
+        df['genre'] = genre or 'unknown'
+    meta_schema = pa.Schema.from_pandas(df, preserve_index=False)
+    schema = dataset_schema(meta_schema, format)
+    file_format = ds.ParquetFileFormat() if format == 'parquet' else ds.IpcFileFormat()
+    ds.write_dataset(
+        _feature_batches(df, jsons_dir, meta_schema, schema, batch_size),
+        dataset_path,
+        schema=schema,
+        format=file_format,
+        file_options=file_format.make_write_options(compression=compression),
+        partitioning=_genre_partitioning(),
+        basename_template='part-{i}.' + DATASET_EXTENSIONS[format],
+        existing_data_behavior='delete_matching',
+    )
+
+
+def load_features(dataset_path, columns=None, filter=None, format='parquet'):
+    '''
+    Read a dataset written by process_features_dataset as an Arrow table. Files are
+    memory-mapped and only the requested columns, and the partitions matching filter
+    (e.g. pyarrow.dataset.field('genre') == 'hindustani'), are read.
+    '''
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+    dataset = ds.dataset(
+        dataset_path,
+        format='parquet' if format == 'parquet' else 'ipc',
+        partitioning=_genre_partitioning(),
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def recording_ids(filenames):
+    '''mbid of each segment file, from the <mbid>_<i>.mp3 names Splitter gives them.'''
+    return pd.Series(filenames).str.rsplit('.', n=1).str[0].str.rsplit('_', n=1).str[0].to_numpy()
+
+
+def segment_durations(segments_dir, filenames):
+    '''Duration in ms of each segment file, read from its MP3 frame index without decoding.'''
+    durations = np.empty(len(filenames))
+    for i, file_ in enumerate(filenames):
+        frames = MP3Frames(os.path.join(segments_dir, file_))
+        durations[i] = frames.duration_ms
+        frames.close()
+    return durations
+
+
+def _most_frequent(codes, values):
+    '''Most frequent non-null value per group code (ties go to the first seen), indexed by code.'''
+    counts = pd.DataFrame({'code': codes, 'value': values}).dropna()
+    counts = counts.groupby(['code', 'value'], sort=False).size().rename('n').reset_index()
+    counts = counts.sort_values('n', ascending=False, kind='stable')
+    return counts.drop_duplicates('code').set_index('code')['value']
+
+
+def aggregate_by_recording(features, durations=None):
+    '''
+    Roll segment features up to one row per recording (mbid) with vectorized group-bys.
+
+    params:
+        - features (pd.DataFrame): segment rows, as written by process_features or read back
+        with load_features(...).to_pandas(). List columns such as moodTags are used when present.
+        - durations (array): duration of each segment, for the weighted profile. Defaults
+        to a 'duration' column if there is one, otherwise every segment weighs the same.
+
+    returns:
+        - pd.DataFrame indexed by mbid with n_segments, the first value of each metadata
+        column (genre, forms, ...), <feature>_mean, <feature>_max and <feature>_weighted
+        for every score, the most frequent label of each categorical field, the dominant
+        mood/moodAdvanced/movement (argmax of the weighted profile, None without any score)
+        and, with tag columns, the most frequent tag of each.
+    '''
+    mbids, codes = np.unique(recording_ids(features['filename']), return_inverse=True)
+    numeric = [c for c in NUMERIC_COLUMNS if c in features.columns]
+    scores = features[numeric].to_numpy(dtype=np.float64)
+    if durations is None:
+        durations = features['duration'].to_numpy(dtype=np.float64) if 'duration' in features.columns else np.ones(len(features))
+    weights = np.asarray(durations, dtype=np.float64)[:, None]
+    # Missing scores drop out of both the weighted sum and its normaliser
+    present = ~np.isnan(scores)
+    weighted_sum = pd.DataFrame(np.where(present, scores * weights, 0)).groupby(codes).sum().to_numpy()
+    weight_sum = pd.DataFrame(np.where(present, weights, 0)).groupby(codes).sum().to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weighted = weighted_sum / weight_sum
+    grouped = pd.DataFrame(scores, columns=numeric).groupby(codes)
+    mean, max_ = grouped.mean().to_numpy(), grouped.max().to_numpy()
+
+    skip = set(numeric) | set(CATEGORICAL_FIELDS) | set(TAG_FIELDS) | {MOOD_MAX_TIMES, 'filename', 'duration'}
+    meta = [c for c in features.columns if c not in skip]
+    out = features[meta].groupby(codes).first()
+    out.insert(0, 'n_segments', np.bincount(codes))
+    columns = {f'{c}_{stat}': values[:, j] for stat, values in (('mean', mean), ('max', max_), ('weighted', weighted)) for j, c in enumerate(numeric)}
+    for field in CATEGORICAL_FIELDS:
+        if field in features.columns:
+            columns[field] = _most_frequent(codes, features[field].to_numpy(dtype=object))
+    for group, fields in SCORE_GROUPS:
+        group_fields = [field for field in fields if f'{group}.{field}' in numeric]
+        if group_fields:
+            profile = weighted[:, [numeric.index(f'{group}.{field}') for field in group_fields]]
+            dominant = np.asarray(group_fields, dtype=object)[np.nan_to_num(profile, nan=-np.inf).argmax(axis=1)]
+            # A recording with no score in the group has no dominant one
+            dominant[np.isnan(profile).all(axis=1)] = None
+            columns[f'dominant_{group}'] = dominant
+    for field in TAG_FIELDS:
+        if field in features.columns:
+            # Exploded on a positional index, so each tag maps back to its row's code whatever the frame's index
+            tags = features[field].reset_index(drop=True).explode()
+            columns[f'{field}_top'] = _most_frequent(codes[tags.index.to_numpy()], tags.to_numpy(dtype=object))
+    # One concat rather than hundreds of column inserts
+    out = pd.concat([out, pd.DataFrame(columns, index=out.index)], axis=1)
+    out.index = pd.Index(mbids, name='mbid')
+    return out
+
+
+def process_recording_features(features_csv_path, csv_save_path, segments_dir=None):
+    '''
+    Aggregate a segment feature CSV to one row per recording. Given segments_dir, the
+    weighted profile weighs each segment by its duration read from the MP3.
+    '''
+    features = pd.read_csv(features_csv_path)
+    durations = segment_durations(segments_dir, features['filename']) if segments_dir else None
+    aggregate_by_recording(features, durations).to_csv(csv_save_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import csv
+import os
+import queue
+import threading
+
+import cyaniteAPI
+import parse_and_save_features
+from dunya_functionality import METADATA_TTL, Downloader, Splitter
+from metrics import add_arguments, configure_from_args
+
+# Marks the end of a stage's output on a queue
+DONE = None
+
+
+class Pipeline:
+    '''
+    Runs download -> split -> tag -> parse as one streaming pipeline. Stages are joined
+    by bounded queues, so a recording is split as soon as it is downloaded, its segments
+    start uploading while later recordings are still downloading, and a slow stage
+    backs up into the one before it instead of piling up work on disk.
+
+    Every stage keeps its own resume behaviour: downloaded recordings are skipped, the
+    tagging journal and track index skip finished segments, and parsing is incremental.
+
+    params:
+        - dataset (str): 'hindustani' or 'andalusian'.
+        - dunya_config (str): path to dunya config for authentication.
+        - N (int): number of recordings to take from the corpus listing.
+        - start_from (int): offset into the corpus listing.
+        - len_minutes_crop (float): length in minutes of each segment.
+        - len_large_segment (float): length in minutes above which an andalusian section is split further.
+        - data_dir (str): where recordings are downloaded, data/<dataset> by default.
+        - segments_dir (str): where segments are saved, data/<dataset>_crop by default.
+        - segments_csv (str): CSV of every segment and its tags, csvs/<dataset>_crop.csv by default.
+        - features_csv (str): feature CSV, csvs/<dataset>_features.csv by default.
+        - download_workers (int): recordings downloaded at once.
+        - split_workers (int): recordings split at once.
+        - queue_size (int): capacity of the queues between download, split and tag.
+        - concurrency (int): files in a Cyanite network stage at once.
+        - upload_workers (int): uploads running at once.
+        - batch_size (int): tracks per feature query.
+        - in_flight (int): segments being tagged at once, from upload until features arrive.
+        - parse_every (int): refresh the feature CSV after this many tagged segments.
+        - webhook_port (int): wait for Cyanite webhooks on this port instead of polling.
+        - streaming, lossless (bool): Splitter modes.
+        - in_memory (bool): hand encoded segments to the uploader as buffers instead of through segments_dir.
+        Up to queue_size + in_flight segments are held in memory at once.
+        - archive (bool): with in_memory, still write every segment to segments_dir.
+        - prune_silence, prune_duplicates (bool): skip silent or repeated segments before upload.
+    '''
+    def __init__(
+        self,
+        dataset:str,
+        dunya_config:str,
+        N:int,
+        start_from:int = 0,
+        len_minutes_crop:float = 3,
+        len_large_segment:float = 6,
+        data_dir:str = None,
+        segments_dir:str = None,
+        segments_csv:str = None,
+        features_csv:str = None,
+        download_workers:int = 4,
+        split_workers:int = 2,
+        queue_size:int = 8,
+        concurrency:int = 8,
+        upload_workers:int = cyaniteAPI.UPLOAD_WORKERS,
+        batch_size:int = cyaniteAPI.BATCH_SIZE,
+        in_flight:int = 64,
+        parse_every:int = 100,
+        streaming:bool = False,
+        lossless:bool = False,
+        metadata_ttl:float = METADATA_TTL,
+        webhook_port:int = None,
+        in_memory:bool = False,
+        archive:bool = False,
+        prune_silence:bool = False,
+        prune_duplicates:bool = False,
+    ):
+        self.dataset = dataset
+        self.data_dir = data_dir or os.path.join('data', dataset)
+        self.segments_dir = segments_dir or os.path.join('data', f'{dataset}_crop')
+        self.segments_csv = segments_csv or os.path.join('csvs', f'{dataset}_crop.csv')
+        self.features_csv = features_csv or os.path.join('csvs', f'{dataset}_features.csv')
+        self.download_workers = download_workers
+        self.split_workers = split_workers
+        self.concurrency = concurrency
+        self.upload_workers = upload_workers
+        self.batch_size = batch_size
+        self.in_flight = in_flight
+        self.parse_every = parse_every
+        self.webhook_port = webhook_port
+        self.in_memory = in_memory
+        self.archive = archive
+
+        # Downloader and Splitter create the folders they write to, but not their parents
+        for path in (os.path.dirname(self.data_dir), os.path.dirname(self.segments_dir), os.path.dirname(self.segments_csv)):
+            if path:
+                os.makedirs(path, exist_ok=True)
+        # Downloader authenticates, so the Splitter can reuse its token
+        self.downloader = Downloader(
+            N, dunya_config, dataset, start_from=start_from, metadata_ttl=metadata_ttl,
+            **{f'path_to_{dataset}': self.data_dir}
+        )
+        self.splitter = Splitter(
+            self.data_dir, self.segments_dir, len_minutes_crop, len_large_segment, dunya_config,
+            streaming=streaming, lossless=lossless, metadata_ttl=metadata_ttl,
+            prune_silence=prune_silence, prune_duplicates=prune_duplicates
+        )
+
+        self._split_queue = queue.Queue(maxsize=queue_size)
+        self._tag_queue = queue.Queue(maxsize=queue_size)
+        self._parse_queue = queue.Queue()
+        self._csv_lock = threading.Lock()
+        self._csv_columns = None
+        self._known_segments = set()
+        # Set when a stage fails for good, so the stages feeding it stop instead of blocking on a full queue
+        self._stop = threading.Event()
+        self.failed = []
+
+    def _put(self, q:queue.Queue, item) -> bool:
+        '''Put item on q, blocking while it is full. Returns False without putting it if the pipeline was stopped.'''
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _download(self, entries:queue.Queue):
+        '''Download worker: fetch recordings until the listing is exhausted.'''
+        while not self._stop.is_set():
+            try:
+                entry = entries.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                mbid = self.downloader._download_one(entry)
+            except Exception as e:
+                print(f'Failed to download {entry["title"]}: {e!r}')
+                self.failed.append(('download', entry['mbid'], repr(e)))
+                continue
+            # Blocks while the splitter is behind
+            if not self._put(self._split_queue, f'{mbid}.mp3'):
+                return
+
+    def _split(self):
+        '''Split worker: cut each downloaded recording and queue its segments for tagging.'''
+        while not self._stop.is_set():
+            try:
+                file = self._split_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if file is DONE:
+                return
+            try:
+                if self.in_memory:
+                    # Each segment is queued as soon as it is encoded, without touching disk
+                    for file_name, tags_, data in self.splitter.iter_segments(file, self.dataset, self.archive):
+                        self._append_segments([(file_name, tags_)])
+                        if not self._put(self._tag_queue, (file_name, data)):
+                            return
+                    continue
+                plan = self.splitter.split_file(file, self.dataset)
+            except Exception as e:
+                print(f'Failed to split {file}: {e!r}')
+                self.failed.append(('split', file, repr(e)))
+                continue
+            self._append_segments([(file_name, tags_) for _, _, file_name, tags_ in plan])
+            for _, _, file_name, _ in plan:
+                if not self._put(self._tag_queue, file_name):
+                    return
+
+    def _append_segments(self, segments:list):
+        '''Add (file_name, tags) segments to segments_csv, with their tags as columns. Segments already listed by an earlier run are skipped.'''
+        rows = [{'filename': file_name, **tags_} for file_name, tags_ in segments]
+        if not rows:
+            return
+        with self._csv_lock:
+            if self._csv_columns is None:
+                if os.path.isfile(self.segments_csv):
+                    with open(self.segments_csv, 'r', newline='') as f:
+                        reader = csv.DictReader(f)
+                        self._known_segments = {row['filename'] for row in reader}
+                        self._csv_columns = reader.fieldnames
+                else:
+                    self._csv_columns = list(rows[0])
+                    with open(self.segments_csv, 'w', newline='') as f:
+                        csv.writer(f).writerow(self._csv_columns)
+            with open(self.segments_csv, 'a', newline='') as f:
+                writer = csv.DictWriter(f, self._csv_columns, extrasaction='ignore')
+                writer.writerows(row for row in rows if row['filename'] not in self._known_segments)
+            self._known_segments.update(row['filename'] for row in rows)
+
+    def _tag(self):
+        '''Tag stage: one event loop tagging segments as they come off the split queue. If it fails, the pipeline stops.'''
+        try:
+            asyncio.run(cyaniteAPI.startProcessQueue(
+                self.segments_dir, self._tag_queue, self.concurrency, self.upload_workers, self.batch_size,
+                self.in_flight, onDone=lambda file, result: self._parse_queue.put(file), webhook_port=self.webhook_port
+            ))
+        except Exception as e:
+            print(f'Tagging failed, stopping the pipeline: {e!r}')
+            self.failed.append(('tag', self.segments_dir, repr(e)))
+            self._stop.set()
+
+    def _parse(self):
+        '''Parse stage: fold newly tagged segments into the feature CSV every parse_every files.'''
+        pending = 0
+        while True:
+            file = self._parse_queue.get()
+            if file is not DONE:
+                pending += 1
+                if pending < self.parse_every:
+                    continue
+            if pending:
+                with self._csv_lock:
+                    added, replaced = parse_and_save_features.process_features_incremental(
+                        self.segments_csv, 'classifierResults', self.features_csv
+                    )
+                print(f'Feature CSV refreshed: {added} rows added, {replaced} replaced')
+                pending = 0
+            if file is DONE:
+                return
+
+    def run(self):
+        entries = queue.Queue()
+        for entry in self.downloader._get_recordings()[self.downloader.start_from:self.downloader.N + self.downloader.start_from]:
+            entries.put(entry)
+
+        downloaders = [threading.Thread(target=self._download, args=(entries,)) for _ in range(self.download_workers)]
+        splitters = [threading.Thread(target=self._split) for _ in range(self.split_workers)]
+        tagger = threading.Thread(target=self._tag)
+        parser = threading.Thread(target=self._parse)
+        for thread in downloaders + splitters + [tagger, parser]:
+            thread.start()
+
+        # Close each stage once everything feeding it has finished. After a failure the
+        # stages before it have stopped on their own, and the parser still folds in what was tagged
+        for thread in downloaders:
+            thread.join()
+        for _ in splitters:
+            self._put(self._split_queue, DONE)
+        for thread in splitters:
+            thread.join()
+        self._put(self._tag_queue, DONE)
+        tagger.join()
+        self._parse_queue.put(DONE)
+        parser.join()
+
+        if self.splitter.segment_filter is not None:
+            self.splitter.segment_filter.report()
+        for stage, item, error in self.failed:
+            print(f'{stage} failed for {item}: {error}')
+        if self._stop.is_set():
+            print(f'Pipeline stopped early. Features tagged so far are saved to {self.features_csv}, rerun to resume')
+        else:
+            print(f'Pipeline completed. Features saved to {self.features_csv}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download, split, tag and parse a Dunya corpus as one streaming pipeline.')
+    parser.add_argument('--dataset', choices=['hindustani', 'andalusian'], required=True)
+    parser.add_argument('--dunya_config', default=os.path.join('configs', 'dunya_config.json'))
+    parser.add_argument('--N', type=int, required=True, help='Number of recordings to process')
+    parser.add_argument('--start_from', type=int, default=0)
+    parser.add_argument('--len_minutes_crop', type=float, default=3, help='Segment length in minutes')
+    parser.add_argument('--len_large_segment', type=float, default=6, help='Andalusian sections longer than this many minutes are split further')
+    parser.add_argument('--data_dir')
+    parser.add_argument('--segments_dir')
+    parser.add_argument('--segments_csv')
+    parser.add_argument('--features_csv')
+    parser.add_argument('--download_workers', type=int, default=4)
+    parser.add_argument('--split_workers', type=int, default=2)
+    parser.add_argument('--queue_size', type=int, default=8, help='Capacity of the queues between stages')
+    parser.add_argument('--concurrency', type=int, default=8, help='Files in a Cyanite network stage at once')
+    parser.add_argument('--upload_workers', type=int, default=cyaniteAPI.UPLOAD_WORKERS)
+    parser.add_argument('--batch_size', type=int, default=cyaniteAPI.BATCH_SIZE, help='Tracks fetched per feature query')
+    parser.add_argument('--in_flight', type=int, default=64, help='Segments being tagged at once')
+    parser.add_argument('--parse_every', type=int, default=100, help='Refresh the feature CSV after this many tagged segments')
+    parser.add_argument('--rate', type=float, default=cyaniteAPI.API_RATE, help='Max Cyanite API requests per second')
+    parser.add_argument('--webhook_port', type=int, default=None, help='Wait for Cyanite analysis webhooks on this port instead of polling')
+    parser.add_argument('--streaming', action='store_true', help='Decode only the segment windows when splitting')
+    parser.add_argument('--lossless', action='store_true', help='Cut segments on MP3 frame boundaries without re-encoding')
+    parser.add_argument('--in_memory', action='store_true', help='Upload segments straight from memory instead of writing them to --segments_dir')
+    parser.add_argument('--archive', action='store_true', help='With --in_memory, still write segments to --segments_dir')
+    parser.add_argument('--prune_silence', action='store_true', help='Skip segments that are mostly silence')
+    parser.add_argument('--prune_duplicates', action='store_true', help='Skip segments that repeat an earlier segment of the same recording')
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    cyaniteAPI.setRateLimit(args.rate)
+
+    Pipeline(
+        args.dataset, args.dunya_config, args.N, args.start_from, args.len_minutes_crop, args.len_large_segment,
+        args.data_dir, args.segments_dir, args.segments_csv, args.features_csv,
+        args.download_workers, args.split_workers, args.queue_size, args.concurrency, args.upload_workers,
+        args.batch_size, args.in_flight, args.parse_every, args.streaming, args.lossless,
+        webhook_port=args.webhook_port, in_memory=args.in_memory, archive=args.archive,
+        prune_silence=args.prune_silence, prune_duplicates=args.prune_duplicates,
+    ).run()
@@ -0,0 +1,129 @@
+import asyncio
+import random
+import threading
+import time
+
+# Error kinds a classifier can report. Only the first two are ever retried.
+THROTTLE = 'throttle'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+
+class TokenBucket:
+    '''
+    Token bucket shared by every thread and coroutine calling one API. Callers block
+    until a token is free, and a throttle response pauses the whole bucket so every
+    caller backs off together instead of each hammering the API on its own.
+
+    params:
+        - rate (float): tokens added per second.
+        - burst (int): bucket capacity, i.e. calls allowed back to back.
+    '''
+    def __init__(self, rate:float, burst:int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        '''Take a token if one is free. Otherwise return the seconds to wait before retrying.'''
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._reserve()
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._reserve()
+
+    def pause(self, seconds:float):
+        '''Hand out no tokens for the next `seconds`, e.g. after a 429.'''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class RetryStats:
+    '''Thread-safe counters of calls, throttles, retries and final failures.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'calls': 0, 'throttles': 0, 'retries': 0, 'failures': 0}
+
+    def add(self, name:str, n:int = 1):
+        with self._lock:
+            self._counts[name] += n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+
+def _retry_delay(error, attempt, classify, limiter, stats, retry_on, max_attempts, base_delay, max_delay):
+    '''Decide what to do with a failed attempt: return the backoff delay, or re-raise.'''
+    kind, retry_after = classify(error)
+    if kind == THROTTLE:
+        stats.add('throttles')
+    if kind not in retry_on or attempt >= max_attempts:
+        stats.add('failures')
+        raise error
+    stats.add('retries')
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    delay = retry_after if retry_after is not None else delay / 2 + random.uniform(0, delay / 2)
+    if kind == THROTTLE and limiter is not None:
+        limiter.pause(delay)
+    return delay
+
+
+def retry(fn, classify, limiter=None, stats=None, retry_on=(THROTTLE, TRANSIENT),
+          max_attempts:int = 6, base_delay:float = 1, max_delay:float = 60):
+    '''
+    Call fn() under the limiter, retrying the error kinds in retry_on with jittered
+    exponential backoff (or the server's Retry-After, when classify reports one).
+
+    params:
+        - fn (callable): zero-argument call to make.
+        - classify (callable): maps an exception to (kind, retry_after or None).
+        - limiter (TokenBucket): bucket to take a token from before each attempt.
+        - stats (RetryStats): counters to update.
+    '''
+    stats = stats if stats is not None else RetryStats()
+    for attempt in range(1, max_attempts + 1):
+        if limiter is not None:
+            limiter.acquire()
+        stats.add('calls')
+        try:
+            return fn()
+        except Exception as e:
+            delay = _retry_delay(e, attempt, classify, limiter, stats, retry_on, max_attempts, base_delay, max_delay)
+        time.sleep(delay)
+
+
+async def retry_async(fn, classify, limiter=None, stats=None, retry_on=(THROTTLE, TRANSIENT),
+                      max_attempts:int = 6, base_delay:float = 1, max_delay:float = 60):
+    '''Async variant of retry. fn() must return a fresh awaitable on every call.'''
+    stats = stats if stats is not None else RetryStats()
+    for attempt in range(1, max_attempts + 1):
+        if limiter is not None:
+            await limiter.acquire_async()
+        stats.add('calls')
+        try:
+            return await fn()
+        except Exception as e:
+            delay = _retry_delay(e, attempt, classify, limiter, stats, retry_on, max_attempts, base_delay, max_delay)
+        await asyncio.sleep(delay)
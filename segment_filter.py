@@ -0,0 +1,242 @@
+import subprocess
+import threading
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+
+from metrics import metrics
+
+# Recordings are analysed as 8 kHz mono, enough for loudness and a coarse spectrum
+SAMPLE_RATE = 8000
+# Samples per analysis frame (128 ms at SAMPLE_RATE), also the FFT size
+FRAME_SIZE = 1024
+# Log-spaced bands of the fingerprint spectrum, in Hz
+N_BANDS = 32
+BAND_RANGE = (60, 4000)
+# Coarse time-frequency envelope of the fingerprint: bands x time bins
+ENVELOPE_SHAPE = (8, 16)
+# A frame quieter than this (dBFS) counts as silence
+SILENCE_DB = -50.0
+# A segment with less than this fraction of non-silent frames is silent
+MIN_ACTIVE = 0.1
+# Cosine similarity of fingerprints above which a segment repeats an earlier one
+DUPLICATE_SIMILARITY = 0.995
+
+
+def load_pcm(path:str, sr:int = SAMPLE_RATE, start:float = None, end:float = None) -> np.ndarray:
+    '''
+    Decode a recording, or only [start, end) ms of it, to mono float32 samples in [-1, 1]
+    at sr, resampled by ffmpeg. The input is seeked, so a window costs only its own decode.
+    '''
+    command = [AudioSegment.converter, '-v', 'error']
+    if start:
+        command += ['-ss', str(start / 1000)]
+    command += ['-i', path]
+    if end is not None:
+        command += ['-t', str((end - (start or 0)) / 1000)]
+    command += ['-vn', '-ac', '1', '-ar', str(sr), '-f', 's16le', '-']
+    p = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise CouldntDecodeError(f'Decoding {path} failed:\n{p.stderr.decode(errors="ignore")}')
+    return np.frombuffer(p.stdout, dtype=np.int16).astype(np.float32) / 32768
+
+
+def pcm_from_audio(audio:AudioSegment, sr:int = SAMPLE_RATE) -> np.ndarray:
+    '''load_pcm for a recording that is already decoded: mono float32 samples in [-1, 1] at sr.'''
+    audio = audio.set_channels(1).set_frame_rate(sr)
+    return np.asarray(audio.get_array_of_samples(), dtype=np.float32) / (1 << (8 * audio.sample_width - 1))
+
+
+def frames(samples:np.ndarray, frame_size:int = FRAME_SIZE) -> np.ndarray:
+    '''Non-overlapping frames of samples as an (n_frames, frame_size) view. The remainder is dropped.'''
+    n = len(samples) // frame_size
+    return samples[:n * frame_size].reshape(n, frame_size)
+
+
+def frame_db(framed:np.ndarray) -> np.ndarray:
+    '''RMS level of each frame in dBFS.'''
+    rms = np.sqrt(np.mean(np.square(framed, dtype=np.float64), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def band_edges(sr:int = SAMPLE_RATE, frame_size:int = FRAME_SIZE, n_bands:int = N_BANDS) -> np.ndarray:
+    '''FFT bin indices bounding n_bands log-spaced bands over BAND_RANGE.'''
+    low, high = BAND_RANGE
+    hz = np.geomspace(low, min(high, sr / 2), n_bands + 1)
+    return np.unique(np.round(hz * frame_size / sr).astype(int))
+
+
+def _zscore(x:np.ndarray) -> np.ndarray:
+    x = x - x.mean()
+    norm = np.linalg.norm(x)
+    return x / norm if norm > 0 else x
+
+
+def fingerprint(framed:np.ndarray, edges:np.ndarray) -> np.ndarray:
+    '''
+    Unit-length spectral fingerprint of a segment: the mean and spread of its log band
+    energies, and a coarse envelope of how they evolve over the segment. Each part is
+    normalised on its own, so a change in overall gain doesn't change the fingerprint.
+    '''
+    power = np.square(np.abs(np.fft.rfft(framed * np.hanning(framed.shape[1]), axis=1)))
+    bands = np.log10(np.add.reduceat(power[:, :edges[-1]], edges[:-1], axis=1) + 1e-10)
+    n_env_bands, n_env_bins = ENVELOPE_SHAPE
+    envelope = np.stack([
+        chunk.mean(axis=(0, 1)) if chunk.size else 0.0
+        for time_chunk in np.array_split(bands, n_env_bins, axis=0)
+        for chunk in np.array_split(time_chunk, n_env_bands, axis=1)
+    ])
+    return _zscore(np.concatenate([_zscore(bands.mean(axis=0)), _zscore(bands.std(axis=0)), _zscore(envelope)]))
+
+
+class SegmentFilter:
+    '''
+    Pre-upload filter over a recording's segment plan. Segments that are mostly silence
+    are dropped, and segments whose spectral fingerprint nearly matches an earlier
+    segment of the same recording are marked as duplicates of it, and dropped too if
+    drop_duplicates is set. Every dropped segment is one Cyanite analysis and upload
+    saved, which summary() totals up.
+
+    params:
+        - silence_db (float): frames quieter than this (dBFS) are silence.
+        - min_active (float): segments with a smaller fraction of non-silent frames are silent.
+        - duplicate_similarity (float): fingerprint cosine similarity from which a segment is a duplicate.
+        - drop_silent (bool): drop silent segments.
+        - drop_duplicates (bool): drop duplicate segments rather than only reporting them.
+        - sr (int): rate recordings are decoded at for the analysis.
+    '''
+    def __init__(
+        self,
+        silence_db:float = SILENCE_DB,
+        min_active:float = MIN_ACTIVE,
+        duplicate_similarity:float = DUPLICATE_SIMILARITY,
+        drop_silent:bool = True,
+        drop_duplicates:bool = False,
+        sr:int = SAMPLE_RATE
+    ):
+        self.silence_db = silence_db
+        self.min_active = min_active
+        self.duplicate_similarity = duplicate_similarity
+        self.drop_silent = drop_silent
+        self.drop_duplicates = drop_duplicates
+        self.sr = sr
+        self._edges = band_edges(sr)
+        self._lock = threading.Lock()
+        self._totals = {'segments': 0, 'silent': 0, 'duplicates': 0, 'dropped': 0, 'seconds': 0.0, 'dropped_seconds': 0.0, 'dropped_bytes': 0}
+
+    def settings(self) -> dict:
+        '''Constructor arguments of this filter, to build an equivalent one in another process.'''
+        return {
+            'silence_db': self.silence_db, 'min_active': self.min_active, 'duplicate_similarity': self.duplicate_similarity,
+            'drop_silent': self.drop_silent, 'drop_duplicates': self.drop_duplicates, 'sr': self.sr,
+        }
+
+    def windows(self, samples:np.ndarray, plan:list):
+        '''
+        The samples of each planned (start, end, file_name, tags) segment, sliced out of a
+        whole recording decoded at sr. start and end are in ms, an end of None meaning the
+        end of the recording.
+        '''
+        for start, end, _, _ in plan:
+            yield samples[int(start * self.sr / 1000):None if end is None else int(end * self.sr / 1000)]
+
+    def analyse(self, windows, plan:list) -> list:
+        '''
+        Loudness and duplicate check of each planned (start, end, file_name, tags) segment.
+        windows yields the samples of each segment at sr in plan order, e.g. windows(samples,
+        plan) or one load_pcm per segment. Only a fingerprint of each is kept, so a generator
+        holds one segment in memory at a time.
+
+        returns:
+            - one dict per segment with file_name, seconds, active (fraction of non-silent
+            frames), silent, and duplicate_of / similarity of the earlier segment it repeats.
+        '''
+        results, prints = [], []
+        for (_, _, file_name, _), window in zip(plan, windows):
+            framed = frames(window)
+            active = float(np.mean(frame_db(framed) > self.silence_db)) if len(framed) else 0.0
+            silent = active < self.min_active
+            results.append({
+                'file_name': file_name, 'seconds': len(window) / self.sr, 'active': round(active, 4),
+                'silent': silent, 'duplicate_of': None, 'similarity': None,
+            })
+            # Silence matches any other silence, so it is never a duplicate or an original
+            prints.append(None if silent or not len(framed) else fingerprint(framed, self._edges))
+
+        kept = [i for i, p in enumerate(prints) if p is not None]
+        if len(kept) > 1:
+            matrix = np.stack([prints[i] for i in kept])
+            similarity = matrix @ matrix.T
+            originals = []
+            for row, i in enumerate(kept):
+                if originals:
+                    best = max(originals, key=lambda o: similarity[row, o])
+                    if similarity[row, best] >= self.duplicate_similarity:
+                        results[i]['duplicate_of'] = results[kept[best]]['file_name']
+                        results[i]['similarity'] = round(float(similarity[row, best]), 6)
+                        continue
+                originals.append(row)
+        return results
+
+    def prune(self, windows, plan:list, recording_bytes:int = None) -> list:
+        '''
+        Drop silent (and, with drop_duplicates, duplicate) segments from plan and add them
+        to the totals. windows are the segments' samples as for analyse. recording_bytes
+        estimates the upload size saved, pro rata by the duration analysed.
+
+        returns:
+            - the remaining plan.
+        '''
+        results = self.analyse(windows, plan)
+        keep, dropped_seconds, silent, duplicates = [], 0.0, 0, 0
+        for segment, result in zip(plan, results):
+            silent += result['silent']
+            duplicates += result['duplicate_of'] is not None
+            if (self.drop_silent and result['silent']) or (self.drop_duplicates and result['duplicate_of'] is not None):
+                dropped_seconds += result['seconds']
+                reason = 'silent' if result['silent'] else f'duplicate of {result["duplicate_of"]} ({result["similarity"]:.4f})'
+                print(f'Skipping {result["file_name"]}: {reason}')
+                continue
+            if result['duplicate_of'] is not None:
+                print(f'{result["file_name"]} looks like a duplicate of {result["duplicate_of"]} ({result["similarity"]:.4f})')
+            keep.append(segment)
+
+        seconds = sum(r['seconds'] for r in results)
+        dropped = len(plan) - len(keep)
+        dropped_bytes = int(recording_bytes * dropped_seconds / seconds) if recording_bytes and seconds else 0
+        with self._lock:
+            totals = self._totals
+            totals['segments'] += len(plan)
+            totals['silent'] += silent
+            totals['duplicates'] += duplicates
+            totals['dropped'] += dropped
+            totals['seconds'] += seconds
+            totals['dropped_seconds'] += dropped_seconds
+            totals['dropped_bytes'] += dropped_bytes
+        metrics.count('segments_silent', silent)
+        metrics.count('segments_duplicate', duplicates)
+        metrics.count('segments_dropped', dropped)
+        return keep
+
+    def merge(self, totals:dict):
+        '''Add the summary() of a filter that pruned in another process to the totals.'''
+        with self._lock:
+            for key, value in totals.items():
+                self._totals[key] += value
+
+    def summary(self) -> dict:
+        '''Totals over every plan pruned so far.'''
+        with self._lock:
+            return dict(self._totals)
+
+    def report(self):
+        totals = self.summary()
+        if not totals['segments']:
+            return
+        print(
+            f"Segment filter: dropped {totals['dropped']} of {totals['segments']} segments "
+            f"({totals['silent']} silent, {totals['duplicates']} duplicate), "
+            f"{totals['dropped_seconds'] / 60:.1f} of {totals['seconds'] / 60:.1f} min of audio, "
+            f"~{totals['dropped_bytes'] / 1e6:.1f} MB of uploads"
+        )
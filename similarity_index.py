@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+from feature_schema import NUMERIC_COLUMNS
+
+# Valence/arousal and the mood, moodAdvanced and movement scores. BPM is left out, its
+# scale would swamp the 0-1 scores.
+VECTOR_COLUMNS = tuple(c for c in NUMERIC_COLUMNS if not c.startswith('bpm'))
+# Queries scored against the whole matrix at once, bounding the (queries, rows) score block
+QUERY_BLOCK = 1024
+KMEANS_ITERATIONS = 20
+
+
+def _top_k(scores, k:int):
+    '''Column indices of the k highest scores of each row, best first.'''
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def kmeans(vectors, n_clusters:int, iterations:int = KMEANS_ITERATIONS, seed:int = 0):
+    '''
+    Plain Lloyd's k-means.
+
+    returns:
+        - (centroids, assignment): (n_clusters, d) centroids and the cluster of each row.
+    '''
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    sq_norms = np.einsum('ij,ij->i', vectors, vectors)
+    for _ in range(iterations):
+        # Squared L2 distance without the (n, k, d) intermediate
+        dist = sq_norms[:, None] - 2 * vectors @ centroids.T + np.einsum('ij,ij->i', centroids, centroids)
+        assignment = dist.argmin(axis=1)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        # An emptied cluster keeps its old centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids, assignment
+
+
+class SimilarityIndex:
+    '''
+    Nearest-neighbour index over the Cyanite feature vectors of a set of segments. Exact
+    search scores each block of queries against the whole float32 matrix with one
+    matrix product. With n_lists set, an inverted-file index clusters the vectors with
+    k-means and only scores the vectors of the n_probe clusters nearest each query,
+    trading a little recall for speed on large corpora.
+
+    params:
+        - vectors (np.ndarray): (n, d) feature matrix.
+        - meta (pd.DataFrame): one row per vector, e.g. filename and genre.
+        - metric (str): 'cosine' or 'l2'.
+        - n_lists (int): number of k-means clusters for approximate search, None for exact.
+        - n_probe (int): clusters searched per query in approximate search.
+    '''
+    def __init__(self, vectors, meta, metric:str = 'cosine', n_lists:int = None, n_probe:int = 8):
+        assert metric in ('cosine', 'l2'), f'Unknown metric {metric}'
+        assert len(vectors) == len(meta), 'Need one meta row per vector'
+        self.metric = metric
+        self.meta = meta.reset_index(drop=True)
+        self.vectors = self._prepare(np.asarray(vectors, dtype=np.float32))
+        self.sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.n_probe = n_probe
+        self.centroids = None
+        if n_lists:
+            self.centroids, assignment = kmeans(self.vectors, min(n_lists, len(self.vectors)))
+            # Row ids grouped by cluster, with cluster c at lists[offsets[c]:offsets[c + 1]]
+            self.lists = np.argsort(assignment, kind='stable')
+            self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(self.centroids)))])
+
+    @classmethod
+    def from_csv(cls, csv_path:str, columns=VECTOR_COLUMNS, **kwargs):
+        '''Build an index from a feature CSV written by parse_and_save_features.'''
+        df = pd.read_csv(csv_path)
+        # Segments whose analysis lacks a score can't be placed
+        df = df.dropna(subset=list(columns)).reset_index(drop=True)
+        vectors = df[list(columns)].to_numpy(dtype=np.float32)
+        return cls(vectors, df.drop(columns=[c for c in df.columns if c in NUMERIC_COLUMNS]), **kwargs)
+
+    def _prepare(self, vectors):
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+        return vectors
+
+    def _scores(self, queries, rows=None):
+        '''Similarity of each query to each row (negated squared distance for l2), higher is closer.'''
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        scores = queries @ vectors.T
+        if self.metric == 'l2':
+            sq_norms = self.sq_norms if rows is None else self.sq_norms[rows]
+            scores = 2 * scores - sq_norms - np.einsum('ij,ij->i', queries, queries)[:, None]
+        return scores
+
+    def search(self, queries, k:int = 10, mask=None):
+        '''
+        Batched top-k search.
+
+        params:
+            - queries (np.ndarray): (q, d) query vectors, or one (d,) vector.
+            - mask (np.ndarray): boolean mask of the rows that may be returned.
+
+        returns:
+            - (ids, scores): (q, k) row ids, best first, and their cosine similarity or L2
+            distance. Rows past the number of candidates are -1.
+        '''
+        queries = self._prepare(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), np.nan, dtype=np.float32)
+        for start in range(0, len(queries), QUERY_BLOCK):
+            block = queries[start:start + QUERY_BLOCK]
+            if self.centroids is None:
+                self._search_exact(block, k, mask, ids[start:], scores[start:])
+            else:
+                self._search_lists(block, k, mask, ids[start:], scores[start:])
+        if self.metric == 'l2':
+            scores = np.sqrt(np.maximum(-scores, 0))
+        return ids, scores
+
+    def _search_exact(self, queries, k, mask, ids, scores):
+        block = self._scores(queries)
+        if mask is not None:
+            block[:, ~mask] = -np.inf
+        top = _top_k(block, k)
+        found = np.take_along_axis(block, top, axis=1)
+        valid = np.isfinite(found)
+        ids[:len(queries), :top.shape[1]] = np.where(valid, top, -1)
+        scores[:len(queries), :top.shape[1]] = np.where(valid, found, np.nan)
+
+    def _search_lists(self, queries, k, mask, ids, scores):
+        # Nearest clusters by L2 to the centroid, which for unit vectors is also nearest by cosine
+        dist = (np.einsum('ij,ij->i', self.centroids, self.centroids) - 2 * queries @ self.centroids.T)
+        probes = _top_k(-dist, self.n_probe)
+        for i, clusters in enumerate(probes):
+            rows = np.concatenate([self.lists[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+            if mask is not None:
+                rows = rows[mask[rows]]
+            if not len(rows):
+                continue
+            row_scores = self._scores(queries[i:i + 1], rows)
+            top = _top_k(row_scores, k)[0]
+            ids[i, :len(top)] = rows[top]
+            scores[i, :len(top)] = row_scores[0, top]
+
+    def similar(self, filename:str, k:int = 10, genre:str = None):
+        '''
+        The k segments most similar to an indexed one, optionally only from one genre.
+
+        returns:
+            - pd.DataFrame of the matches' meta rows, best first, with a score column.
+        '''
+        row = np.flatnonzero(self.meta['filename'] == filename)
+        assert len(row), f'{filename} is not in the index'
+        mask = np.ones(len(self.meta), dtype=bool)
+        mask[row[0]] = False
+        if genre is not None:
+            mask &= (self.meta['genre'] == genre).to_numpy()
+        return self.query(self.vectors[row[0]], k, mask)
+
+    def query(self, vector, k:int = 10, mask=None):
+        '''Meta rows of the k nearest segments to one feature vector, with a score column.'''
+        ids, scores = self.search(vector, k, mask)
+        found = ids[0] >= 0
+        matches = self.meta.iloc[ids[0][found]].copy()
+        matches['score'] = scores[0][found]
+        return matches.reset_index(drop=True)
@@ -0,0 +1,52 @@
+import asyncio
+
+import aiohttp
+import requests
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+
+from cyaniteAPI import LibraryTrackCreateError, classifyError
+from rate_limit import FATAL, THROTTLE, TRANSIENT
+
+
+def query_error(message:str, code=None) -> TransportQueryError:
+    error = {'message': message}
+    if code is not None:
+        error['extensions'] = {'code': code}
+    return TransportQueryError(message, errors=[error])
+
+
+def http_error(status:int, headers=None) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+def test_http_status():
+    assert classifyError(http_error(429, {'Retry-After': '7'})) == (THROTTLE, 7.0)
+    assert classifyError(http_error(429)) == (THROTTLE, None)
+    assert classifyError(http_error(503)) == (TRANSIENT, None)
+    assert classifyError(http_error(404)) == (FATAL, None)
+    assert classifyError(TransportServerError('Too Many Requests', 429)) == (THROTTLE, None)
+    assert classifyError(TransportServerError('Bad Gateway', 502)) == (TRANSIENT, None)
+
+
+def test_graphql_error_code():
+    assert classifyError(query_error('Slow down', 'RATE_LIMITED')) == (THROTTLE, None)
+    assert classifyError(query_error('Slow down', 'tooManyRequests')) == (THROTTLE, None)
+    assert classifyError(LibraryTrackCreateError('RATE_LIMIT_EXCEEDED', 'Slow down')) == (THROTTLE, None)
+
+
+def test_graphql_error_text_is_not_a_throttle():
+    '''Messages that merely mention a rate or a limit are fatal unless their code says otherwise.'''
+    assert classifyError(query_error('Argument "limit" must be at most 100', 'BAD_USER_INPUT')) == (FATAL, None)
+    assert classifyError(query_error('Unknown sample rate')) == (FATAL, None)
+    assert classifyError(LibraryTrackCreateError('fileTooLarge', 'File exceeds the size limit')) == (FATAL, None)
+    assert classifyError(LibraryTrackCreateError(None, 'Too many tracks in library')) == (FATAL, None)
+
+
+def test_connection_errors_are_transient():
+    assert classifyError(requests.ConnectionError()) == (TRANSIENT, None)
+    assert classifyError(aiohttp.ClientConnectionError()) == (TRANSIENT, None)
+    assert classifyError(asyncio.TimeoutError()) == (TRANSIENT, None)
+    assert classifyError(ValueError()) == (FATAL, None)
@@ -0,0 +1,140 @@
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.mock_cyanite import synthetic_result
+from feature_schema import CATEGORICAL_FIELDS, NUMERIC_COLUMNS, TAG_FIELDS
+from parse_and_save_features import (
+    DATASET_BATCH_SIZE, aggregate_by_recording, load_features, process_features, process_features_dataset,
+    process_features_incremental, process_features_parallel
+)
+
+
+def write_results(workdir, n:int, genres=('hindustani', 'andalusian')) -> tuple:
+    '''Write n synthetic classifier JSONs and a segments CSV listing them. Returns (csv_path, jsons_dir).'''
+    jsons_dir = os.path.join(workdir, 'classifierResults')
+    os.makedirs(jsons_dir, exist_ok=True)
+    filenames = [f'rec-{i // 4:06d}_{i % 4}.mp3' for i in range(n)]
+    for file_ in filenames:
+        with open(os.path.join(jsons_dir, file_.split('.')[0] + '.json'), 'w') as f:
+            json.dump({'libraryTrack': {'audioAnalysisV6': {'result': synthetic_result(file_)}}}, f)
+    csv_path = os.path.join(workdir, 'segments.csv')
+    pd.DataFrame({'filename': filenames, 'genre': [genres[i % len(genres)] for i in range(n)]}).to_csv(csv_path, index=False)
+    return csv_path, jsons_dir
+
+
+def test_dataset_round_trip(tmp_path):
+    '''A dataset spanning several record batches reads back every value, in each format.'''
+    n = 2 * DATASET_BATCH_SIZE + 52
+    csv_path, jsons_dir = write_results(tmp_path, n)
+    for format in ('parquet', 'arrow'):
+        dataset_path = os.path.join(tmp_path, f'features_{format}')
+        process_features_dataset(csv_path, jsons_dir, dataset_path, format=format)
+        df = load_features(dataset_path, format=format).to_pandas().set_index('filename')
+        assert len(df) == n, f'{format}: read {len(df)} of {n} rows'
+        for file_, row in df.iterrows():
+            result = synthetic_result(file_)
+            for name in CATEGORICAL_FIELDS:
+                assert row[name] == result[name], f'{format}: {file_} {name}'
+            for name in TAG_FIELDS:
+                assert list(row[name]) == result[name], f'{format}: {file_} {name}'
+            for name in NUMERIC_COLUMNS:
+                group, _, field = name.partition('.')
+                expected = result[group][field] if field else result[name]
+                assert math.isclose(row[name], expected, rel_tol=1e-6), f'{format}: {file_} {name}'
+
+
+def test_aggregate_filtered_index(tmp_path):
+    '''A filtered and shuffled frame, whose index is neither 0..n-1 nor sorted, aggregates as with a fresh index.'''
+    csv_path, jsons_dir = write_results(tmp_path, 400)
+    dataset_path = os.path.join(tmp_path, 'features')
+    process_features_dataset(csv_path, jsons_dir, dataset_path)
+    features = load_features(dataset_path).to_pandas()
+    subset = features[features.index >= 10].sample(frac=1, random_state=0)
+    expected = aggregate_by_recording(subset.reset_index(drop=True))
+    pd.testing.assert_frame_equal(aggregate_by_recording(subset), expected)
+    assert expected['moodTags_top'].notna().all()
+
+
+def test_incremental_counts(tmp_path):
+    '''A result saved before its analysis finished and rewritten once it has is an added row, not a replaced one.'''
+    n = 8
+    csv_path, jsons_dir = write_results(tmp_path, n)
+    features_csv = os.path.join(tmp_path, 'features.csv')
+    late = os.path.join(jsons_dir, 'rec-000000_0.json')
+    with open(late) as f:
+        finished = json.load(f)
+    steps = [
+        ({'libraryTrack': {'audioAnalysisV6': {'__typename': 'AudioAnalysisV6Processing'}}}, (n - 1, 0)),
+        (finished, (1, 0)),
+        ({'libraryTrack': {'audioAnalysisV6': {'result': {**finished['libraryTrack']['audioAnalysisV6']['result'], 'valence': 0.5}}}}, (0, 1)),
+    ]
+    for i, (content, expected) in enumerate(steps):
+        with open(late, 'w') as f:
+            json.dump(content, f)
+        # A rewrite within the mtime resolution must still be seen
+        os.utime(late, ns=(i * 10 ** 9, i * 10 ** 9))
+        assert process_features_incremental(csv_path, jsons_dir, features_csv) == expected, f'step {i}'
+    df = pd.read_csv(features_csv)
+    assert len(df) == n and df['filename'].is_unique
+
+
+def test_incremental_over_unmanifested_csv(tmp_path):
+    '''Incremental runs over a CSV without a manifest, or after a run that stopped before saving it, never duplicate rows.'''
+    n = 20
+    csv_path, jsons_dir = write_results(tmp_path, n)
+    features_csv = os.path.join(tmp_path, 'features.csv')
+    manifest_path = features_csv + '.manifest.json'
+    process_features(csv_path, jsons_dir, features_csv)
+    assert process_features_incremental(csv_path, jsons_dir, features_csv) == (0, n)
+    assert process_features_incremental(csv_path, jsons_dir, features_csv) == (0, 0)
+    # Appended, but the manifest was lost before it was saved
+    os.remove(manifest_path)
+    assert process_features_incremental(csv_path, jsons_dir, features_csv) == (0, n)
+    reference_csv = os.path.join(tmp_path, 'reference.csv')
+    process_features(csv_path, jsons_dir, reference_csv)
+    df = pd.read_csv(features_csv)
+    assert len(df) == n and df['filename'].is_unique
+    pd.testing.assert_frame_equal(df.sort_values('filename', ignore_index=True), pd.read_csv(reference_csv))
+
+
+def test_aggregate_dominant_missing(tmp_path):
+    '''A recording without a score in a group has no dominant one, rather than the group's first field.'''
+    csv_path, jsons_dir = write_results(tmp_path, 8)
+    dataset_path = os.path.join(tmp_path, 'features')
+    process_features_dataset(csv_path, jsons_dir, dataset_path)
+    features = load_features(dataset_path).to_pandas()
+    mood = [c for c in NUMERIC_COLUMNS if c.startswith('mood.')]
+    features.loc[features['filename'].str.startswith('rec-000001'), mood] = np.nan
+    out = aggregate_by_recording(features)
+    assert out['dominant_mood'].isna().tolist() == [False, True]
+    assert out['dominant_moodAdvanced'].notna().all()
+
+
+def test_parallel_matches_serial(tmp_path):
+    '''The parallel CSV is byte-identical to the serial one, also with null nested objects in first or later rows.'''
+    cases = {
+        'complete': [],
+        'later null': [(3, 'bpmPrediction')],
+        'first null': [(0, 'bpmPrediction'), (0, 'mood')],
+        'mixed': [(1, 'movement'), (5, 'mood'), (5, 'movement'), (9, 'moodAdvanced')],
+    }
+    for name, nulls in cases.items():
+        workdir = os.path.join(tmp_path, name.replace(' ', '_'))
+        csv_path, jsons_dir = write_results(workdir, 12)
+        filenames = pd.read_csv(csv_path)['filename']
+        for i, group in nulls:
+            path = os.path.join(jsons_dir, filenames[i].split('.')[0] + '.json')
+            with open(path) as f:
+                content = json.load(f)
+            content['libraryTrack']['audioAnalysisV6']['result'][group] = None
+            with open(path, 'w') as f:
+                json.dump(content, f)
+        serial_csv, parallel_csv = os.path.join(workdir, 'serial.csv'), os.path.join(workdir, 'parallel.csv')
+        process_features(csv_path, jsons_dir, serial_csv)
+        process_features_parallel(csv_path, jsons_dir, parallel_csv, workers=2)
+        with open(serial_csv) as serial, open(parallel_csv) as parallel:
+            assert parallel.read() == serial.read(), name
@@ -0,0 +1,148 @@
+import asyncio
+import types
+
+import pytest
+
+import rate_limit
+from rate_limit import FATAL, THROTTLE, TRANSIENT, RetryStats, TokenBucket, retry, retry_async
+
+
+class Clock:
+    '''Stand-in for the time module: monotonic only moves when something sleeps.'''
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds:float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    async def sleep_async(self, seconds:float):
+        self.sleep(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    monkeypatch.setattr(rate_limit, 'asyncio', types.SimpleNamespace(sleep=clock.sleep_async))
+    return clock
+
+
+class Flaky:
+    '''Callable raising the given errors in turn, then returning 'ok'.'''
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__('throttled')
+        self.retry_after = retry_after
+
+
+def classify(e):
+    if isinstance(e, Throttled):
+        return THROTTLE, e.retry_after
+    if isinstance(e, ConnectionError):
+        return TRANSIENT, None
+    return FATAL, None
+
+
+def test_bucket_allows_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.slept == []
+    bucket.acquire()
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+def test_bucket_refill_caps_at_burst(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 60
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.slept == []
+    bucket.acquire()
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+def test_pause_holds_every_caller(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    bucket.pause(2)
+    # A shorter pause does not cut a longer one short
+    bucket.pause(1)
+    bucket.acquire()
+    assert sum(clock.slept) == pytest.approx(2)
+    asyncio.run(bucket.acquire_async())
+    assert sum(clock.slept) == pytest.approx(2)
+
+
+def test_retry_transient_with_backoff(clock):
+    fn, stats = Flaky(ConnectionError(), ConnectionError()), RetryStats()
+    assert retry(fn, classify, stats=stats, base_delay=1, max_delay=60) == 'ok'
+    assert fn.calls == 3
+    assert stats.snapshot() == {'calls': 3, 'throttles': 0, 'retries': 2, 'failures': 0}
+    # Jittered between half and all of base_delay * 2 ** (attempt - 1)
+    assert 0.5 <= clock.slept[0] <= 1 and 1 <= clock.slept[1] <= 2
+
+
+def test_retry_raises_fatal_at_once(clock):
+    fn, stats = Flaky(ValueError('bad query')), RetryStats()
+    with pytest.raises(ValueError):
+        retry(fn, classify, stats=stats)
+    assert fn.calls == 1 and clock.slept == []
+    assert stats.snapshot() == {'calls': 1, 'throttles': 0, 'retries': 0, 'failures': 1}
+
+
+def test_retry_only_retries_retry_on(clock):
+    fn = Flaky(ConnectionError())
+    with pytest.raises(ConnectionError):
+        retry(fn, classify, retry_on=(THROTTLE,))
+    assert fn.calls == 1
+
+
+def test_retry_gives_up_after_max_attempts(clock):
+    fn, stats = Flaky(*[ConnectionError()] * 5), RetryStats()
+    with pytest.raises(ConnectionError):
+        retry(fn, classify, stats=stats, max_attempts=3)
+    assert fn.calls == 3 and len(clock.slept) == 2
+    assert stats.snapshot() == {'calls': 3, 'throttles': 0, 'retries': 2, 'failures': 1}
+
+
+def test_retry_throttle_pauses_limiter(clock):
+    bucket, stats = TokenBucket(rate=100, burst=10), RetryStats()
+    fn, start = Flaky(Throttled(retry_after=5)), clock.now
+    assert retry(fn, classify, limiter=bucket, stats=stats) == 'ok'
+    assert clock.slept == [5]
+    assert stats.snapshot() == {'calls': 2, 'throttles': 1, 'retries': 1, 'failures': 0}
+    # Every other caller of the bucket waits out the Retry-After as well
+    assert bucket._paused_until == start + 5
+
+
+def test_retry_async(clock):
+    bucket, stats = TokenBucket(rate=100, burst=10), RetryStats()
+    fn = Flaky(ConnectionError(), Throttled(retry_after=3), ValueError())
+
+    async def call():
+        return fn()
+
+    with pytest.raises(ValueError):
+        asyncio.run(retry_async(call, classify, limiter=bucket, stats=stats))
+    assert fn.calls == 3
+    assert 0.5 <= clock.slept[0] <= 1 and clock.slept[1] == 3 and len(clock.slept) == 2
+    assert stats.snapshot() == {'calls': 3, 'throttles': 1, 'retries': 2, 'failures': 1}
+    assert asyncio.run(retry_async(call, classify, limiter=bucket, stats=stats)) == 'ok'
@@ -0,0 +1,61 @@
+import numpy as np
+
+from segment_filter import SAMPLE_RATE, SegmentFilter
+
+SECONDS = 20
+
+
+def tone(f0:float, seed:int) -> np.ndarray:
+    '''A few seconds of a note sequence with harmonics and a little noise, at SAMPLE_RATE.'''
+    rng = np.random.default_rng(seed)
+    notes = np.repeat(f0 * rng.choice([1, 9 / 8, 5 / 4, 3 / 2, 5 / 3, 2], size=SECONDS), SAMPLE_RATE)
+    phase = 2 * np.pi * np.cumsum(notes) / SAMPLE_RATE
+    x = sum(np.sin(k * phase) / k for k in range(1, 5)) * 0.2
+    return (x + 0.01 * rng.standard_normal(len(x))).astype(np.float32)
+
+
+def recording() -> tuple:
+    '''Music, silence, the music again, other music and the first again at half the gain.'''
+    a, b = tone(220, 1), tone(147, 2)
+    silence = (0.0005 * np.random.default_rng(0).standard_normal(len(a))).astype(np.float32)
+    samples = np.concatenate([a, silence, a, b, 0.5 * a])
+    ms = SECONDS * 1000
+    plan = [(i * ms, (i + 1) * ms if i < 4 else None, f'rec_{i}.mp3', {}) for i in range(5)]
+    return samples, plan
+
+
+def test_analyse_flags_silence_and_duplicates():
+    samples, plan = recording()
+    results = SegmentFilter().analyse(SegmentFilter().windows(samples, plan), plan)
+    assert [r['silent'] for r in results] == [False, True, False, False, False]
+    assert [r['duplicate_of'] for r in results] == [None, None, 'rec_0.mp3', None, 'rec_0.mp3']
+
+
+def test_analyse_reads_windows_lazily():
+    '''Windows can come from a generator, e.g. one decode per segment, and are read in plan order.'''
+    samples, plan = recording()
+    f = SegmentFilter()
+    read = []
+
+    def windows():
+        for i, window in enumerate(f.windows(samples, plan)):
+            read.append(i)
+            yield window.copy()
+
+    assert f.analyse(windows(), plan) == f.analyse(f.windows(samples, plan), plan)
+    assert read == list(range(len(plan)))
+
+
+def test_prune_and_totals():
+    samples, plan = recording()
+    f = SegmentFilter(drop_duplicates=True)
+    keep = f.prune(f.windows(samples, plan), plan, recording_bytes=5000)
+    assert [segment[2] for segment in keep] == ['rec_0.mp3', 'rec_3.mp3']
+    totals = f.summary()
+    assert (totals['segments'], totals['silent'], totals['duplicates'], totals['dropped']) == (5, 1, 2, 3)
+    assert totals['dropped_bytes'] == 3000
+
+    other = SegmentFilter(**f.settings())
+    other.prune(other.windows(samples, plan), plan)
+    f.merge(other.summary())
+    assert f.summary()['segments'] == 10 and f.summary()['dropped'] == 6
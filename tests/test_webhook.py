@@ -0,0 +1,92 @@
+import asyncio
+import hmac
+import json
+import socket
+from hashlib import sha512
+
+import requests
+
+import cyaniteAPI
+from cyaniteAPI import WebhookReceiver
+
+SECRET = 's3cret'
+
+
+def post_event(port:int, trackID:str) -> int:
+    body = json.dumps({
+        'resource': {'type': 'LibraryTrack', 'id': trackID},
+        'event': {'type': 'AudioAnalysisV6', 'status': 'finished'},
+    }).encode()
+    signature = hmac.new(SECRET.encode(), body, sha512).hexdigest()
+    url = f'http://127.0.0.1:{port}{cyaniteAPI.WEBHOOK_PATH}'
+    return requests.post(url, data=body, headers={'Signature': signature, 'Content-Type': 'application/json'}).status_code
+
+
+def test_events_only_kept_for_waiting_tracks():
+    async def run():
+        receiver = WebhookReceiver(None, 0, SECRET, host='127.0.0.1')
+        receiver.start()
+        loop = asyncio.get_running_loop()
+        try:
+            waiting = receiver._events.setdefault('waited', asyncio.Event())
+            for trackID in ('waited', 'unknown-1', 'unknown-2'):
+                assert await loop.run_in_executor(None, post_event, receiver.port, trackID) == 200
+            # Let the notifications scheduled from the server thread run
+            await asyncio.sleep(0.1)
+            return waiting.is_set(), set(receiver._events)
+        finally:
+            receiver.stop()
+
+    is_set, tracks = asyncio.run(run())
+    assert is_set
+    assert tracks == {'waited'}
+
+
+def test_stop_frees_the_port():
+    async def run():
+        receiver = WebhookReceiver(None, 0, SECRET, host='127.0.0.1')
+        receiver.start()
+        port = receiver.port
+        receiver.stop()
+        return port
+
+    port = asyncio.run(run())
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', port))
+
+
+def test_receiver_stopped_when_a_run_fails(tmp_path, monkeypatch):
+    '''An exception in the tagging loop still shuts the receiver down.'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cyaniteAPI, 'secret', SECRET)
+    receivers = []
+
+    class Client:
+        schema = None
+
+        async def __aenter__(self):
+            return None
+
+        async def __aexit__(self, *exc):
+            return False
+
+    def make_waiter(session, batch_size, webhook_port=None):
+        receiver = WebhookReceiver(session, 0, host='127.0.0.1')
+        receiver.start()
+        receivers.append(receiver)
+        return receiver
+
+    class Files:
+        def get(self):
+            raise RuntimeError('queue broken')
+
+    monkeypatch.setattr(cyaniteAPI, 'makeClient', Client)
+    monkeypatch.setattr(cyaniteAPI, 'makeWaiter', make_waiter)
+    try:
+        asyncio.run(cyaniteAPI.startProcessQueue(str(tmp_path), Files(), webhook_port=0))
+    except RuntimeError as e:
+        assert str(e) == 'queue broken'
+    else:
+        raise AssertionError('startProcessQueue swallowed the error')
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', receivers[0].port))
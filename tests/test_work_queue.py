@@ -0,0 +1,132 @@
+import pytest
+
+import work_queue
+from work_queue import DONE, FAILED, LEASED, PENDING, WorkQueue
+
+
+class Clock:
+    '''Stand-in for time.time that only moves when told to.'''
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(work_queue, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def wq(tmp_path, clock):
+    q = WorkQueue(str(tmp_path / 'workQueue.db'), lease_seconds=10, max_attempts=2)
+    q.add(['a.mp3', 'b.mp3'])
+    yield q
+    q.close()
+
+
+def attempts(q:WorkQueue, file:str) -> int:
+    return q._conn.execute('SELECT attempts FROM items WHERE file = ?', (file,)).fetchone()[0]
+
+
+def test_add_is_idempotent(wq):
+    assert wq.add(['a.mp3', 'c.mp3']) == 1
+    assert wq.counts()[PENDING] == 3
+
+
+def test_claim_leases_each_file_once(wq):
+    assert wq.claim('w1', 1) == ['a.mp3']
+    assert wq.claim('w2', 5) == ['b.mp3']
+    assert wq.claim('w3', 5) == []
+    assert wq.counts()[LEASED] == 2
+
+
+def test_expired_lease_is_taken_over(wq, clock):
+    wq.claim('w1', 2)
+    clock.now += 9
+    assert wq.claim('w2', 2) == []
+    clock.now += 2
+    assert sorted(wq.claim('w2', 2)) == ['a.mp3', 'b.mp3']
+    assert attempts(wq, 'a.mp3') == 2
+    # The first worker lost its leases, so its heartbeat holds nothing
+    assert wq.heartbeat('w1', ['a.mp3', 'b.mp3']) == 0
+
+
+def test_heartbeat_extends_lease(wq, clock):
+    wq.claim('w1', 2)
+    clock.now += 8
+    assert wq.heartbeat('w1', ['a.mp3']) == 1
+    clock.now += 8
+    # b.mp3 was not heartbeated and expired, a.mp3 is still held
+    assert wq.claim('w2', 2) == ['b.mp3']
+
+
+def test_fail_retries_until_max_attempts(wq):
+    wq.claim('w1', 1)
+    wq.fail('w1', 'a.mp3', 'boom')
+    assert wq.counts() == {PENDING: 2, LEASED: 0, DONE: 0, FAILED: 0}
+    assert wq.claim('w1', 1) == ['b.mp3']
+    assert wq.claim('w1', 1) == ['a.mp3']
+    wq.fail('w1', 'a.mp3', 'boom again')
+    assert wq.failures() == [('a.mp3', 'boom again')]
+    assert wq.remaining() == 1
+
+
+def test_fail_after_lease_lost_is_ignored(wq, clock):
+    wq.claim('w1', 1)
+    clock.now += 11
+    wq.claim('w2', 1)
+    wq.fail('w1', 'a.mp3', 'late')
+    assert wq.counts()[LEASED] == 1 and wq.failures() == []
+
+
+def test_complete(wq):
+    wq.claim('w1', 2)
+    wq.complete('w1', 'a.mp3')
+    assert wq.counts() == {PENDING: 0, LEASED: 1, DONE: 1, FAILED: 0}
+    assert wq.remaining() == 1
+
+
+def test_release_returns_leases_without_using_an_attempt(wq):
+    wq.claim('w1', 2)
+    wq.release('w1')
+    assert wq.counts()[PENDING] == 2
+    assert attempts(wq, 'a.mp3') == 0
+    assert sorted(wq.claim('w2', 2)) == ['a.mp3', 'b.mp3']
+
+
+def test_start_worker_settles_results(tmp_path, monkeypatch):
+    '''Only finished analyses are done. Failed analyses, timeouts and exceptions go back through fail().'''
+    import asyncio
+    import cyaniteAPI
+    results = {
+        'finished.mp3': {'status': 'AudioAnalysisV6Finished'},
+        'skipped.mp3': None,
+        'failed.mp3': {'status': 'AudioAnalysisV6Failed'},
+        'timeout.mp3': {'status': 'AudioAnalysisV6Processing'},
+        'error.mp3': RuntimeError('upload failed'),
+    }
+
+    async def tag(dirName, files, concurrency, upload_workers, batch_size, in_flight, onDone, webhook_port):
+        loop = asyncio.get_running_loop()
+        while (file := await loop.run_in_executor(None, files.get)) is not None:
+            onDone(file, results[file])
+
+    path = str(tmp_path / 'workQueue.db')
+    q = WorkQueue(path, max_attempts=1)
+    q.add(list(results))
+    q.close()
+    monkeypatch.setattr(cyaniteAPI, 'startProcessQueue', tag)
+    monkeypatch.setattr(cyaniteAPI, 'WORK_POLL', 0.05)
+    monkeypatch.setattr(cyaniteAPI, 'WorkQueue', lambda path, lease: WorkQueue(path, lease, max_attempts=1))
+    cyaniteAPI.startWorker(str(tmp_path), path, 'w1')
+
+    q = WorkQueue(path)
+    assert q.counts() == {PENDING: 0, LEASED: 0, DONE: 2, FAILED: 3}
+    assert dict(q.failures()) == {
+        'failed.mp3': 'AudioAnalysisV6Failed', 'timeout.mp3': 'AudioAnalysisV6Processing', 'error.mp3': "RuntimeError('upload failed')",
+    }
+    q.close()
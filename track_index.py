@@ -0,0 +1,74 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class TrackIndex:
+    '''
+    Persistent index from the SHA-256 of an audio file's bytes to its Cyanite library
+    track ID and the feature payload fetched for it. Lets re-runs skip audio that has
+    already been uploaded or analysed.
+
+    params:
+        - path (str): path to the sqlite database. Created if it doesn't exist.
+    '''
+    def __init__(self, path:str = 'trackIndex.db'):
+        self.path = path
+        # The async pipeline hands work to threads, so share one connection behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    sha256 TEXT PRIMARY KEY,
+                    track_id TEXT NOT NULL,
+                    features TEXT,
+                    updated TEXT NOT NULL
+                )
+                '''
+            )
+
+    def get(self, sha256:str):
+        '''
+        Look up a file hash.
+
+        returns:
+            - (track_id, features) where features is None until the analysis has been
+            cached, or None if the hash is unknown.
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT track_id, features FROM tracks WHERE sha256 = ?', (sha256,)
+            ).fetchone()
+        if row is None:
+            return None
+        track_id, features = row
+        return track_id, (json.loads(features) if features is not None else None)
+
+    def set_track(self, sha256:str, track_id:str):
+        '''Record the library track for a hash, keeping any cached features for the same track.'''
+        with self._lock, self._conn:
+            self._conn.execute(
+                '''
+                INSERT INTO tracks (sha256, track_id, updated) VALUES (?, ?, ?)
+                ON CONFLICT(sha256) DO UPDATE SET
+                    features = CASE WHEN track_id = excluded.track_id THEN features END,
+                    track_id = excluded.track_id,
+                    updated = excluded.updated
+                ''',
+                (sha256, track_id, str(datetime.now()))
+            )
+
+    def set_features(self, sha256:str, features:dict):
+        '''Cache the finished feature payload for a hash already recorded with set_track.'''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE tracks SET features = ?, updated = ? WHERE sha256 = ?',
+                (json.dumps(features), str(datetime.now()), sha256)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
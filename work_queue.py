@@ -0,0 +1,153 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# States of a work item
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue:
+    '''
+    Shared queue of files to tag, for running several workers against one file list.
+    A worker claims a few files at a time under a lease and has to heartbeat to keep
+    it. If a worker dies its leases run out and its files go back to other workers.
+
+    Workers on several hosts can share the database over a network filesystem as long
+    as it supports POSIX locks, and their clocks are roughly in sync.
+
+    params:
+        - path (str): path to the sqlite database. Created if it doesn't exist.
+        - lease_seconds (float): how long a claim lasts without a heartbeat.
+        - max_attempts (int): claims a file gets before a failure is final.
+    '''
+    def __init__(self, path:str = 'workQueue.db', lease_seconds:float = 300, max_attempts:int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Transactions are opened explicitly, so a claim can take the write lock before reading
+        self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS items (
+                    file TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated REAL NOT NULL
+                )
+                '''
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_until)')
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so reads inside see no concurrent claims
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def add(self, files:list) -> int:
+        '''Queue files that aren't queued yet. Returns how many were added.'''
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO items (file, status, updated) VALUES (?, ?, ?)',
+                [(file, PENDING, now) for file in files]
+            )
+            return conn.total_changes - before
+
+    def claim(self, worker:str, n:int = 1) -> list:
+        '''Lease up to n pending or expired files to worker.'''
+        now = time.time()
+        with self._transaction() as conn:
+            files = [row[0] for row in conn.execute(
+                '''
+                SELECT file FROM items
+                WHERE status = ? OR (status = ? AND lease_until < ?)
+                ORDER BY attempts, file LIMIT ?
+                ''',
+                (PENDING, LEASED, now, n)
+            )]
+            conn.executemany(
+                '''
+                UPDATE items SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ?
+                WHERE file = ?
+                ''',
+                [(LEASED, worker, now + self.lease_seconds, now, file) for file in files]
+            )
+        return files
+
+    def heartbeat(self, worker:str, files) -> int:
+        '''Extend worker's leases on files. Returns how many it still held.'''
+        files = list(files)
+        if not files:
+            return 0
+        now = time.time()
+        placeholders = ', '.join('?' * len(files))
+        with self._transaction() as conn:
+            return conn.execute(
+                f'UPDATE items SET lease_until = ?, updated = ? WHERE status = ? AND worker = ? AND file IN ({placeholders})',
+                (now + self.lease_seconds, now, LEASED, worker, *files)
+            ).rowcount
+
+    def complete(self, worker:str, file:str):
+        '''Mark a file done. A file whose lease was lost and re-claimed is still done, its result is the same.'''
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE items SET status = ?, worker = ?, lease_until = NULL, error = NULL, updated = ? WHERE file = ?',
+                (DONE, worker, time.time(), file)
+            )
+
+    def fail(self, worker:str, file:str, error:str):
+        '''Give a failed file back to the queue, or mark it failed once it has used max_attempts.'''
+        with self._transaction() as conn:
+            conn.execute(
+                '''
+                UPDATE items SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                    lease_until = NULL, error = ?, updated = ?
+                WHERE file = ? AND worker = ? AND status = ?
+                ''',
+                (self.max_attempts, FAILED, PENDING, error, time.time(), file, worker, LEASED)
+            )
+
+    def release(self, worker:str):
+        '''Hand back every file worker still holds, e.g. on a clean shutdown.'''
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE items SET status = ?, lease_until = NULL, attempts = attempts - 1, updated = ? WHERE status = ? AND worker = ?',
+                (PENDING, time.time(), LEASED, worker)
+            )
+
+    def counts(self) -> dict:
+        '''Number of files in each state.'''
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM items GROUP BY status').fetchall()
+        return {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def remaining(self) -> int:
+        '''Files that are pending or leased, i.e. not settled yet.'''
+        counts = self.counts()
+        return counts[PENDING] + counts[LEASED]
+
+    def failures(self) -> list:
+        '''(file, error) of every file that failed for good.'''
+        with self._lock:
+            return self._conn.execute('SELECT file, error FROM items WHERE status = ?', (FAILED,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()